@@ -0,0 +1,538 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for tomputils.downloader against a local HTTP server.
+
+The server runs in its own process, so its CPU time and memory are not
+counted. It serves synthetic files of any size at /data/<size>, where size
+may carry a K, M or G suffix. Query parameters change how it responds:
+
+    norange=1   ignore Range and don't advertise Accept-Ranges
+    rate=N      send at most N bytes per second on each connection
+    error=P     answer a GET with 503 with probability P
+    drop=P      close the connection part way through a body with
+                probability P
+
+Each configuration is measured in a fresh process, which retrieves the file
+--repeat times. The report gives throughput, CPU seconds per GB retrieved,
+peak RSS and latency percentiles of a single fetch.
+
+    python benchmarks/bench_downloader.py [-s SIZES] [-c MAX_CON]
+        [-m MIN_SEG_SIZE] [-S SCENARIOS] [-r REPEAT] [--async]
+        [--save FILE] [--compare FILE]
+
+With --compare, throughput or CPU per GB more than --tolerance worse than
+the saved results is flagged, and the exit status is non-zero.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import argparse
+import email.utils
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from six.moves.urllib.parse import parse_qs
+
+from tomputils.downloader import AsyncDownloader, Downloader
+
+BLOCK_SIZE = 1024 * 1024
+WRITE_SIZE = 64 * 1024
+UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3}
+LAST_MODIFIED = email.utils.formatdate(0, usegmt=True)
+POLL_INTERVAL = 1.0
+
+SCENARIOS = {
+    "range": "",
+    "norange": "norange=1",
+    "throttled": "rate=4000000",
+    "errors": "error=0.05&drop=0.05",
+}
+
+
+def _block():
+    """The data every file is made of, repeated."""
+    return b"".join(
+        hashlib.sha256(str(i).encode()).digest() for i in range(BLOCK_SIZE // 32)
+    )
+
+
+def _parse_size(text):
+    text = text.strip().upper()
+    if text and text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def _format_size(size):
+    for unit in "GMK":
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return "{}{}".format(size // UNITS[unit], unit)
+    return str(size)
+
+
+def _md5(size):
+    """md5 of a synthetic file, for checking downloads."""
+    block = _block()
+    digest = hashlib.md5()
+    for _ in range(size // BLOCK_SIZE):
+        digest.update(block)
+    digest.update(block[: size % BLOCK_SIZE])
+    return digest.hexdigest()
+
+
+class BenchHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    data = None
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _serve(self, body):
+        path, _, query = self.path.partition("?")
+        params = dict((k, v[0]) for k, v in parse_qs(query).items())
+        try:
+            size = _parse_size(path.rsplit("/", 1)[-1])
+        except ValueError:
+            self.send_error(404)
+            return
+        ranges = "norange" not in params
+        rate = float(params.get("rate", 0))
+
+        if body and random.random() < float(params.get("error", 0)):
+            self.send_error(503)
+            return
+
+        start, end = 0, size - 1
+        status = 200
+        requested = self.headers.get("Range")
+        if ranges and requested and requested.startswith("bytes="):
+            first, _, last = requested[6:].partition("-")
+            if first:
+                start = int(first)
+                if last:
+                    end = min(int(last), size - 1)
+            else:
+                start = max(0, size - int(last))
+            if start > end:
+                self.send_error(416)
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Last-Modified", LAST_MODIFIED)
+        if ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+        self.end_headers()
+        if not body:
+            return
+
+        drop_at = None
+        # An empty body has nothing to drop part way through.
+        if end >= start and random.random() < float(params.get("drop", 0)):
+            drop_at = random.randint(start, end)
+
+        began = time.time()
+        sent = 0
+        position = start
+        while position <= end:
+            offset = position % BLOCK_SIZE
+            length = min(WRITE_SIZE, end - position + 1)
+            if drop_at is not None and position + length > drop_at:
+                self.close_connection = True
+                return
+            stop = offset + length
+            try:
+                self.wfile.write(self.data[offset:stop])
+            except ConnectionError:
+                # The client gave up, or was stopped for taking too long.
+                return
+            position += length
+            sent += length
+            if rate:
+                ahead = sent / rate - (time.time() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+def _serve(ready):
+    BenchHandler.data = memoryview(_block() * 2)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BenchHandler)
+    server.daemon_threads = True
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_server():
+    """
+    Start the benchmark server in a child process.
+
+    Returns
+    -------
+    (multiprocessing.Process, int)
+        the server process and the port it listens on.
+
+    """
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(ready,))
+    process.daemon = True
+    process.start()
+    return process, ready.get(timeout=30)
+
+
+def _fetch_all(url, output, repeat, max_con, min_seg_size, use_async, checksum):
+    kwargs = dict(max_con=max_con, min_seg_size=min_seg_size, resume=False)
+    latencies = []
+    errors = 0
+    if use_async:
+        import asyncio
+
+        async def run():
+            nonlocal errors
+            async with AsyncDownloader(**kwargs) as dl:
+                for _ in range(repeat):
+                    began = time.time()
+                    try:
+                        await dl.fetch(url, output, checksum)
+                    except RuntimeError:
+                        errors += 1
+                    latencies.append(time.time() - began)
+
+        asyncio.run(run())
+    else:
+        with Downloader(**kwargs) as dl:
+            for _ in range(repeat):
+                began = time.time()
+                try:
+                    dl.fetch(url, output, checksum)
+                except RuntimeError:
+                    errors += 1
+                latencies.append(time.time() - began)
+    return latencies, errors
+
+
+def _measure(results, url, size, repeat, max_con, min_seg_size, use_async, verify):
+    workdir = tempfile.mkdtemp(prefix="bench_downloader")
+    output = os.path.join(workdir, "data")
+    checksum = "md5:" + _md5(size) if verify else None
+    try:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        began = time.time()
+        latencies, errors = _fetch_all(
+            url, output, repeat, max_con, min_seg_size, use_async, checksum
+        )
+        wall = time.time() - began
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        if os.path.getsize(output) != size:
+            errors += 1
+    finally:
+        shutil.rmtree(workdir)
+
+    cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+    rss = after.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    results.put(
+        {
+            "latencies": latencies,
+            "errors": errors,
+            "wall": wall,
+            "cpu": cpu,
+            "rss": rss,
+        }
+    )
+
+
+def collect(process, results, timeout):
+    """
+    Wait for the measurements of a process, without hanging if it dies.
+
+    Parameters
+    ----------
+    process : multiprocessing.Process
+        the measuring process, started.
+    results : multiprocessing.Queue
+        where it puts its measurements.
+    timeout : float
+        seconds it may take before it is stopped.
+
+    Returns
+    -------
+    dict
+        the measurements.
+
+    Raises
+    ------
+    RuntimeError
+        if the process exits without measurements or takes too long.
+
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            measured = results.get(timeout=POLL_INTERVAL)
+            break
+        except queue.Empty:
+            pass
+        if not process.is_alive():
+            # It may have put its results just before exiting.
+            try:
+                measured = results.get(timeout=POLL_INTERVAL)
+                break
+            except queue.Empty:
+                raise RuntimeError(
+                    "measuring process exited with status %s" % process.exitcode
+                )
+        if time.time() > deadline:
+            process.terminate()
+            process.join()
+            raise RuntimeError("timed out after %d seconds" % timeout)
+    process.join()
+    return measured
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def run_case(port, scenario, size, max_con, min_seg_size, args):
+    """
+    Measure one configuration in a fresh process.
+
+    Raises
+    ------
+    RuntimeError
+        if the process fails or takes longer than args.timeout.
+
+    Returns
+    -------
+    dict
+        the configuration and its measurements.
+
+    """
+    url = "http://127.0.0.1:%d/data/%s" % (port, _format_size(size))
+    if SCENARIOS[scenario]:
+        url += "?" + SCENARIOS[scenario]
+
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_measure,
+        args=(
+            results,
+            url,
+            size,
+            args.repeat,
+            max_con,
+            min_seg_size,
+            args.use_async,
+            args.verify,
+        ),
+    )
+    process.start()
+    measured = collect(process, results, args.timeout)
+
+    retrieved = size * args.repeat
+    latencies = measured["latencies"]
+    # Rates mean nothing for empty files.
+    mb_per_s = cpu_per_gb = float("nan")
+    if retrieved:
+        mb_per_s = retrieved / measured["wall"] / UNITS["M"]
+        cpu_per_gb = measured["cpu"] / (retrieved / UNITS["G"])
+    return {
+        "scenario": scenario,
+        "size": size,
+        "max_con": max_con,
+        "min_seg_size": min_seg_size,
+        "mb_per_s": mb_per_s,
+        "cpu_per_gb": cpu_per_gb,
+        "rss_mb": measured["rss"] / UNITS["M"],
+        "p50": _percentile(latencies, 0.50),
+        "p95": _percentile(latencies, 0.95),
+        "p99": _percentile(latencies, 0.99),
+        "errors": measured["errors"],
+    }
+
+
+def _key(result):
+    return "{scenario}/{size}/{max_con}/{min_seg_size}".format(**result)
+
+
+HEADER = "{:<10} {:>6} {:>4} {:>6} {:>9} {:>9} {:>8} {:>8} {:>8} {:>8} {:>4}".format(
+    "scenario",
+    "size",
+    "con",
+    "minseg",
+    "MB/s",
+    "CPU s/GB",
+    "RSS MB",
+    "p50 s",
+    "p95 s",
+    "p99 s",
+    "err",
+)
+
+
+def _report(result, baseline=None):
+    line = (
+        "{:<10} {:>6} {:>4} {:>6} {:>9.1f} {:>9.2f} {:>8.1f} "
+        "{:>8.3f} {:>8.3f} {:>8.3f} {:>4}".format(
+            result["scenario"],
+            _format_size(result["size"]),
+            result["max_con"],
+            _format_size(result["min_seg_size"]),
+            result["mb_per_s"],
+            result["cpu_per_gb"],
+            result["rss_mb"],
+            result["p50"],
+            result["p95"],
+            result["p99"],
+            result["errors"],
+        )
+    )
+    if baseline is not None:
+        line += "  ({:+.0%} MB/s, {:+.0%} CPU)".format(
+            result["mb_per_s"] / baseline["mb_per_s"] - 1,
+            result["cpu_per_gb"] / baseline["cpu_per_gb"] - 1,
+        )
+    print(line)
+
+
+def _regressed(result, baseline, tolerance):
+    return result["mb_per_s"] < baseline["mb_per_s"] * (1 - tolerance) or result[
+        "cpu_per_gb"
+    ] > baseline["cpu_per_gb"] * (1 + tolerance)
+
+
+def _size_list(text):
+    return [_parse_size(s) for s in text.split(",")]
+
+
+def _arg_parse():
+    parser = argparse.ArgumentParser(description="Downloader benchmarks.")
+    parser.add_argument(
+        "-s", "--sizes", help="file sizes", type=_size_list, default="1M,16M,128M"
+    )
+    parser.add_argument(
+        "-c",
+        "--max-con",
+        help="values of max_con",
+        type=lambda s: [int(c) for c in s.split(",")],
+        default="1,4,8",
+    )
+    parser.add_argument(
+        "-m",
+        "--min-seg-size",
+        help="values of min_seg_size",
+        type=_size_list,
+        default="16K,1M",
+    )
+    parser.add_argument(
+        "-S",
+        "--scenarios",
+        help="server behaviours, from {}".format(", ".join(SCENARIOS)),
+        type=lambda s: s.split(","),
+        default="range,norange",
+    )
+    parser.add_argument(
+        "-r", "--repeat", help="fetches per configuration", type=int, default=10
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        help="benchmark AsyncDownloader",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--verify", help="check each download with an md5", action="store_true"
+    )
+    parser.add_argument("--save", help="write results to a JSON file")
+    parser.add_argument("--compare", help="compare with results saved earlier")
+    parser.add_argument(
+        "--tolerance",
+        help="fraction worse than the saved results that is flagged",
+        type=float,
+        default=0.1,
+    )
+    parser.add_argument(
+        "--timeout",
+        help="seconds a configuration may take before it is abandoned",
+        type=float,
+        default=600,
+    )
+    args = parser.parse_args()
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("unknown scenario {}".format(scenario))
+    return args
+
+
+def main():
+    args = _arg_parse()
+    baselines = {}
+    if args.compare:
+        with open(args.compare) as saved:
+            baselines = dict((_key(r), r) for r in json.load(saved))
+
+    server, port = start_server()
+    results = []
+    regressions = []
+    failures = []
+    print(HEADER)
+    try:
+        for scenario in args.scenarios:
+            for size in args.sizes:
+                for max_con in args.max_con:
+                    for min_seg_size in args.min_seg_size:
+                        try:
+                            result = run_case(
+                                port, scenario, size, max_con, min_seg_size, args
+                            )
+                        except RuntimeError as e:
+                            key = "{}/{}/{}/{}".format(
+                                scenario,
+                                _format_size(size),
+                                max_con,
+                                _format_size(min_seg_size),
+                            )
+                            print("{} failed: {}".format(key, e))
+                            failures.append(key)
+                            continue
+                        baseline = baselines.get(_key(result))
+                        _report(result, baseline)
+                        results.append(result)
+                        if baseline and _regressed(result, baseline, args.tolerance):
+                            regressions.append(_key(result))
+    finally:
+        server.terminate()
+
+    if args.save:
+        with open(args.save, "w") as saved:
+            json.dump(results, saved, indent=1)
+    if regressions:
+        print("Regressed: {}".format(", ".join(regressions)))
+    if failures:
+        print("Failed: {}".format(", ".join(failures)))
+    if regressions or failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark many small files over HTTP/1.1 and multiplexed HTTP/2.
+
+nghttpd serves a directory of small files in cleartext HTTP/2 (h2c), and
+nghttpx in front of it answers both HTTP/1.1 and h2c on one port, so both
+protocols see the same server. Both come with nghttp2 and must be on the
+PATH.
+
+Each protocol is measured in a fresh process, which retrieves every file
+with one fetch_many, --repeat times. The report gives files per second, the
+connections opened and CPU seconds per thousand files.
+
+    python benchmarks/bench_http2.py [-n FILES] [-s SIZE] [-c MAX_CON]
+        [-r REPEAT] [--async] [--timeout SECONDS]
+
+A protocol whose process fails or runs past --timeout is reported as
+failed, and the exit status is non-zero.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from tomputils.downloader import AsyncDownloader, Downloader
+
+from bench_downloader import collect
+
+PROTOCOLS = {"http/1.1": False, "h2c": "prior-knowledge"}
+UNITS = {"K": 1024, "M": 1024**2}
+
+
+def _parse_size(text):
+    text = text.strip().upper()
+    if text and text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _wait_for(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.5).close()
+            return
+        except (IOError, OSError):
+            time.sleep(0.05)
+    raise RuntimeError("Server on port {} did not start.".format(port))
+
+
+def start_servers(htdocs):
+    """
+    Start nghttpd serving a directory and nghttpx in front of it.
+
+    Returns
+    -------
+    (list of subprocess.Popen, int)
+        the server processes and the port nghttpx listens on.
+
+    """
+    for program in ("nghttpd", "nghttpx"):
+        if shutil.which(program) is None:
+            sys.exit("{} from nghttp2 is needed for this benchmark.".format(program))
+
+    origin = _free_port()
+    nghttpd = subprocess.Popen(
+        ["nghttpd", "--no-tls", "-d", htdocs, str(origin)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    _wait_for(origin)
+
+    port = _free_port()
+    nghttpx = subprocess.Popen(
+        [
+            "nghttpx",
+            "--frontend=127.0.0.1,{};no-tls".format(port),
+            "--backend=127.0.0.1,{};;proto=h2".format(origin),
+            "--workers=1",
+            "--accesslog-file=/dev/null",
+            "--errorlog-file=/dev/null",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    _wait_for(port)
+    return [nghttpx, nghttpd], port
+
+
+def _fetch_all(urls, outputs, repeat, max_con, http2, use_async):
+    kwargs = dict(max_con=max_con, resume=False, http2=http2)
+    results = []
+    if use_async:
+        import asyncio
+
+        async def run():
+            async with AsyncDownloader(**kwargs) as dl:
+                for _ in range(repeat):
+                    results.extend(await dl.retrieve_many(urls, outputs))
+
+        asyncio.run(run())
+    else:
+        with Downloader(**kwargs) as dl:
+            for _ in range(repeat):
+                results.extend(dl.retrieve_many(urls, outputs))
+    return results
+
+
+def _measure(results, urls, repeat, max_con, http2, use_async):
+    workdir = tempfile.mkdtemp(prefix="bench_http2")
+    outputs = [os.path.join(workdir, str(i)) for i in range(len(urls))]
+    try:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        began = time.time()
+        fetched = _fetch_all(urls, outputs, repeat, max_con, http2, use_async)
+        wall = time.time() - began
+        after = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        shutil.rmtree(workdir)
+
+    cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+    results.put(
+        {
+            "wall": wall,
+            "cpu": cpu,
+            "errors": sum(1 for r in fetched if not r.ok),
+            "connections": sum(m.connections for r in fetched for m in r.requests),
+        }
+    )
+
+
+def run_case(port, protocol, names, args):
+    """
+    Measure one protocol in a fresh process.
+
+    Raises
+    ------
+    RuntimeError
+        if the process fails or takes longer than args.timeout.
+
+    Returns
+    -------
+    dict
+        the protocol and its measurements.
+
+    """
+    urls = ["http://127.0.0.1:{}/{}".format(port, name) for name in names]
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_measure,
+        args=(
+            results,
+            urls,
+            args.repeat,
+            args.max_con,
+            PROTOCOLS[protocol],
+            args.use_async,
+        ),
+    )
+    process.start()
+    measured = collect(process, results, args.timeout)
+
+    files = len(urls) * args.repeat
+    return {
+        "protocol": protocol,
+        "files_per_s": files / measured["wall"],
+        "connections": measured["connections"],
+        "cpu_per_1000": measured["cpu"] / files * 1000,
+        "errors": measured["errors"],
+    }
+
+
+HEADER = "{:<10} {:>9} {:>12} {:>16} {:>6}".format(
+    "protocol", "files/s", "connections", "CPU s/1000 files", "err"
+)
+
+
+def _report(result, baseline=None):
+    line = "{:<10} {:>9.0f} {:>12} {:>16.3f} {:>6}".format(
+        result["protocol"],
+        result["files_per_s"],
+        result["connections"],
+        result["cpu_per_1000"],
+        result["errors"],
+    )
+    if baseline is not None:
+        line += "  ({:.1f}x files/s)".format(
+            result["files_per_s"] / baseline["files_per_s"]
+        )
+    print(line)
+
+
+def _arg_parse():
+    parser = argparse.ArgumentParser(description="HTTP/2 downloader benchmark.")
+    parser.add_argument("-n", "--files", help="files per batch", type=int, default=1000)
+    parser.add_argument("-s", "--size", help="size of each file", default="4K")
+    parser.add_argument(
+        "-c", "--max-con", help="max_con of the downloader", type=int, default=4
+    )
+    parser.add_argument(
+        "-r", "--repeat", help="batches per protocol", type=int, default=3
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        help="benchmark AsyncDownloader",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--timeout",
+        help="seconds a protocol may take before it is abandoned",
+        type=float,
+        default=600,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = _arg_parse()
+    size = _parse_size(args.size)
+    htdocs = tempfile.mkdtemp(prefix="bench_http2_htdocs")
+    names = []
+    for i in range(args.files):
+        name = "file{}".format(i)
+        with open(os.path.join(htdocs, name), "wb") as f:
+            f.write(os.urandom(size))
+        names.append(name)
+
+    servers, port = start_servers(htdocs)
+    failures = []
+    print(HEADER)
+    try:
+        baseline = None
+        for protocol in PROTOCOLS:
+            try:
+                result = run_case(port, protocol, names, args)
+            except RuntimeError as e:
+                print("{} failed: {}".format(protocol, e))
+                failures.append(protocol)
+                continue
+            _report(result, baseline)
+            baseline = baseline or result
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(htdocs)
+
+    if failures:
+        print("Failed: {}".format(", ".join(failures)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks for the token buckets in tomputils.downloader.limit.
+
+Each benchmark reports calls per second. Buckets are sized so that consume
+always succeeds, which measures the bookkeeping cost rather than waiting.
+
+    python benchmarks/bench_limit.py [-n CALLS] [-t THREADS] [-p PROCESSES]
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import argparse
+import asyncio
+import multiprocessing
+import threading
+import time
+
+from tomputils.downloader.limit import (
+    AsyncTokenBucket,
+    SharedTokenBucket,
+    Throttle,
+    TokenBucket,
+)
+
+HUGE = 1e18
+
+
+def _arg_parse():
+    parser = argparse.ArgumentParser(description="Token bucket micro-benchmarks.")
+    parser.add_argument(
+        "-n", "--calls", help="calls per benchmark", type=int, default=1000000
+    )
+    parser.add_argument(
+        "-t", "--threads", help="threads for contention test", type=int, default=4
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        help="processes for shared memory test",
+        type=int,
+        default=4,
+    )
+    return parser.parse_args()
+
+
+def _report(name, calls, elapsed):
+    print("{:<40} {:>12,.0f} calls/s".format(name, calls / elapsed))
+
+
+def bench_consume(bucket, calls):
+    consume = bucket.consume
+    start = time.perf_counter()
+    for _ in range(calls):
+        consume(1)
+    return time.perf_counter() - start
+
+
+def bench_threads(bucket, calls, threads):
+    per_thread = calls // threads
+    workers = [
+        threading.Thread(target=bench_consume, args=(bucket, per_thread))
+        for _ in range(threads)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+
+def bench_async(bucket, calls):
+    async def run():
+        acquire = bucket.acquire
+        for _ in range(calls):
+            await acquire(1)
+
+    start = time.perf_counter()
+    asyncio.run(run())
+    return time.perf_counter() - start
+
+
+def bench_processes(bucket, calls, processes):
+    per_process = calls // processes
+    workers = [
+        multiprocessing.Process(target=bench_consume, args=(bucket, per_process))
+        for _ in range(processes)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+
+def bench_throttle(throttle, calls):
+    request = throttle.request
+    start = time.perf_counter()
+    for _ in range(calls):
+        request("example.com", 16384)
+    return time.perf_counter() - start
+
+
+def main():
+    args = _arg_parse()
+    n = args.calls
+
+    _report("TokenBucket.consume", n, bench_consume(TokenBucket(HUGE, HUGE), n))
+    _report(
+        "TokenBucket.consume, {} threads".format(args.threads),
+        n,
+        bench_threads(TokenBucket(HUGE, HUGE), n, args.threads),
+    )
+    _report(
+        "AsyncTokenBucket.acquire",
+        n,
+        bench_async(AsyncTokenBucket(HUGE, HUGE), n),
+    )
+    _report(
+        "SharedTokenBucket.consume",
+        n,
+        bench_consume(SharedTokenBucket(HUGE, HUGE), n),
+    )
+    _report(
+        "SharedTokenBucket.consume, {} processes".format(args.processes),
+        n,
+        bench_processes(SharedTokenBucket(HUGE, HUGE), n, args.processes),
+    )
+    _report(
+        "Throttle.request, global and per host",
+        n,
+        bench_throttle(Throttle(HUGE, HUGE), n),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -24,13 +24,17 @@ setup(
         "Development Status :: 4 - Beta",
         "Topic :: Software Development :: Libraries",
         "License :: CC0 1.0 Universal (CC0 1.0) Public Domain Dedication",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
     ],
+    python_requires=">=3.7",
     dependency_links=[
         'https://github.com/tparker-usgs/py-single/tarball/py3#egg=single-1.0.0'
     ],
     install_requires=[
         'requests',
-        'future',
         'pika',
         'pycurl',
         'pyOpenSSL',
@@ -38,6 +42,9 @@ setup(
         'svn',
         'ruamel.yaml'
     ],
+    extras_require={
+        'crc32c': ['crc32c'],
+    },
     setup_requires=['pytest-runner'],
     tests_require=['pytest'],
     scripts=['bin/singleTimeout.sh'],
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the metadata cache of tomputils.downloader.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import gzip
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from tomputils.downloader import Downloader
+from tomputils.downloader.cache import MetadataCache
+from tomputils.downloader.downloader import Transfer
+
+BODY = b"plain text\n" * 100
+ETAG = '"v1"'
+FILES = {
+    "/file": (BODY, ETAG),
+    "/f.gz": (gzip.compress(BODY), '"gz1"'),
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_HEAD(self):
+        self._reply(body=False)
+
+    def do_GET(self):
+        self._reply(body=True)
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _reply(self, body):
+        Handler.requests.append((self.command, self.path, dict(self.headers)))
+        if self.path == "/moved":
+            self.send_response(302)
+            self.send_header("Location", "/file")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        data, etag = FILES[self.path]
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+
+@pytest.fixture
+def server():
+    Handler.requests = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield "http://127.0.0.1:%d" % httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _gets(path):
+    return [r for r in Handler.requests if r[0] == "GET" and r[1] == path]
+
+
+def test_update_and_lookup(tmp_path):
+    output = tmp_path / "file"
+    output.write_bytes(BODY)
+    cache = MetadataCache(str(tmp_path / "cache.json"))
+    cache.update("http://host/file", str(output), len(BODY), ETAG)
+    cache.save()
+
+    cache = MetadataCache(str(tmp_path / "cache.json"))
+    assert cache.lookup("http://host/file")["etag"] == ETAG
+    assert cache.matches("http://host/file", str(output), len(BODY), ETAG)
+    assert not cache.matches("http://host/file", str(output), len(BODY), '"v2"')
+    assert cache.conditional_headers("http://host/file") == [
+        "If-None-Match: {}".format(ETAG)
+    ]
+
+
+def test_lookup_needs_the_file(tmp_path):
+    cache = MetadataCache(str(tmp_path / "cache.json"))
+    cache.update("http://host/file", str(tmp_path / "file"), len(BODY), ETAG)
+    assert cache.lookup("http://host/file") is None
+    assert cache.conditional_headers("http://host/file") == []
+
+
+def test_redirected_file_is_not_fetched_again(server, tmp_path):
+    output = str(tmp_path / "file")
+    cache = str(tmp_path / "cache.json")
+    for _ in range(2):
+        with Downloader(cache=cache, progress=[]) as downloader:
+            result = downloader.retrieve(server + "/moved", output)
+        assert result.ok
+    assert len(_gets("/file")) == 1
+    probes = [r for r in Handler.requests if r[0] == "HEAD" and r[1] == "/moved"]
+    assert probes[-1][2].get("If-None-Match") == ETAG
+    assert result.skipped
+
+
+def test_decompressed_file_is_not_fetched_again(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache = str(tmp_path / "cache.json")
+    for _ in range(2):
+        with Downloader(cache=cache, decompress=True, progress=[]) as downloader:
+            result = downloader.retrieve(server + "/f.gz")
+        assert result.ok
+        assert result.output == "f"
+    assert result.skipped
+    assert len(_gets("/f.gz")) == 1
+    with open("f", "rb") as f:
+        assert f.read() == BODY
+
+
+def test_compressed_copy_does_not_stand_in(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache = str(tmp_path / "cache.json")
+    with Downloader(cache=cache, progress=[]) as downloader:
+        assert downloader.retrieve(server + "/f.gz").output == "f.gz"
+    with Downloader(cache=cache, decompress=True, progress=[]) as downloader:
+        result = downloader.retrieve(server + "/f.gz")
+    assert not result.skipped
+    with open(result.output, "rb") as f:
+        assert f.read() == BODY
+
+
+def test_not_modified_without_an_entry_fails(tmp_path):
+    # The cached copy may go between the probe and its answer.
+    cache = MetadataCache(str(tmp_path / "cache.json"))
+    transfer = Transfer("http://host/file", str(tmp_path / "file"), cache=cache)
+    probe = ("http://host/file", 0, False, {})
+    with Downloader(progress=[]) as downloader:
+        with pytest.raises(RuntimeError):
+            downloader._apply_probes(transfer, [(304, None, probe)])
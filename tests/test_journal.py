@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the resume journal of tomputils.downloader.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import os
+
+from tomputils.downloader.journal import SegmentJournal
+
+
+def _journal(tmp_path, *ranges):
+    journal = SegmentJournal(str(tmp_path / "file"), "http://host/file", 100, '"v1"')
+    for start, end in ranges:
+        journal.record(start, end)
+    return journal
+
+
+def test_record_merges_adjacent_and_overlapping_ranges(tmp_path):
+    journal = _journal(tmp_path, (20, 29), (0, 9), (10, 14), (25, 39), (60, 69))
+    assert journal.completed == [[0, 14], [20, 39], [60, 69]]
+    assert journal.completed_bytes == 15 + 20 + 10
+
+
+def test_record_ignores_empty_ranges(tmp_path):
+    journal = _journal(tmp_path, (10, 9))
+    assert journal.completed == []
+
+
+def test_missing(tmp_path):
+    journal = _journal(tmp_path, (10, 19), (30, 39))
+    assert journal.missing(0, 99) == [[0, 9], [20, 29], [40, 99]]
+    assert journal.missing(10, 19) == []
+    assert journal.missing(15, 34) == [[20, 29]]
+    assert journal.missing(50, 59) == [[50, 59]]
+    assert _journal(tmp_path).missing(0, 99) == [[0, 99]]
+
+
+def test_save_and_load(tmp_path):
+    journal = _journal(tmp_path, (0, 9), (50, 59))
+    journal.save()
+    loaded = SegmentJournal.load(str(tmp_path / "file"))
+    assert loaded.completed == [[0, 9], [50, 59]]
+    assert loaded.matches(100, '"v1"')
+    assert not loaded.matches(100, '"v2"')
+    assert not loaded.matches(101, '"v1"')
+
+    loaded.remove()
+    assert not os.path.exists(journal.path)
+    assert SegmentJournal.load(str(tmp_path / "file")) is None
+
+
+def test_matches_needs_a_validator(tmp_path):
+    journal = SegmentJournal(str(tmp_path / "file"), "http://host/file", 100)
+    assert not journal.matches(100)
+
+
+def test_unreadable_journal_is_ignored(tmp_path):
+    with open(str(tmp_path / "file.journal"), "w") as f:
+        f.write("{not json")
+    assert SegmentJournal.load(str(tmp_path / "file")) is None
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for reading what a file is from the headers of its first response.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import pytest
+
+from tomputils.downloader.downloader import _response_probe
+
+URL = "http://host/dir/file"
+
+
+def _raw(*responses):
+    return "".join("\r\n".join(lines) + "\r\n\r\n" for lines in responses)
+
+
+def test_partial_content_gives_the_total():
+    raw = _raw(
+        ["HTTP/1.1 206 Partial Content", "Content-Range: bytes 0-99/5000", 'ETag: "1"']
+    )
+    status, (eurl, size, can_segment, headers) = _response_probe(URL, raw)
+    assert (status, eurl, size, can_segment) == (206, URL, 5000, True)
+    assert headers["etag"] == '"1"'
+
+
+def test_unknown_total():
+    raw = _raw(["HTTP/1.1 206 Partial Content", "Content-Range: bytes 0-99/*"])
+    assert _response_probe(URL, raw)[1][1:3] == (-1, False)
+    raw = _raw(["HTTP/1.1 200 OK", "Accept-Ranges: bytes"])
+    assert _response_probe(URL, raw)[1][1:3] == (-1, False)
+
+
+@pytest.mark.parametrize(
+    "accept_ranges, can_segment", [("bytes", True), ("none", False), (None, False)]
+)
+def test_whole_file(accept_ranges, can_segment):
+    lines = ["HTTP/1.1 200 OK", "Content-Length: 1234"]
+    if accept_ranges is not None:
+        lines.append("Accept-Ranges: " + accept_ranges)
+    status, probe = _response_probe(URL, _raw(lines))
+    assert status == 200
+    assert probe[:3] == (URL, 1234, can_segment)
+
+
+def test_redirects_give_the_effective_url():
+    raw = _raw(
+        ["HTTP/1.1 301 Moved Permanently", "Location: /other/file", "ETag: old"],
+        ["HTTP/1.1 302 Found", "Location: ../mirror/file"],
+        ["HTTP/1.1 206 Partial Content", "Content-Range: bytes 0-9/10"],
+    )
+    status, (eurl, size, can_segment, headers) = _response_probe(URL, raw)
+    assert eurl == "http://host/mirror/file"
+    assert (status, size, can_segment) == (206, 10, True)
+    assert "etag" not in headers
+
+
+def test_empty_file_cannot_satisfy_a_range():
+    raw = _raw(["HTTP/1.1 416 Range Not Satisfiable", "Content-Range: bytes */0"])
+    assert _response_probe(URL, raw) == (
+        416,
+        (URL, 0, False, {"content-range": "bytes */0"}),
+    )
+    raw = _raw(["HTTP/1.1 416 Range Not Satisfiable"])
+    assert _response_probe(URL, raw)[1][1] == 0
+
+
+@pytest.mark.parametrize(
+    "lines",
+    [
+        ["HTTP/1.1 404 Not Found"],
+        ["HTTP/1.1 416 Range Not Satisfiable", "Content-Range: bytes */100"],
+        ["HTTP/1.1 500 Internal Server Error"],
+        ["garbage"],
+    ],
+)
+def test_failures_raise(lines):
+    with pytest.raises(RuntimeError):
+        _response_probe(URL, _raw(lines))
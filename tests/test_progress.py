@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for progress reporting in tomputils.downloader.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import io
+import json
+import logging
+import math
+
+import pytest
+
+from tomputils.downloader import progress as progress_module
+from tomputils.downloader.progress import (
+    RATE_WINDOW,
+    JsonProgress,
+    LogProgress,
+    Progress,
+    ProgressReporter,
+    ProgressSink,
+    _bytes,
+    _describe,
+    _duration,
+)
+
+
+class FakeTransfer(object):
+    def __init__(self, size, downloaded=0):
+        self.size = size
+        self.downloaded = downloaded
+        self.finished = False
+
+
+class Clock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class Recorder(ProgressSink):
+    def __init__(self):
+        self.samples = []
+
+    def update(self, progress):
+        self.samples.append(progress)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(1000.0)
+    monkeypatch.setattr(progress_module.time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def recorder():
+    return Recorder()
+
+
+@pytest.fixture
+def reporter(recorder):
+    # Sample only when asked to.
+    reporter = ProgressReporter([recorder], updates=1e-6)
+    yield reporter
+    reporter.remove(list(reporter._transfers))
+
+
+def test_percent_and_eta():
+    progress = Progress(10.0, 250, 1000, 1, 0, 40.0, 50.0)
+    assert progress.percent == 25.0
+    assert progress.eta == 15.0
+    assert Progress(1.0, 250, None, 1, 0, 40.0, 50.0).percent is None
+    assert Progress(1.0, 250, None, 1, 0, 40.0, 50.0).eta is None
+    assert Progress(1.0, 0, 1000, 1, 0, 0.0, 0.0).eta is None
+    assert Progress(1.0, 0, 0, 1, 0, 0.0, 0.0).percent == 100.0
+    assert Progress(1.0, 1200, 1000, 1, 0, 0.0, 50.0).percent == 100.0
+    assert Progress(1.0, 1200, 1000, 1, 0, 0.0, 50.0).eta == 0.0
+    assert Progress(1.0, 500, 1000, 1, 1, 0.0, 50.0, done=True).eta == 0.0
+
+
+def test_as_dict():
+    progress = Progress(1.23456, 1, 3, 2, 1, 1.26, 2.0 / 3)
+    assert progress.as_dict() == {
+        "elapsed": 1.235,
+        "downloaded": 1,
+        "size": 3,
+        "percent": 33.33,
+        "files": 2,
+        "finished": 1,
+        "rate": 1.3,
+        "average": 0.7,
+        "eta": 3.0,
+        "done": False,
+    }
+    assert Progress(1.0, 1, None, 1, 0, 0.0, 0.0).as_dict()["eta"] is None
+
+
+def test_formatting():
+    assert _bytes(0) == "0 B"
+    assert _bytes(1023) == "1023 B"
+    assert _bytes(1536) == "1.5 KiB"
+    assert _bytes(5 * 1024**3) == "5.0 GiB"
+    assert _bytes(2048 * 1024**4) == "2048.0 TiB"
+    assert _duration(0) == "0:00:00"
+    assert _duration(3723.9) == "1:02:03"
+
+
+def test_describe():
+    progress = Progress(2.0, 1024, 4096, 3, 1, 512.0, 256.0)
+    assert _describe(progress) == (
+        "D/L 1.0 KiB / 4.0 KiB ( 25.00%) - 512 B/s, avg 256 B/s, ETA 0:00:12"
+        " - 1 of 3 files"
+    )
+    progress = Progress(4.0, 2048, None, 1, 1, 0.0, 0.0, done=True)
+    assert _describe(progress) == "D/L 2.0 KiB in 0:00:04 - 512 B/s"
+
+
+def test_sample_rate_and_average(clock, reporter):
+    transfer = FakeTransfer(10000, downloaded=1000)
+    reporter.add([transfer])
+
+    clock.now += 1
+    transfer.downloaded = 2000
+    progress = reporter.sample()
+    # Resumed bytes are not counted as retrieved in this interval.
+    assert progress.rate == 1000.0
+    assert progress.average == 1000.0
+    assert progress.eta == 8.0
+
+    clock.now += 2
+    transfer.downloaded = 5000
+    progress = reporter.sample()
+    alpha = 1 - math.exp(-2 / RATE_WINDOW)
+    assert progress.rate == 1500.0
+    assert progress.average == pytest.approx(1000.0 + alpha * 500.0)
+    assert progress.eta == pytest.approx(5000 / progress.average)
+    assert progress.elapsed == 3.0
+
+    progress = reporter.sample()
+    assert progress.rate == 1500.0
+
+
+def test_sample_sizes(clock, reporter):
+    known = FakeTransfer(1000)
+    unknown = FakeTransfer(-1)
+    reporter.add([known, unknown])
+    progress = reporter.sample()
+    assert progress.size is None
+    assert (progress.files, progress.finished) == (2, 0)
+
+    unknown.downloaded = 300
+    unknown.finished = True
+    progress = reporter.sample()
+    assert progress.size == 1300
+    assert progress.finished == 1
+
+
+def test_remove_reports_once_settled(clock, recorder, reporter):
+    first, second = FakeTransfer(100), FakeTransfer(200)
+    reporter.add([first, second])
+    first.downloaded = 100
+    reporter.remove([first])
+    assert recorder.samples == []
+
+    clock.now += 1
+    second.downloaded = 200
+    reporter.remove([second])
+    done = recorder.samples[-1]
+    assert done.done
+    assert (done.downloaded, done.size, done.finished) == (300, 300, 2)
+
+
+def test_log_interval(caplog):
+    sink = LogProgress(interval=10)
+    with caplog.at_level(logging.INFO, logger=progress_module.LOG.name):
+        for elapsed in (0, 5, 10, 15, 21):
+            sink.update(Progress(elapsed, 0, None, 1, 0, 0.0, 0.0))
+        sink.update(Progress(22, 0, None, 1, 1, 0.0, 0.0, done=True))
+    assert len(caplog.records) == 4
+    assert caplog.records[-1].getMessage().startswith("D/L 0 B in 0:00:22")
+
+
+def test_json_interval():
+    stream = io.StringIO()
+    sink = JsonProgress(stream, interval=1)
+    for elapsed in (0, 0.5, 1, 1.5, 2.5):
+        sink.update(Progress(elapsed, 0, None, 1, 0, 0.0, 0.0))
+    sink.update(Progress(2.6, 0, None, 1, 1, 0.0, 0.0, done=True))
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [line["elapsed"] for line in lines] == [0, 1, 2.5, 2.6]
+    assert lines[-1]["done"]
+
+
+def test_inactive_sinks_are_left_out():
+    sink = ProgressSink()
+    sink.active = False
+    assert not ProgressReporter([sink]).active
+    with pytest.raises(ValueError):
+        ProgressReporter([], updates=0)
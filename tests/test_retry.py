@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the circuit breaker of tomputils.downloader.retry.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pycurl
+import pytest
+
+from tomputils.downloader import Downloader, RetryPolicy
+
+HOST = "example.com:80"
+BODY = b"x" * 1024
+
+
+def test_missing_files_do_not_trip_the_breaker():
+    policy = RetryPolicy(breaker_threshold=2)
+    for _ in range(5):
+        policy.failure(HOST, status=404)
+    assert policy.blocked_until(HOST) is None
+
+
+def test_server_errors_trip_the_breaker():
+    policy = RetryPolicy(breaker_threshold=2, breaker_cooldown=30)
+    policy.failure(HOST, status=500)
+    assert policy.blocked_until(HOST) is None
+    policy.failure(HOST, status=503)
+    assert policy.blocked_until(HOST) > time.time() + 25
+
+
+def test_connection_errors_trip_the_breaker():
+    policy = RetryPolicy(breaker_threshold=2)
+    policy.failure(HOST, errno=pycurl.E_COULDNT_CONNECT)
+    policy.failure(HOST, errno=pycurl.E_OPERATION_TIMEDOUT)
+    assert policy.blocked_until(HOST) is not None
+
+
+def test_local_errors_do_not_trip_the_breaker():
+    policy = RetryPolicy(breaker_threshold=2)
+    for _ in range(5):
+        policy.failure(HOST, errno=pycurl.E_WRITE_ERROR)
+    assert policy.blocked_until(HOST) is None
+
+
+def test_hold_applies_without_counting():
+    policy = RetryPolicy(breaker_threshold=2)
+    policy.failure(HOST, hold=10, status=429)
+    assert policy.blocked_until(HOST) > time.time() + 5
+    assert policy.hosts[HOST][0] == 0
+
+
+def test_success_resets_the_count():
+    policy = RetryPolicy(breaker_threshold=2)
+    policy.failure(HOST, status=500)
+    policy.success(HOST)
+    policy.failure(HOST, status=500)
+    assert policy.blocked_until(HOST) is None
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self._reply(body=False)
+
+    def do_GET(self):
+        self._reply(body=True)
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _reply(self, body):
+        if not self.path.startswith("/ok"):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+        if body:
+            self.wfile.write(BODY)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield "http://127.0.0.1:%d" % httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_missing_file_does_not_block_the_host(server, tmp_path):
+    policy = RetryPolicy(breaker_threshold=2)
+    with Downloader(retry=policy, probe=False, progress=[]) as downloader:
+        for i in range(3):
+            with pytest.raises(RuntimeError):
+                downloader.fetch(
+                    "%s/missing%d" % (server, i), str(tmp_path / "missing")
+                )
+        began = time.time()
+        output = downloader.fetch(server + "/ok", str(tmp_path / "ok"))
+    assert time.time() - began < 5
+    with open(output, "rb") as f:
+        assert f.read() == BODY
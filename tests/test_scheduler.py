@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for how tomputils.downloader hands segments to connections.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import time
+
+import pytest
+
+from tomputils.downloader import Downloader
+from tomputils.downloader.downloader import Scheduler, Segment, Transfer
+
+SIZE = 10000
+MIN_SEG_SIZE = 100
+
+
+class FakeConnection(object):
+    """A connection part way through a segment, at a steady rate."""
+
+    name = "fake"
+    can_segment = True
+
+    def __init__(self, transfer, segment, rate):
+        self.transfer = transfer
+        self.segment = segment
+        self._rate = rate
+
+    def rate(self, now):
+        return self._rate
+
+
+@pytest.fixture
+def downloader():
+    with Downloader(min_seg_size=MIN_SEG_SIZE, max_con=4, progress=[]) as dl:
+        yield dl
+
+
+def _transfer(tmp_path):
+    transfer = Transfer("http://host/file", str(tmp_path / "file"))
+    transfer.size = SIZE
+    transfer.can_segment = True
+    transfer.unassigned = [[0, SIZE - 1]]
+    transfer.sources[0].host = "host"
+    return transfer
+
+
+def _working(transfer, downloaded, rate):
+    segment = transfer.new_segment(0, SIZE - 1)
+    segment.downloaded = downloaded
+    return FakeConnection(transfer, segment, rate)
+
+
+def test_next_segment_carves_in_order(tmp_path):
+    transfer = _transfer(tmp_path)
+    first = transfer.next_segment(3000)
+    second = transfer.next_segment(3000)
+    assert (first.start, first.end) == (0, 2999)
+    assert (second.start, second.end) == (3000, 5999)
+    assert transfer.unassigned == [[6000, SIZE - 1]]
+    assert transfer.next_segment(SIZE).end == SIZE - 1
+    assert not transfer.unassigned
+
+
+def test_next_segment_waits_for_retries(tmp_path):
+    transfer = _transfer(tmp_path)
+    due = Segment(7, 500, 999)
+    later = Segment(8, 1000, 1499)
+    later.not_before = time.time() + 60
+    transfer.queued = [later, due]
+    assert transfer.next_segment(3000) is due
+    assert transfer.next_segment(3000).start == 0
+    assert transfer.queued == [later]
+
+
+def test_requeue_puts_a_settled_transfer_back(downloader, tmp_path):
+    scheduler = Scheduler(downloader, None)
+    transfer = _transfer(tmp_path)
+    transfer.unassigned = []
+    scheduler.add(transfer)
+    assert scheduler._next_work() is None
+    assert transfer not in scheduler.waiting
+
+    segment = Segment(0, 0, SIZE - 1)
+    scheduler._requeue(transfer, segment)
+    assert scheduler.waiting == [transfer]
+    assert scheduler._next_work()[1] is segment
+
+
+def test_steal_splits_by_rate(downloader, tmp_path):
+    scheduler = Scheduler(downloader, None)
+    transfer = _transfer(tmp_path)
+    transfer.unassigned = []
+    victim = _working(transfer, 1000, 1000.0)
+    scheduler.working = [victim]
+
+    work = downloader._steal(scheduler)
+    assert work is not None
+    stolen = work[1]
+    # An untried source is expected to match the victim, so it takes half.
+    assert victim.segment.end == 5499
+    assert (stolen.start, stolen.end) == (5500, SIZE - 1)
+
+
+def test_steal_gives_a_faster_source_more(downloader, tmp_path):
+    scheduler = Scheduler(downloader, None)
+    transfer = _transfer(tmp_path)
+    transfer.sources[0].rate = 3000.0
+    victim = _working(transfer, 1000, 1000.0)
+    scheduler.working = [victim]
+
+    stolen = downloader._steal(scheduler)[1]
+    assert victim.segment.end == 3249
+    assert stolen.start == 3250
+
+
+def test_steal_leaves_segments_about_to_finish(downloader, tmp_path):
+    scheduler = Scheduler(downloader, None)
+    transfer = _transfer(tmp_path)
+    scheduler.working = [_working(transfer, 1000, 1e6)]
+    assert downloader._steal(scheduler) is None
+
+    scheduler.working = [_working(transfer, SIZE - MIN_SEG_SIZE, 1.0)]
+    assert downloader._steal(scheduler) is None
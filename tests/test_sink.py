@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the in-memory and streaming sinks of tomputils.downloader.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import hashlib
+import io
+
+import pytest
+
+from tomputils.downloader.sink import BufferSink, StreamSink
+from tomputils.downloader.verify import Verifier
+
+DATA = bytes(bytearray(range(256))) * 40
+
+
+def test_stream_reorders_pieces():
+    chunks = []
+    sink = StreamSink(chunks.append, window=len(DATA))
+    sink.verifier = Verifier({"md5": hashlib.md5(DATA).digest()})
+    sink.open(len(DATA))
+    sink.write(6000, DATA[6000:])
+    sink.write(2000, DATA[2000:6000])
+    assert chunks == []
+    assert sink.buffered == len(DATA) - 2000
+
+    sink.write(0, DATA[:2000])
+    assert b"".join(chunks) == DATA
+    assert [len(c) for c in chunks] == [2000, 4000, len(DATA) - 6000]
+    assert sink.pending == {}
+    assert sink.buffered == 0
+    sink.verifier.finish(sink.read, len(DATA))
+
+
+def test_stream_skips_what_was_delivered():
+    out = io.BytesIO()
+    sink = StreamSink(out, window=len(DATA))
+    sink.write(0, DATA[:3000])
+    # Retrieved again from the start, as without ranges.
+    sink.write(0, DATA[:1000])
+    sink.write(0, DATA[:5000])
+    sink.write(5000, DATA[5000:])
+    assert out.getvalue() == DATA
+
+
+def test_stream_window_follows_delivery():
+    sink = StreamSink(lambda data: None, window=1000)
+    assert sink.limit() == 999
+    sink.write(500, DATA[500:900])
+    assert sink.limit() == 999
+    sink.write(0, DATA[:500])
+    assert sink.limit() == 1899
+
+
+def test_stream_manual_release():
+    sink = StreamSink(lambda data: None, window=1000, manual_release=True)
+    sink.write(0, DATA[:800])
+    assert sink.position == 800
+    assert sink.limit() == 999
+    sink.release(300)
+    assert sink.limit() == 1299
+
+
+def test_stream_cannot_be_read_back():
+    sink = StreamSink(lambda data: None, window=1000)
+    with pytest.raises(RuntimeError):
+        sink.read(0, 10)
+    with pytest.raises(TypeError):
+        StreamSink(object(), window=1000)
+
+
+def test_buffer_takes_pieces_in_any_order():
+    buffer = bytearray(b"stale data")
+    sink = BufferSink(buffer)
+    sink.open(len(DATA))
+    assert len(buffer) == len(DATA)
+    for start, end in ((8000, len(DATA)), (0, 3000), (3000, 8000)):
+        sink.write(start, DATA[start:end])
+    assert bytes(buffer) == DATA
+    assert sink.read(100, 50) == DATA[100:150]
+
+
+def test_buffer_grows_when_size_is_unknown():
+    buffer = bytearray(b"stale data")
+    sink = BufferSink(buffer)
+    sink.open(-1)
+    assert buffer == bytearray()
+    sink.write(1000, DATA[1000:2000])
+    sink.write(0, DATA[:1000])
+    assert bytes(buffer) == DATA[:2000]
+
+
+def test_memoryview_must_fit():
+    view = memoryview(bytearray(100))
+    sink = BufferSink(view)
+    with pytest.raises(ValueError):
+        sink.open(101)
+    sink.open(100)
+    sink.write(90, DATA[:10])
+    assert view[90:].tobytes() == DATA[:10]
+    with pytest.raises(ValueError):
+        sink.write(95, DATA[:10])
+    with pytest.raises(ValueError):
+        BufferSink(memoryview(bytes(100))).open(100)
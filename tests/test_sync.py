@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the listing parser and index of tomputils.downloader.sync.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import os
+
+import pytest
+
+from tomputils.downloader.sync import (
+    SYNC_INDEX,
+    ListingParser,
+    SyncPlan,
+    _directory_url,
+    _listing_entry,
+)
+
+BASE = "http://host/data/"
+
+APACHE = """<html><body><h1>Index of /data</h1><table>
+<tr><th><a href="?C=N;O=D">Name</a></th><th>Last modified</th><th>Size</th></tr>
+<tr><td><a href="/">Parent Directory</a></td><td>&nbsp;</td><td>-</td></tr>
+<tr><td><a href="a.txt"><img src="/icons/text.gif"></a></td>
+<td><a href="a.txt">a.txt</a></td>
+<td align="right">2024-01-02 03:04  </td><td align="right"> 12K</td></tr>
+<tr><td><a href="sub/">sub/</a></td><td>2024-01-03 00:00  </td><td>  - </td></tr>
+<tr><td><a href="caf%C3%A9.dat">café.dat</a></td><td>2024-01-04 00:00  </td>
+<td>1.0M</td></tr>
+</table></body></html>
+"""
+
+NGINX = """<html><body><h1>Index of /data/</h1><hr><pre><a href="../">../</a>
+<a href="a.txt">a.txt</a>                 02-Jan-2024 03:04     12288
+<a href="sub/">sub/</a>                  03-Jan-2024 00:00         -
+</pre><hr></body></html>
+"""
+
+
+def _parse(listing, chunk):
+    parser = ListingParser(BASE)
+    data = listing.encode("utf-8")
+    entries = []
+    for start in range(0, len(data), chunk):
+        entries += parser.parse(data[start : start + chunk])  # noqa: E203
+    return entries + parser.parse(b"", final=True)
+
+
+@pytest.mark.parametrize("chunk", [1, 7, 100000])
+def test_apache_listing(chunk):
+    entries = _parse(APACHE, chunk)
+    assert [(e.name, e.is_dir, e.stamp) for e in entries] == [
+        ("a.txt", False, "2024-01-02 03:04 12K"),
+        ("sub", True, "2024-01-03 00:00 -"),
+        ("café.dat", False, "2024-01-04 00:00 1.0M"),
+    ]
+    assert entries[1].url == BASE + "sub/"
+    assert entries[2].url == BASE + "caf%C3%A9.dat"
+
+
+@pytest.mark.parametrize("chunk", [1, 100000])
+def test_nginx_listing(chunk):
+    entries = _parse(NGINX, chunk)
+    assert [(e.name, e.is_dir, e.stamp) for e in entries] == [
+        ("a.txt", False, "02-Jan-2024 03:04 12288"),
+        ("sub", True, "03-Jan-2024 00:00 -"),
+    ]
+
+
+@pytest.mark.parametrize(
+    "href",
+    [
+        None,
+        "",
+        "?C=M;O=A",
+        "#top",
+        "../",
+        "./",
+        "/",
+        "/other/a.txt",
+        "http://elsewhere/data/a.txt",
+        "https://host/data/a.txt",
+        "sub/a.txt",
+        "a.txt?download=1",
+        "a%2Fb.txt",
+    ],
+)
+def test_links_leading_elsewhere_are_skipped(href):
+    assert _listing_entry(BASE, href) is None
+
+
+def test_links_inside_the_directory():
+    entry = _listing_entry(BASE, "/data/a.txt")
+    assert (entry.url, entry.name, entry.is_dir) == (BASE + "a.txt", "a.txt", False)
+    entry = _listing_entry(BASE, "http://host/data/sub/")
+    assert (entry.url, entry.name, entry.is_dir) == (BASE + "sub/", "sub", True)
+    assert _listing_entry(BASE, " b%20c.txt ").name == "b c.txt"
+
+
+def test_directory_url():
+    assert _directory_url("http://host/data") == BASE
+    assert _directory_url(BASE) == BASE
+    assert _directory_url("http://host") == "http://host/"
+
+
+def test_plan_skips_files_listed_unchanged(tmp_path):
+    local = str(tmp_path)
+    plan = SyncPlan(BASE, local)
+    assert plan.next_directory() == BASE
+    entries = _parse(APACHE, 100000)
+    plan.add(entries)
+    assert plan.directories[0] == (BASE + "sub/", os.path.join(local, "sub"))
+    urls, outputs = plan.take()
+    assert urls == [BASE + "a.txt", BASE + "caf%C3%A9.dat"]
+
+    # The second file has been relisted since it was retrieved.
+    for url, output, stamp in zip(urls, outputs, (entries[0].stamp, "old")):
+        with open(output, "wb") as f:
+            f.write(b"data")
+        plan.index.update(url, output, 4)
+        plan.index.stamp(url, stamp)
+    plan.changed.clear()
+    plan.index.save()
+
+    plan = SyncPlan(BASE, local, recursive=False)
+    plan.next_directory()
+    plan.add(entries)
+    assert not plan.directories
+    assert plan.take()[0] == [BASE + "caf%C3%A9.dat"]
+    assert plan.listed == 2
+    assert os.path.exists(os.path.join(local, SYNC_INDEX))
+
+
+def test_touched_copy_is_fetched_again(tmp_path):
+    local = str(tmp_path)
+    plan = SyncPlan(BASE, local)
+    plan.next_directory()
+    output = os.path.join(local, "a.txt")
+    with open(output, "wb") as f:
+        f.write(b"data")
+    plan.index.update(BASE + "a.txt", output, 4)
+    plan.index.stamp(BASE + "a.txt", "stamp")
+    assert plan.index.unchanged(BASE + "a.txt", output, "stamp")
+    assert not plan.index.unchanged(BASE + "a.txt", output, "other")
+    assert not plan.index.unchanged(BASE + "a.txt", output, None)
+    assert not plan.index.unchanged(BASE + "a.txt", output, "stamp", decompress=True)
+
+    mtime = os.path.getmtime(output)
+    os.utime(output, (mtime + 10, mtime + 10))
+    assert not plan.index.unchanged(BASE + "a.txt", output, "stamp")
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for checksum verification in tomputils.downloader.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import base64
+import hashlib
+import random
+import struct
+import zlib
+
+import pytest
+
+from tomputils.downloader.verify import (
+    CRC32_POLY,
+    CRC32C_POLY,
+    VerificationError,
+    Verifier,
+    crc_combine,
+    parse_checksum,
+    parse_digest_headers,
+)
+
+DATA = bytes(bytearray(random.Random(1).getrandbits(8) for _ in range(100000)))
+
+
+def _crc32(data):
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+
+def _expected(data, *names):
+    expected = {}
+    for name in names:
+        if name == "crc32":
+            expected[name] = struct.pack(">I", _crc32(data))
+        else:
+            expected[name] = hashlib.new(name, data).digest()
+    return expected
+
+
+def _pieces(size, count, seed):
+    rng = random.Random(seed)
+    cuts = sorted(rng.sample(range(1, size), count - 1))
+    bounds = [0] + cuts + [size]
+    pieces = list(zip(bounds, bounds[1:]))
+    rng.shuffle(pieces)
+    return pieces
+
+
+def _read(data):
+    def read(offset, length):
+        return bytes(data[offset : offset + length])  # noqa: E203
+
+    return read
+
+
+@pytest.mark.parametrize("split", [0, 1, 7, 4096, 65535, len(DATA)])
+def test_crc_combine_matches_zlib(split):
+    first, second = DATA[:split], DATA[split:]
+    combined = crc_combine(_crc32(first), _crc32(second), len(second), CRC32_POLY)
+    assert combined == _crc32(DATA)
+
+
+def test_crc_combine_crc32c():
+    crc32c = pytest.importorskip("crc32c")
+    split = 12345
+    first, second = DATA[:split], DATA[split:]
+    combined = crc_combine(
+        crc32c.crc32c(first), crc32c.crc32c(second), len(second), CRC32C_POLY
+    )
+    assert combined == crc32c.crc32c(DATA)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_out_of_order_writes_verify(seed):
+    written = bytearray(len(DATA))
+    verifier = Verifier(_expected(DATA, "md5", "sha256", "crc32"))
+    for start, end in _pieces(len(DATA), 20, seed):
+        written[start:end] = DATA[start:end]
+        verifier.update(_read(written), start, DATA[start:end])
+    assert verifier.frontier == len(DATA)
+    verifier.finish(_read(written), len(DATA))
+
+
+def test_frontier_waits_for_the_gap_to_close():
+    written = bytearray(DATA)
+    verifier = Verifier(_expected(DATA, "md5"))
+    verifier.update(_read(written), 1000, DATA[1000:3000])
+    assert verifier.frontier == 0
+    verifier.update(_read(written), 0, DATA[:1000])
+    assert verifier.frontier == 3000
+
+
+def test_unseen_ranges_are_read_back():
+    # As after a resume, where earlier data was written by another run.
+    verifier = Verifier(_expected(DATA, "md5", "crc32"))
+    verifier.update(_read(DATA), 50000, DATA[50000:60000])
+    verifier.finish(_read(DATA), len(DATA))
+
+
+def test_mismatch_raises():
+    corrupt = bytearray(DATA)
+    corrupt[500] ^= 0xFF
+    for name in ("md5", "crc32"):
+        verifier = Verifier(_expected(DATA, name))
+        verifier.update(_read(corrupt), 0, bytes(corrupt))
+        with pytest.raises(VerificationError):
+            verifier.finish(_read(corrupt), len(corrupt))
+
+
+def test_parse_checksum():
+    digest = hashlib.md5(DATA).hexdigest()
+    assert parse_checksum("MD5:" + digest) == {"md5": hashlib.md5(DATA).digest()}
+    assert parse_checksum({"sha-256": "00ff"}) == {"sha256": b"\x00\xff"}
+    with pytest.raises(ValueError):
+        parse_checksum("whirlpool:00")
+
+
+def test_parse_digest_headers():
+    md5 = hashlib.md5(DATA).digest()
+    sha = hashlib.sha256(DATA).digest()
+    headers = {
+        "content-md5": base64.b64encode(md5).decode(),
+        "repr-digest": "sha-256=:{}:, unknown=:AA==:".format(
+            base64.b64encode(sha).decode()
+        ),
+    }
+    assert parse_digest_headers(headers) == {"md5": md5, "sha256": sha}
@@ -10,21 +10,56 @@ tomputils.downloader
 
 A simple segmenting downloader.
 
+Segments from many files may share a single set of connections. Files
+may be written to disk, filled into memory or streamed in order.
+AsyncDownloader offers the same from an asyncio event loop. Request
+timings may be exported to Prometheus or StatsD through metrics hooks.
+Progress is drawn on a terminal, logged or written as JSON lines.
+Failed requests are retried with backoff, honouring Retry-After.
+
 :license:
     CC0 1.0 Universal
     http://creativecommons.org/publicdomain/zero/1.0/
 """
 
-from tomputils.downloader.downloader import Downloader, fetch
+from tomputils.downloader.downloader import Downloader, fetch, fetch_many, stream
+from tomputils.downloader.aio import AsyncDownloader
+from tomputils.downloader.metrics import (
+    MetricsHook,
+    PrometheusExporter,
+    StatsdExporter,
+    TransferResult,
+)
+from tomputils.downloader.progress import (
+    JsonProgress,
+    LogProgress,
+    ProgressSink,
+    TtyProgress,
+)
+from tomputils.downloader.retry import RetryPolicy
 
 DEFAULT_MIN_SEG_SIZE = 16 * 1024
 DEFAULT_MAX_CON = 4
+DEFAULT_MAX_TOTAL_CON = 16
 DEFAULT_MAX_RETRY = 5
 
 __all__ = [
     "fetch",
+    "fetch_many",
+    "stream",
     "Downloader",
+    "AsyncDownloader",
+    "TransferResult",
+    "MetricsHook",
+    "PrometheusExporter",
+    "StatsdExporter",
+    "ProgressSink",
+    "TtyProgress",
+    "LogProgress",
+    "JsonProgress",
+    "RetryPolicy",
     "DEFAULT_MIN_SEG_SIZE",
     "DEFAULT_MAX_CON",
+    "DEFAULT_MAX_TOTAL_CON",
     "DEFAULT_MAX_RETRY",
 ]
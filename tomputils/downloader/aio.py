@@ -0,0 +1,512 @@
+# -*- coding: utf8 -*-
+"""
+Download files from an asyncio event loop.
+
+libcurl tells the downloader which sockets to watch and when its next
+timeout falls due. Those sockets are registered with the running loop, so
+any number of transfers share one thread and progress as soon as their
+sockets are ready.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import asyncio
+import logging
+import time
+
+import pycurl
+
+from tomputils.downloader.downloader import (
+    Downloader,
+    Scheduler,
+    _end_probe,
+    _resume_paused,
+    _start_probe,
+)
+from tomputils.downloader.journal import SAVE_INTERVAL
+from tomputils.downloader.retry import TransientError
+from tomputils.downloader.sink import StreamSink
+from tomputils.downloader.sync import ListingParser, SyncPlan
+
+LOG = logging.getLogger(__name__)
+
+
+class AsyncDownloader(Downloader):
+    """
+    Download files, possibly in segments, without blocking the event loop.
+
+    Takes the same parameters as Downloader. Concurrent calls to ``fetch``
+    and ``fetch_many`` share one set of connections, and the connection
+    limits apply across all of them. A downloader is bound to the event
+    loop it is first used on.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncDownloader, self).__init__(*args, **kwargs)
+        self._loop = None
+        self._multi = None
+        self._scheduler = None
+        self._timeout = None
+        self._tick = None
+        self._checkpointed = 0
+        self._sockets = set()
+        self._probes = {}
+        self._waiters = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Stop watching sockets and close all pooled connections."""
+        self._detach()
+        super(AsyncDownloader, self).close()
+
+    async def fetch(self, req_url, output=None, checksum=None):
+        """
+        Fetch a file.
+
+        Parameters
+        ----------
+        req_url : str or list of str
+            URL of the file to retrieve, or URLs of mirrors holding the same
+            file, as accepted by Downloader.fetch.
+        output : str, bytearray, memoryview, file-like or callable, optional
+            filename, possibly with path, of the downloaded file, or other
+            output as accepted by Downloader.fetch.
+        checksum : str or dict, optional
+            expected checksum, as accepted by Downloader.fetch.
+
+        Returns
+        -------
+        str or object
+            filename of the downloaded file, or output if it is not a
+            filename.
+
+        """
+        checksums = None if checksum is None else [checksum]
+        return (await self.fetch_many([req_url], [output], checksums))[0]
+
+    async def fetch_many(self, urls, outputs=None, checksums=None):
+        """
+        Fetch several files over the shared set of connections.
+
+        Parameters
+        ----------
+        urls : list of str
+            URLs of the files to retrieve
+        outputs : list, optional
+            filenames, possibly with path, of the downloaded files, or other
+            outputs as accepted by Downloader.fetch.
+        checksums : list, optional
+            expected checksums, as accepted by Downloader.fetch_many.
+
+        Returns
+        -------
+        list
+            filenames of the downloaded files, or the outputs given, in the
+            same order as ``urls``.
+
+        Raises
+        ------
+        RuntimeError
+            if any file could not be retrieved.
+
+        """
+        transfers = self._transfers(urls, outputs, checksums)
+        start_time = time.time()
+        await self._run_async(transfers)
+        return self._settle(transfers, time.time() - start_time)
+
+    async def retrieve(self, req_url, output=None, checksum=None):
+        """
+        Fetch a file, reporting how it went rather than raising on failure.
+
+        Takes the same parameters as ``fetch``.
+
+        Returns
+        -------
+        TransferResult
+            outcome of the file, with the timings of every request.
+
+        """
+        checksums = None if checksum is None else [checksum]
+        return (await self.retrieve_many([req_url], [output], checksums))[0]
+
+    async def retrieve_many(self, urls, outputs=None, checksums=None):
+        """
+        Fetch several files, reporting how each went rather than raising on
+        failure.
+
+        Takes the same parameters as ``fetch_many``.
+
+        Returns
+        -------
+        list of TransferResult
+            outcome of each file, in the same order as ``urls``.
+
+        """
+        transfers = self._transfers(urls, outputs, checksums)
+        start_time = time.time()
+        await self._run_async(transfers)
+        return self._results(transfers, time.time() - start_time)
+
+    async def _run_async(self, transfers):
+        """Retrieve a batch of transfers, recording any failure on each."""
+        self._attach()
+        await asyncio.gather(*[self._prepare_async(t) for t in transfers])
+
+        fetching = [t for t in transfers if t.error is None and not t.skipped]
+        waiters = []
+        for transfer in fetching:
+            self._plan_segments(transfer)
+            waiter = self._loop.create_future()
+            self._waiters[transfer] = waiter
+            waiters.append(waiter)
+            self._scheduler.add(transfer)
+
+        self.progress.add(fetching)
+        try:
+            self._scheduler.dispatch()
+            self._schedule_tick()
+            if waiters:
+                await asyncio.gather(*waiters)
+        except BaseException:
+            for transfer in fetching:
+                self._waiters.pop(transfer, None)
+            self._scheduler.cancel(fetching)
+            raise
+        finally:
+            self.progress.remove(fetching)
+
+    async def stream(self, req_url, checksum=None):
+        """
+        Retrieve a file as a sequence of chunks, in order, without writing
+        it to disk.
+
+        Segments are retrieved concurrently, if the server allows, within
+        ``reorder_buffer`` bytes of the data the caller has taken, so a
+        slow consumer holds back the download.
+
+        Parameters
+        ----------
+        req_url : str or list of str
+            URL of the file to retrieve, or URLs of mirrors, as accepted by
+            Downloader.fetch.
+        checksum : str or dict, optional
+            expected checksum, as accepted by Downloader.fetch. It can only
+            be checked once every chunk has been yielded.
+
+        Yields
+        ------
+        bytes
+            the next chunk of the file.
+
+        Raises
+        ------
+        RuntimeError
+            if the file could not be retrieved or failed verification.
+
+        """
+        chunks = asyncio.Queue()
+        sink = StreamSink(chunks.put_nowait, self.reorder_buffer, manual_release=True)
+        task = asyncio.ensure_future(self.fetch(req_url, sink, checksum))
+        task.add_done_callback(lambda task: chunks.put_nowait(None))
+        try:
+            while True:
+                data = await chunks.get()
+                if data is None:
+                    break
+                yield data
+                sink.release(len(data))
+                if self._scheduler is not None:
+                    self._scheduler.dispatch()
+                    self._schedule_tick()
+            await task
+        finally:
+            if not task.done():
+                task.cancel()
+
+    async def sync(self, index_url, local_dir, recursive=True):
+        """
+        Mirror a directory listing into a local directory, retrieving only
+        the files which are new or have changed since the last sync.
+
+        Takes the same parameters as Downloader.sync.
+
+        Returns
+        -------
+        list of TransferResult
+            outcome of each file probed or retrieved.
+
+        """
+        plan = SyncPlan(index_url, local_dir, recursive, self.decompress)
+        results = []
+        top = url = plan.next_directory()
+        while url is not None:
+            parser = ListingParser(url)
+            try:
+                async for chunk in self.stream(url):
+                    plan.add(parser.parse(chunk))
+            except RuntimeError as e:
+                if url == top:
+                    raise
+                LOG.error("Cannot list %s: %s", url, e)
+            plan.add(parser.parse(b"", final=True))
+            results += await self._sync_changed(plan)
+            url = plan.next_directory()
+        plan.finish(results)
+        return results
+
+    async def _sync_changed(self, plan):
+        """Retrieve the files of a sync found to be new or changed."""
+        urls, outputs = plan.take()
+        if not urls:
+            return []
+        transfers = self._transfers(urls, outputs, cache=plan.index)
+        start_time = time.time()
+        await self._run_async(transfers)
+        results = self._results(transfers, time.time() - start_time)
+        plan.retrieved(results)
+        return results
+
+    async def _prepare_async(self, transfer):
+        """Probe the remote servers for a transfer, recording any failure."""
+        probes = self._plan_probes(transfer)
+        if probes:
+            results = await asyncio.gather(
+                *[self._probe_async(*probe) for probe in probes]
+            )
+            self._prepare_probed(transfer, results)
+
+    async def _probe_async(self, url, conditions, retry=False):
+        """
+        Probe a URL, returning the same as Downloader._probe_outcome. If
+        retry is set, transient failures are probed again after a backoff.
+        """
+        attempt = 0 if retry else None
+        while True:
+            c = self._acquire()
+            headers = _start_probe(url, c.curl, conditions)
+            try:
+                errno, errmsg = await self._perform(c.curl)
+            except BaseException:
+                _end_probe(c.curl, conditions)
+                c.close()
+                raise
+            outcome = self._probe_outcome(
+                c, url, headers, conditions, errno, errmsg, attempt
+            )
+            if not isinstance(outcome, TransientError):
+                return outcome
+            LOG.warning("%s: %s, probing again in %.1fs", url, outcome, outcome.delay)
+            attempt += 1
+            await asyncio.sleep(outcome.delay)
+
+    async def _perform(self, curl):
+        """
+        Perform a request on the shared multi handle.
+
+        Returns
+        -------
+        (int, str)
+            libcurl error code and message.
+        """
+        waiter = self._loop.create_future()
+        self._probes[curl] = waiter
+        self._multi.add_handle(curl)
+        try:
+            return await waiter
+        finally:
+            if self._probes.pop(curl, None) is not None:
+                self._multi.remove_handle(curl)
+
+    def _attach(self):
+        """Bind to the running event loop, creating the multi handle."""
+        loop = asyncio.get_running_loop()
+        if loop is self._loop:
+            return
+        if self._probes or self._waiters:
+            raise RuntimeError("AsyncDownloader is in use on another event loop.")
+
+        self._detach()
+        self._loop = loop
+        self._multi = self._create_multi()
+        self._multi.setopt(pycurl.M_SOCKETFUNCTION, self._socket_cb)
+        self._multi.setopt(pycurl.M_TIMERFUNCTION, self._timer_cb)
+        self._scheduler = Scheduler(self, self._multi, self._finished)
+
+    def _detach(self):
+        if self._loop is None:
+            return
+
+        for handle in (self._timeout, self._tick):
+            if handle is not None:
+                handle.cancel()
+        transfers = list(self._waiters)
+        if self._loop.is_closed():
+            # Nothing is left to await the transfers.
+            self._waiters = {}
+        else:
+            for fd in self._sockets:
+                self._loop.remove_reader(fd)
+                self._loop.remove_writer(fd)
+        self._scheduler.cancel(transfers)
+        self._multi.close()
+        self._loop = None
+        self._multi = None
+        self._scheduler = None
+        self._timeout = None
+        self._tick = None
+        self._sockets = set()
+
+    def _socket_cb(self, what, fd, multi, socketp):
+        loop = self._loop
+        loop.remove_reader(fd)
+        loop.remove_writer(fd)
+        if what == pycurl.POLL_REMOVE:
+            self._sockets.discard(fd)
+            return
+
+        self._sockets.add(fd)
+        if what in (pycurl.POLL_IN, pycurl.POLL_INOUT):
+            loop.add_reader(fd, self._socket_action, fd, pycurl.CSELECT_IN)
+        if what in (pycurl.POLL_OUT, pycurl.POLL_INOUT):
+            loop.add_writer(fd, self._socket_action, fd, pycurl.CSELECT_OUT)
+
+    def _timer_cb(self, timeout_ms):
+        if self._timeout is not None:
+            self._timeout.cancel()
+            self._timeout = None
+        if timeout_ms >= 0:
+            self._timeout = self._loop.call_later(timeout_ms / 1000.0, self._on_timeout)
+
+    def _on_timeout(self):
+        self._timeout = None
+        self._socket_action(pycurl.SOCKET_TIMEOUT, 0)
+
+    def _socket_action(self, fd, event):
+        try:
+            while True:
+                ret, running = self._multi.socket_action(fd, event)
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            self._read_messages()
+            self._scheduler.dispatch()
+            self._schedule_tick()
+        except Exception as e:
+            LOG.exception("Transfer engine failed")
+            self._abort(e)
+
+    def _read_messages(self):
+        while True:
+            num_q, ok_list, err_list = self._multi.info_read()
+            for curl in ok_list:
+                self._complete(curl, pycurl.E_OK, None)
+            for curl, errno, errmsg in err_list:
+                self._complete(curl, errno, errmsg)
+            if num_q == 0:
+                break
+
+    def _complete(self, curl, errno, errmsg):
+        self._multi.remove_handle(curl)
+        waiter = self._probes.pop(curl, None)
+        if waiter is None:
+            self._scheduler.complete(curl, errno, errmsg)
+        elif not waiter.done():
+            waiter.set_result((errno, errmsg))
+
+    def _finished(self, transfer):
+        waiter = self._waiters.pop(transfer, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(transfer)
+
+    def _abort(self, error):
+        """Fail every outstanding request after an unexpected error."""
+        for waiter in list(self._probes.values()) + list(self._waiters.values()):
+            if not waiter.done():
+                waiter.set_exception(error)
+
+    def _schedule_tick(self):
+        """
+        Arrange to checkpoint working connections every SAVE_INTERVAL, to
+        resume throttled connections when their wait is over and to start
+        retries when they fall due. Nothing is scheduled while no connection
+        is working and no retry is waiting.
+        """
+        working = self._scheduler.working
+        wakeup = self._scheduler.next_wakeup()
+        if not working and wakeup is None:
+            if self._tick is not None:
+                self._tick.cancel()
+                self._tick = None
+            return
+
+        now = time.time()
+        delay = SAVE_INTERVAL
+        if wakeup is not None:
+            delay = min(delay, max(0, wakeup - now))
+        if self._throttle is not None:
+            for c in working:
+                if c.resume_at is not None:
+                    delay = min(delay, max(0, c.resume_at - now))
+
+        when = self._loop.time() + delay
+        if self._tick is not None:
+            if self._tick.when() <= when:
+                return
+            self._tick.cancel()
+        self._tick = self._loop.call_at(when, self._on_tick)
+
+    def _on_tick(self):
+        self._tick = None
+        try:
+            if self._throttle is not None:
+                _resume_paused(self._scheduler.working)
+            now = self._loop.time()
+            if now - self._checkpointed >= SAVE_INTERVAL:
+                self._scheduler.checkpoint()
+                self._checkpointed = now
+            self._scheduler.dispatch()
+            self._schedule_tick()
+        except Exception as e:
+            LOG.exception("Transfer engine failed")
+            self._abort(e)
+
+
+async def fetch(req_url, output=None, checksum=None):
+    """
+    Fetch a single URL using default settings.
+
+    Parameters
+    ----------
+    req_url : unicode or str
+        URL to request.
+    output : str, bytearray, memoryview, file-like or callable, optional
+        filename, possibly with path, of the downloaded file, or other output
+        as accepted by Downloader.fetch.
+    checksum : str or dict, optional
+        expected checksum, as accepted by Downloader.fetch.
+    """
+    async with AsyncDownloader() as dl:
+        return await dl.fetch(req_url, output, checksum)
+
+
+async def fetch_many(urls, outputs=None, checksums=None):
+    """
+    Fetch several URLs using default settings.
+
+    Parameters
+    ----------
+    urls : list of str
+        URLs to request.
+    outputs : list, optional
+        filenames, possibly with path, of the downloaded files, or other
+        outputs as accepted by Downloader.fetch.
+    checksums : list, optional
+        expected checksums, as accepted by Downloader.fetch_many.
+    """
+    async with AsyncDownloader() as dl:
+        return await dl.fetch_many(urls, outputs, checksums)
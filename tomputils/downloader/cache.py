@@ -0,0 +1,264 @@
+# -*- coding: utf8 -*-
+"""
+Remember the validators of downloaded files, so unchanged files need not be
+retrieved again, and what recent probes learned, so files need not be probed
+again.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import collections
+import json
+import logging
+import os
+import time
+
+LOG = logging.getLogger(__name__)
+DEFAULT_MAX_PROBES = 10000
+
+
+class MetadataCache(object):
+    """
+    ETag, Last-Modified and size of previously downloaded files, keyed by
+    the URL requested and kept in a JSON file. The key is known before any
+    request is made, so it holds behind redirects. A file decompressed as
+    it was retrieved is only current for downloads which decompress too.
+
+    Parameters
+    ----------
+    path : str
+        filename, possibly with path, of the cache.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._dirty = False
+        try:
+            with open(path, str("r")) as cache_file:
+                self.entries = json.load(cache_file)
+        except (IOError, OSError):
+            pass
+        except ValueError:
+            LOG.warning("Ignoring unreadable cache %s", path)
+
+    def lookup(self, url, output=None, decompress=False):
+        """
+        Find the entry for a URL, if the file it describes is still on disk.
+
+        Parameters
+        ----------
+        url : str
+            URL the file was requested from.
+        output : str, optional
+            filename the file is wanted at. If None, the cached filename is
+            accepted.
+        decompress : bool, optional
+            true if the file is wanted decompressed.
+
+        Returns
+        -------
+        dict
+            cached entry, or None.
+
+        """
+        entry = self.entries.get(url)
+        if entry is None:
+            return None
+        if output is not None and entry["output"] != output:
+            return None
+        if entry.get("decompress", False) != decompress:
+            return None
+        try:
+            local_size = entry.get("local_size", entry["size"])
+            if os.path.getsize(entry["output"]) != local_size:
+                return None
+        except OSError:
+            return None
+        return entry
+
+    def conditional_headers(self, url, output=None, decompress=False):
+        """
+        Build request headers which ask the server to skip an unchanged file.
+
+        Parameters
+        ----------
+        url : str
+            URL the file is requested from.
+        output : str, optional
+            filename the file is wanted at.
+        decompress : bool, optional
+            true if the file is wanted decompressed.
+
+        Returns
+        -------
+        list of str
+            If-None-Match and If-Modified-Since headers, possibly empty.
+
+        """
+        entry = self.lookup(url, output, decompress)
+        if entry is None:
+            return []
+
+        headers = []
+        if entry.get("etag"):
+            headers.append("If-None-Match: {}".format(entry["etag"]))
+        if entry.get("last_modified"):
+            headers.append("If-Modified-Since: {}".format(entry["last_modified"]))
+        return headers
+
+    def matches(
+        self, url, output, size, etag=None, last_modified=None, decompress=False
+    ):
+        """
+        Check if a local copy matches what the server reports.
+
+        Parameters
+        ----------
+        url : str
+            URL the file was requested from.
+        output : str
+            filename the file is wanted at.
+        size : int
+            size reported by the server.
+        etag : str, optional
+            ETag reported by the server.
+        last_modified : str, optional
+            Last-Modified reported by the server.
+        decompress : bool, optional
+            true if the file is wanted decompressed.
+
+        Returns
+        -------
+        bool
+            True if the local copy is current.
+
+        """
+        if etag is None and last_modified is None:
+            return False
+
+        entry = self.lookup(url, output, decompress)
+        return (
+            entry is not None
+            and entry["size"] == size
+            and entry.get("etag") == etag
+            and entry.get("last_modified") == last_modified
+        )
+
+    def update(
+        self,
+        url,
+        output,
+        size,
+        etag=None,
+        last_modified=None,
+        local_size=None,
+        decompress=False,
+    ):
+        """
+        Remember a completed download.
+
+        Parameters
+        ----------
+        url : str
+            URL the file was requested from.
+        output : str
+            filename of the downloaded file.
+        size : int
+            size of the file on the server in bytes.
+        etag : str, optional
+            ETag reported by the server.
+        last_modified : str, optional
+            Last-Modified reported by the server.
+        local_size : int, optional
+            size of the downloaded file, if it differs from size.
+        decompress : bool, optional
+            true if the file was decompressed as it was retrieved.
+
+        """
+        if etag is None and last_modified is None:
+            return
+
+        self.entries[url] = _entry(
+            output, size, etag, last_modified, local_size, decompress
+        )
+        self._dirty = True
+
+    def save(self):
+        """Write the cache to disk if it has changed."""
+        if not self._dirty:
+            return
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, str("w")) as cache_file:
+            json.dump(self.entries, cache_file)
+        os.rename(tmp_path, self.path)
+        self._dirty = False
+
+
+def _entry(output, size, etag, last_modified, local_size, decompress):
+    return {
+        "output": output,
+        "size": size,
+        "local_size": size if local_size is None else local_size,
+        "etag": etag,
+        "last_modified": last_modified,
+        "decompress": decompress,
+    }
+
+
+class ProbeCache(object):
+    """
+    What recent probes learned of each URL, held in memory for a limited
+    time, so files fetched again soon after need not be probed again.
+
+    Parameters
+    ----------
+    ttl : float
+        seconds a probe is trusted for.
+    max_entries : int, optional
+        most URLs remembered. The oldest are forgotten first.
+
+    """
+
+    def __init__(self, ttl, max_entries=DEFAULT_MAX_PROBES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+
+    def get(self, url):
+        """
+        Find what a recent probe learned of a URL.
+
+        Parameters
+        ----------
+        url : str
+            URL which was probed.
+
+        Returns
+        -------
+        tuple
+            effective URL, size, range support and headers, as returned by
+            downloader._check_headers, or None if the URL has not been
+            probed within ttl seconds.
+
+        """
+        entry = self.entries.get(url)
+        if entry is None:
+            return None
+        expires, probe = entry
+        if expires <= time.time():
+            del self.entries[url]
+            return None
+        return probe
+
+    def put(self, url, probe):
+        """Remember what a probe of a URL learned."""
+        self.entries.pop(url, None)
+        self.entries[url] = (time.time() + self.ttl, probe)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def forget(self, url):
+        """Drop what is known of a URL, once it has proved wrong."""
+        self.entries.pop(url, None)
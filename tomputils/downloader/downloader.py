@@ -1,21 +1,58 @@
 # -*- coding: utf8 -*-
 """
-Download a single file. Download file segments concurrently if supported by
-the remote server.
+Download files. Download file segments concurrently if supported by the remote
+server, sharing connections across a batch of files.
 
 Inspired by:
 https://github.com/dragondjf/QMusic/blob/master/test/pycurldownload.py
 
 """
 from __future__ import absolute_import, division, print_function, unicode_literals
-from future.builtins import *  # NOQA
+import collections
 import logging
-import sys
+import math
 import os
+import selectors
 import time
 
 import pycurl
 from six import BytesIO
+from six.moves.urllib.parse import urljoin, urlparse
+
+from tomputils.downloader.cache import MetadataCache, ProbeCache
+from tomputils.downloader.journal import SegmentJournal, SAVE_INTERVAL
+from tomputils.downloader.limit import Throttle
+from tomputils.downloader.metrics import RequestMetrics, TransferResult
+from tomputils.downloader.progress import (
+    DEFAULT_UPDATES,
+    ProgressReporter,
+    ProgressSink,
+    TtyProgress,
+)
+from tomputils.downloader.retry import (
+    RETRY_AFTER_STATUSES,
+    RetryPolicy,
+    TransientError,
+    parse_retry_after,
+)
+from tomputils.downloader.sink import (
+    ALLOCATIONS,
+    WRITE_MODES,
+    DecompressSink,
+    FileSink,
+    Sink,
+    StreamSink,
+    compression,
+    create_sink,
+    decompressed_name,
+)
+from tomputils.downloader.sync import ListingParser, SyncPlan
+from tomputils.downloader.verify import (
+    Verifier,
+    VerificationError,
+    parse_checksum,
+    parse_digest_headers,
+)
 
 if os.name == "posix":
     import signal
@@ -24,347 +61,2580 @@ if os.name == "posix":
     del signal
 
 STATUS_OK = (200, 203, 206)
+STATUS_PARTIAL = 206
+STATUS_NOT_MODIFIED = 304
+STATUS_RANGE_NOT_SATISFIABLE = 416
 STATUS_ERROR = range(400, 600)
 DEFAULT_MIN_SEG_SIZE = 16 * 1024
 DEFAULT_MAX_CON = 4
+DEFAULT_MAX_TOTAL_CON = 16
 DEFAULT_MAX_RETRY = 5
+CHUNKS_PER_CON = 4
+CHUNK_SECONDS = 2.0
+STEAL_MIN_SECONDS = 1.0
+MIRROR_MAX_FAILURES = 3
+DEFAULT_REORDER_BUFFER = 8 * 1024 * 1024
+ACCEPT_ENCODING = "gzip, deflate"
+DEFAULT_MAX_STREAMS = 100
+HTTP2_VERSIONS = {
+    True: pycurl.CURL_HTTP_VERSION_2TLS,
+    "prior-knowledge": pycurl.CURL_HTTP_VERSION_2_PRIOR_KNOWLEDGE,
+}
+POLL_EVENTS = {
+    pycurl.POLL_IN: selectors.EVENT_READ,
+    pycurl.POLL_OUT: selectors.EVENT_WRITE,
+    pycurl.POLL_INOUT: selectors.EVENT_READ | selectors.EVENT_WRITE,
+}
 
 LOG = logging.getLogger(__name__)
 
 
+class Segment(object):
+    """
+    A byte range of a file, retrieved by a single request.
+
+    The end of a segment may be moved back while it is being retrieved, when
+    part of the range is handed to an idle connection.
+
+    Parameters
+    ----------
+    id : int
+        Segment number, unique within a transfer.
+    start : int
+        Offset of the first byte of the segment.
+    end : int
+        Offset of the last byte of the segment, or None if the segment runs
+        to the end of a response of unknown length.
+
+    """
+
+    def __init__(self, id, start, end):
+        self.id = id
+        self.start = start
+        self.end = end
+        self.downloaded = 0
+        self.retried = 0
+        self.not_before = 0
+
+    @property
+    def position(self):
+        return self.start + self.downloaded
+
+    @property
+    def size(self):
+        if self.end is None:
+            return None
+        return self.end - self.start + 1
+
+    @property
+    def remaining(self):
+        if self.end is None:
+            return None
+        return self.end - self.position + 1
+
+    @property
+    def complete(self):
+        # Only a clean end to the response completes an open segment.
+        return self.end is not None and self.position > self.end
+
+
+class Source(object):
+    """
+    One of the URLs a file may be retrieved from.
+
+    Parameters
+    ----------
+    url : str
+        URL of the file on this server.
+
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.eurl = None
+        self.host = None
+        self.latency = None
+        self.rate = None
+        self.failures = 0
+
+    def record_rate(self, rate):
+        """Fold the throughput of a finished request into the running rate."""
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate = 0.7 * self.rate + 0.3 * rate
+
+    @property
+    def healthy(self):
+        return self.failures < MIRROR_MAX_FAILURES
+
+
 class Connection(object):
-    def __init__(self, req_url, can_segment):
+    """
+    A reusable curl handle. A connection is bound to a transfer and segment
+    each time it is prepared, so one connection may serve many files.
+
+    Parameters
+    ----------
+    share : pycurl.CurlShare, optional
+        Share handle used to pool DNS, TLS session and connection caches with
+        other connections.
+    throttle : Throttle, optional
+        Bandwidth budget to draw from before accepting data.
+    encoding : str, optional
+        Accept-Encoding to request. Responses are kept as sent.
+    http_version : int, optional
+        HTTP version to ask for. If given, requests wait for a connection
+        they can be multiplexed over rather than opening another.
+
+    """
+
+    def __init__(self, share=None, throttle=None, encoding=None, http_version=None):
         self.curl = pycurl.Curl()
         self.curl.setopt(pycurl.FOLLOWLOCATION, 1)
         self.curl.setopt(pycurl.MAXREDIRS, 5)
         self.curl.setopt(pycurl.CONNECTTIMEOUT, 30)
         self.curl.setopt(pycurl.TIMEOUT, 300)
         self.curl.setopt(pycurl.NOSIGNAL, 1)
+        self.curl.setopt(pycurl.TCP_KEEPALIVE, 1)
         self.curl.setopt(pycurl.WRITEFUNCTION, self.write_cb)
-        self.curl.setopt(pycurl.URL, req_url)
-        self.can_segment = can_segment
+        if encoding is not None:
+            self.curl.setopt(pycurl.ENCODING, encoding)
+            self.curl.setopt(pycurl.HTTP_CONTENT_DECODING, 0)
+        if http_version is not None:
+            self.curl.setopt(pycurl.HTTP_VERSION, http_version)
+            self.curl.setopt(pycurl.PIPEWAIT, 1)
+        if share is not None:
+            self.curl.setopt(pycurl.SHARE, share)
         self.curl.connection = self
-        self.total_downloaded = 0
-        self.id = None
+        self.transfer = None
+        self.source = None
+        self.can_segment = None
         self.name = None
-        self.segment_size = None
         self.segment = None
+        self.offset = None
         self.link_downloaded = None
-        self.segment_downloaded = None
-        self.retried = None
-        self.out_file = None
-
-    def prepare(self, out_file, segment):
-        if isinstance(segment, list):
-            self.id = segment[0]
-            self.name = "Segment % 02d" % segment[0]
-            self.curl.setopt(pycurl.RANGE, "%d-%d" % (segment[1], segment[2]))
-            self.segment_size = segment[2] - segment[1] + 1
-            self.segment = segment
-        else:
-            self.id = 0
-            self.name = "TASK"
-            self.segment_size = segment
-            self.segment = None
+        self.started = None
+        self.discard = False
+        self.rewind = False
+        self.retry_after = None
+        self.discover = None
+        self.headers = []
+        self.throttle = throttle
+        self.resume_at = None
+        self.held = False
+        self._if_range = False
+        self._buffer = []
+        self._buffered = 0
 
-        self.link_downloaded = 0
-        self.segment_downloaded = 0
-        self.retried = 0
-        self.out_file = out_file
+    def prepare(self, transfer, segment, source, discover=None):
+        """
+        Bind the connection to a segment of a transfer.
+
+        Parameters
+        ----------
+        transfer : Transfer
+            transfer the request is for.
+        segment : Segment
+            range to retrieve.
+        source : Source
+            where to retrieve it from.
+        discover : callable, optional
+            called with the connection once the headers of the response
+            have arrived, before any data is kept, for a transfer which was
+            not probed. The request is stopped if it returns false.
+
+        """
+        self.transfer = transfer
+        self.source = source
+        self.can_segment = transfer.can_segment
         self.segment = segment
+        self.discover = discover
+        self.headers = []
+        self.curl.setopt(pycurl.URL, source.eurl)
+        self.curl.setopt(pycurl.HEADERFUNCTION, self.header_cb)
+        self._name()
+        self._set_range()
+
+        self.link_downloaded = 0
+        self.started = time.time()
+        self.discard = False
+        self.rewind = False
+        self.retry_after = None
+        self.held = False
 
-    def prepare_retry(self):
+    def _name(self):
+        transfer = self.transfer
+        if self.can_segment:
+            self.name = "%s segment % 02d" % (transfer.output, self.segment.id)
+        else:
+            self.name = transfer.output or self.source.url
+
+    def _set_range(self):
+        self.offset = self.segment.position
+        validator = None
         if self.can_segment:
             self.curl.setopt(
-                pycurl.RANGE,
-                "%d-%d" % (self.segment[1] + self.segment_downloaded, self.segment[2]),
+                pycurl.RANGE, "%d-%d" % (self.segment.position, self.segment.end)
             )
-        if self.link_downloaded:
-            self.link_downloaded = 0
+        elif self.discover is not None:
+            # Ask for a range, so the response shows if ranges are supported.
+            self.curl.setopt(pycurl.RANGE, "%d-" % self.segment.position)
+        elif self.offset and self.transfer.can_resume:
+            # Carry on from where an earlier request stopped, as long as the
+            # file has not changed since.
+            self.curl.setopt(pycurl.RANGE, "%d-" % self.offset)
+            validator = _strong_validator(self.transfer)
         else:
-            self.retried += 1
+            self.curl.unsetopt(pycurl.RANGE)
+        if validator is not None:
+            self.curl.setopt(pycurl.HTTPHEADER, ["If-Range: %s" % validator])
+            self._if_range = True
+        elif self._if_range:
+            self.curl.unsetopt(pycurl.HTTPHEADER)
+            self._if_range = False
+
+    def discovered(self, can_segment):
+        """
+        Carry on with a request once its transfer has been prepared from
+        the response. A segmented request stops at the end of its segment.
+        """
+        self.headers = []
+        self.can_segment = can_segment
+        self._name()
+
+    def rate(self, now):
+        """
+        Bytes per second retrieved since the current request started. Young
+        requests are credited with the running rate of their source.
+        """
+        elapsed = now - self.started
+        typical = self.source.rate or self.transfer.rate
+        if elapsed < STEAL_MIN_SECONDS and typical:
+            return typical
+        return self.link_downloaded / max(elapsed, 0.1)
+
+    def metrics(self, error=None):
+        """Measurements of the request just finished."""
+        return RequestMetrics.from_curl(
+            self.curl,
+            "segment",
+            self.source.eurl,
+            self.source.host,
+            start=self.offset,
+            end=self.segment.end,
+            bytes=self.link_downloaded,
+            error=error,
+        )
 
     def close(self):
         self.curl.close()
 
+    def flush(self):
+        """Write buffered data to the output at its segment offset."""
+        if not self._buffered:
+            return
+
+        data = b"".join(self._buffer)
+        offset = self.segment.position - self._buffered
+        self.transfer.sink.write(offset, data)
+        self._buffer = []
+        self._buffered = 0
+
+    def header_cb(self, line):
+        if self.discover is not None:
+            self.headers.append(line)
+        if line.startswith(b"HTTP/"):
+            self.retry_after = None
+            try:
+                status = int(line.split()[1])
+            except (IndexError, ValueError):
+                return
+            # Don't write an error page into the output.
+            self.discard = status in STATUS_ERROR
+            # A server which ignored the range, or found the file changed,
+            # sends all of it.
+            self.rewind = (
+                self.offset > 0
+                and not self.can_segment
+                and status in STATUS_OK
+                and status != STATUS_PARTIAL
+            )
+        elif line[:12].lower() == b"retry-after:":
+            self.retry_after = parse_retry_after(line[12:].decode("iso-8859-1"))
+
     def write_cb(self, buf):
-        if self.can_segment:
-            self.out_file.seek(self.segment[1] + self.segment_downloaded, 0)
-            self.out_file.write(buf)
-            self.out_file.flush()
-            size = len(buf)
-            self.link_downloaded += size
-            self.segment_downloaded += size
-            self.total_downloaded += size
-        else:
-            self.out_file.write(buf)
-            self.out_file.flush()
-            size = len(buf)
-            self.link_downloaded += size
-            self.segment_downloaded += size
-            self.total_downloaded += size
+        if self.discard:
+            return None
+        if self.discover is not None and not self.discover(self):
+            return 0
 
+        segment = self.segment
+        if self.rewind:
+            LOG.info("%s: Range not honoured, starting again", self.name)
+            self.rewind = False
+            self.offset = 0
+            self.transfer.rewind(segment)
+        if not self.can_segment:
+            limit = self.transfer.sink.limit()
+            if limit is not None and segment.position > limit:
+                # The output has fallen a window behind. Hand it what is
+                # buffered and wait for it to catch up.
+                self.flush()
+                self.held = True
+                return pycurl.WRITEFUNC_PAUSE
 
-class Downloader(object):
+        size = len(buf)
+        if self.can_segment and size > segment.remaining:
+            # The end of the segment has been handed to another connection.
+            # Keep what is ours and stop the transfer.
+            buf = buf[: segment.remaining]
+
+        written = len(buf)
+        if self.throttle is not None:
+            wait = self.throttle.request(self.source.host, written)
+            if wait > 0:
+                # libcurl holds on to buf and offers it again once resumed.
+                self.resume_at = time.time() + wait
+                return pycurl.WRITEFUNC_PAUSE
+
+        self._buffer.append(buf)
+        self._buffered += written
+        self.link_downloaded += written
+        segment.downloaded += written
+        self.transfer.downloaded += written
+        if self._buffered >= self.transfer.sink.buffer_size:
+            self.flush()
+        if written != size:
+            return 0
+
+
+class Transfer(object):
     """
-    Download a file, possibly in segments.
+    A single file being retrieved as part of a batch.
 
     Parameters
     ----------
-    max_retry : int, optional
-        Maximum attempts that will be made to retrieve a segment.
-    min_seg_size : int, optional
-        Largest file size, in bytes, that will not trigger segmenting.
-    max_con : int, optional
-        Maximum number of concurrent connections to the remote server.
+    req_url : str or list of str
+        URL of the file to retrieve, or URLs of mirrors holding the same
+        file, preferred mirror first.
+    output : str or Sink, optional
+        filename, possibly with path, of the downloaded file, or where else
+        to put the data.
+    checksum : str or dict, optional
+        expected checksum, as accepted by verify.parse_checksum.
+    cache : MetadataCache, optional
+        cache the file is checked against and recorded in once retrieved.
 
     """
 
-    def __init__(
-        self,
-        max_retry=DEFAULT_MAX_RETRY,
-        min_seg_size=DEFAULT_MIN_SEG_SIZE,
-        max_con=DEFAULT_MAX_CON,
-    ):
-        self.min_seg_size = min_seg_size
-        self.max_retry = max_retry
-        self.max_con = max_con
+    def __init__(self, req_url, output=None, checksum=None, cache=None):
+        if isinstance(req_url, (list, tuple)):
+            self.sources = [Source(url) for url in req_url]
+        else:
+            self.sources = [Source(req_url)]
+        self.req_url = self.sources[0].url
+        if isinstance(output, Sink):
+            self.sink = output
+            self.output = output.name
+        else:
+            self.sink = None
+            self.output = output
+        self.opened = False
+        self.checksum = parse_checksum(checksum) if checksum else {}
+        self.cache = cache
+        self._verifier = None
+        self.eurl = None
+        self.size = None
+        self.can_segment = False
+        self.can_resume = False
+        self.unprobed = False
+        self.unassigned = []
+        self.queued = []
+        self.active = 0
+        self.downloaded = 0
+        self.rate = None
+        self.error = None
+        self.etag = None
+        self.last_modified = None
+        self.journal = None
+        self.resumed = False
+        self.skipped = False
+        self.started = None
+        self.ended = None
+        self.retries = 0
+        self.requests = []
+        self.result = None
+        self.finished = False
+        self._segment_id = 0
+
+    @property
+    def file_sink(self):
+        """The FileSink written to, through any decompression, or None."""
+        sink = self.sink
+        while isinstance(sink, DecompressSink):
+            sink = sink.inner
+        return sink if isinstance(sink, FileSink) else None
+
+    @property
+    def to_file(self):
+        return self.sink is None or self.file_sink is not None
+
+    @property
+    def target(self):
+        """What fetch returns for this transfer."""
+        return self.output if self.to_file else self.sink.target
 
-    def fetch(self, req_url, output=None):
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.ended or time.time()) - self.started
+
+    @property
+    def verifier(self):
+        return self._verifier
+
+    @verifier.setter
+    def verifier(self, verifier):
+        self._verifier = verifier
+        if self.sink is not None:
+            self.sink.verifier = verifier
+
+    def open(self):
+        """Open the output for writing."""
+        if self.sink is None:
+            self.sink = FileSink(self.output)
+        self.sink.verifier = self.verifier
+        self.sink.open(self.size, self.resumed)
+        self.opened = True
+        if self.journal is not None:
+            self.journal.save()
+
+    def close(self):
+        if self.opened:
+            self.sink.close()
+            self.opened = False
+
+    def rewind(self, segment):
         """
-        Fetch a file.
+        Start a segment again from its first byte, as a server sends it when
+        it cannot resume. A stream drops what it has already delivered, so
+        its verifier carries on.
+        """
+        self.downloaded -= segment.downloaded
+        segment.downloaded = 0
+        if self.verifier is not None and self.sink.rewindable:
+            self.verifier = Verifier(self.verifier.expected)
+
+    def new_segment(self, start, end):
+        segment = Segment(self._segment_id, start, end)
+        self._segment_id += 1
+        return segment
+
+    def next_segment(self, chunk_size):
+        """
+        Take the next segment to retrieve, carving it from the unassigned
+        ranges if no segment is due for a retry.
 
         Parameters
         ----------
-        req_url : str
-            URL of the file to retrieve
-        output : str, optional
-            filename, possibly with path, of the downloaded file.
+        chunk_size : int
+            Number of bytes to carve.
+
+        Returns
+        -------
+        Segment
+            Segment to retrieve, or None if the output cannot take more
+            data yet or every segment left is waiting to be retried.
 
-        TODO: test can_segment == false
         """
+        now = time.time()
+        for i, segment in enumerate(self.queued):
+            if segment.not_before <= now:
+                return self.queued.pop(i)
+        if not self.unassigned:
+            return None
 
-        (eurl, size, can_segment) = _check_headers(req_url)
-        if output is None:
-            output = os.path.split(eurl)[1]
+        first = self.unassigned[0]
+        end = min(first[1], first[0] + chunk_size - 1)
+        limit = self.sink.limit() if self.sink is not None else None
+        if limit is not None:
+            if first[0] > limit:
+                return None
+            end = min(end, limit)
+        segment = self.new_segment(first[0], end)
+        if end == first[1]:
+            self.unassigned.pop(0)
+        else:
+            first[0] = end + 1
+        return segment
 
-        if len(output) < 1:
-            raise RuntimeError(
-                "Output file must be provided if URL points " "to a directory."
+    def record_rate(self, rate):
+        """Fold the throughput of a finished request into the running rate."""
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate = 0.7 * self.rate + 0.3 * rate
+
+    def checkpoint(self, c, force=False):
+        """
+        Flush the bytes buffered by a connection and record them in the
+        journal.
+
+        Parameters
+        ----------
+        c : Connection
+            connection working on this transfer.
+        force : bool, optional
+            If true, write the journal to disk immediately.
+
+        """
+        c.flush()
+        if self.journal is None or not c.segment.downloaded:
+            return
+        self.journal.record(c.segment.start, c.segment.position - 1)
+        self.journal.save(force)
+
+    def finish(self):
+        """
+        Verify the output, close it and settle the journal once no work
+        remains.
+        """
+        self.finished = True
+        self.ended = time.time()
+        if self.error is None and self.verifier is not None:
+            size = self.size if self.size >= 0 else self.downloaded
+            try:
+                self.verifier.finish(self.sink.read, size)
+            except VerificationError as e:
+                LOG.error("%s: %s", self.output, e)
+                self.error = e
+                # The bytes on disk can't be trusted, so don't resume them.
+                if self.journal is not None:
+                    self.journal.remove()
+                    self.journal = None
+        if self.error is None and self.opened:
+            try:
+                self.sink.finish()
+            except RuntimeError as e:
+                LOG.error("%s: %s", self.output, e)
+                self.error = e
+        self.close()
+        if self.journal is None:
+            if self.error is not None and self.sink is not None:
+                self.sink.discard(isinstance(self.error, VerificationError))
+            return
+        if self.error is None:
+            self.journal.remove()
+        else:
+            self.journal.save()
+
+    @property
+    def unassigned_bytes(self):
+        return sum(r[1] - r[0] + 1 for r in self.unassigned)
+
+    @property
+    def has_work(self):
+        return bool(self.queued or self.unassigned)
+
+    @property
+    def done(self):
+        return not self.has_work and self.active == 0
+
+
+class Scheduler(object):
+    """
+    Hand segments of running transfers to connections as they become free,
+    and settle the outcome of each request.
+
+    The scheduler does not wait on the network itself. Its owner drives the
+    multi handle and passes each finished request back to ``complete``, so
+    the same scheduling serves blocking and event loop driven downloads.
+
+    Parameters
+    ----------
+    downloader : Downloader
+        source of connections and scheduling limits.
+    multi : pycurl.CurlMulti
+        handle requests are added to.
+    on_finish : callable, optional
+        called with each transfer once it has succeeded or failed.
+
+    """
+
+    def __init__(self, downloader, multi, on_finish=None):
+        self.downloader = downloader
+        self.multi = multi
+        self.on_finish = on_finish
+        self.waiting = []
+        self.working = []
+        self.hosts = {}
+
+    def add(self, transfer):
+        """Queue a planned transfer for retrieval."""
+        self.waiting.append(transfer)
+
+    @property
+    def idle(self):
+        return not self.working and not any(t.has_work for t in self.waiting)
+
+    def dispatch(self):
+        """
+        Resume requests whose output has caught up, and start requests until
+        the connection limits are reached.
+        """
+        for c in self.working:
+            if c.held:
+                limit = c.transfer.sink.limit()
+                if limit is None or c.segment.position <= limit:
+                    c.held = False
+                    c.curl.pause(pycurl.PAUSE_CONT)
+
+        dl = self.downloader
+        while len(self.working) < dl.max_requests:
+            work = self._next_work()
+            if work is None:
+                break
+
+            transfer, segment, source = work
+            if transfer.started is None:
+                transfer.started = time.time()
+            if not transfer.opened and not transfer.unprobed:
+                try:
+                    transfer.open()
+                except (IOError, OSError) as e:
+                    self._fail(transfer, e)
+                    continue
+
+            c = dl._acquire()
+            transfer.active += 1
+            self.hosts[source.host] = self.hosts.get(source.host, 0) + 1
+            discover = self._discover if transfer.unprobed else None
+            c.prepare(transfer, segment, source, discover)
+            self.working.append(c)
+            self.multi.add_handle(c.curl)
+            LOG.debug(
+                "%s: Start downloading %d-%s from %s",
+                c.name,
+                segment.position,
+                "" if segment.end is None else segment.end,
+                source.host,
             )
-        LOG.info("Downloading %s, (%d bytes)" % (output, size))
-        segments = self._get_segments(size, can_segment)
 
-        # allocate file space
-        afile = open(output, str("wb"))
-        if size > 0:
-            afile.truncate(size)
-        afile.close()
+    def complete(self, curl, errno=pycurl.E_OK, errmsg=None):
+        """
+        Settle a request which has left the multi handle.
 
-        out_file = open(output, str("r+b"))
-        connections = []
-        for i in range(len(segments)):
-            c = Connection(eurl, can_segment)
-            connections.append(c)
+        Parameters
+        ----------
+        curl : pycurl.Curl
+            handle of the finished request.
+        errno : int, optional
+            libcurl error code.
+        errmsg : str, optional
+            libcurl error message.
 
-        con = {"connections": connections, "free": connections[:], "working": []}
+        """
+        c = curl.connection
+        c.errno = errno
+        c.errmsg = errmsg
+        transfer = c.transfer
+        metrics = c.metrics(errmsg if errno != pycurl.E_OK else None)
+        transfer.requests.append(metrics)
+        self.downloader._emit("request", metrics)
 
-        start_time = time.time()
-        elapsed = None
-        mcurl = pycurl.CurlMulti()
+        if errno == pycurl.E_OK:
+            c.code = curl.getinfo(pycurl.RESPONSE_CODE)
+            if c.discover is not None and (
+                c.code in STATUS_OK or c.code == STATUS_RANGE_NOT_SATISFIABLE
+            ):
+                # No data arrived to prepare the transfer, so the file is
+                # empty.
+                if self._discover(c):
+                    self._succeeded(c)
+                else:
+                    self._release(c)
 
-        while True:
-            while segments and con["free"]:
-                p = segments.pop(0)
-                c = con["free"].pop(0)
-                c.prepare(out_file, p)
-                con["working"].append(c)
-                mcurl.add_handle(c.curl)
-                LOG.debug("%s:Start downloading", c.name)
+            elif c.code in STATUS_OK:
+                self._succeeded(c)
 
-            while True:
-                ret, handles_num = mcurl.perform()
-                if ret != pycurl.E_CALL_MULTI_PERFORM:
-                    break
+            elif c.code in STATUS_ERROR:
+                msg = "%s: Error < %d >! Connection will be closed"
+                LOG.error(msg, c.name, c.code)
+                hold = c.retry_after if c.code in RETRY_AFTER_STATUSES else None
+                self._failed(c, hold, status=c.code)
+                # Settle the segment before the release can finish the transfer.
+                delay = self._retry_delay(c, status=c.code, hold=hold)
+                if transfer.error is not None:
+                    pass
+                elif delay is not None:
+                    c.segment.retried += 1
+                    self._retry_elsewhere(c, delay)
+                else:
+                    self._fail(transfer, "HTTP status %d" % c.code)
+                self._release(c, reuse=False)
 
-            while True:
-                num_q, ok_list, err_list = mcurl.info_read()
-                for curl in ok_list:
-                    curl.errno = pycurl.E_OK
-                    mcurl.remove_handle(curl)
-
-                    c = curl.connection
-                    con["working"].remove(c)
-                    c.errno = curl.errno
-                    c.errmsg = None
-                    c.code = curl.getinfo(pycurl.RESPONSE_CODE)
-
-                    if c.code in STATUS_OK:
-                        LOG.info(
-                            "%s: Download successful. (%d/%d)",
-                            c.name,
-                            c.segment_downloaded,
-                            c.segment_size,
-                        )
-                        con["free"].append(c)
-
-                    elif c.code in STATUS_ERROR:
-                        msg = "%s:Error < %d >! Connection will be closed"
-                        LOG.error(msg.format(c.name, c.code))
-                        con["connections"].remove(c)
-                        c.close()
-                        segments.append(c.segment)
-                        new_c = Connection(c.getopt(pycurl.URL))
-                        con["connections"].append(new_c)
-                        con["free"].append(new_c)
+            else:
+                self._fail(transfer, "Unhandled http status code %d" % c.code)
+                self._release(c)
 
-                    else:
-                        msg = "%s: Unhandled http status code %d"
-                        raise Exception(msg.format(c.name, c.code))
-
-                for curl, errno, errmsg in err_list:
-                    curl.errno = errno
-                    curl.errmsg = errmsg
-                    mcurl.remove_handle(curl)
-
-                    c = curl.connection
-                    c.errno = curl.errno
-                    c.errmsg = curl.errmsg
-                    con["working"].remove(c)
-                    msg = "%s:Download failed < %s >"
-                    LOG.error(msg, c.name, c.errmsg)
-                    if c.can_segment and c.retried < self.max_retry:
-                        c.prepare_retry()
-                        con["working"].append(c)
-                        mcurl.add_handle(c.curl)
-                        LOG.error("%s:Try again", c.name)
-                    else:
-                        raise RuntimeError(c.errmsg)
+        elif errno == pycurl.E_WRITE_ERROR and c.segment.complete:
+            # stopped at a segment end moved by _steal
+            self._succeeded(c)
 
-                if num_q == 0:
-                    break
+        else:
+            LOG.error("%s: Download failed < %s >", c.name, c.errmsg)
+            self._failed(c, errno=errno)
+            transfer.checkpoint(c)
+            delay = self._retry_delay(c, errno=errno)
+            if transfer.error is not None:
+                pass
+            elif delay is not None:
+                # A request which made progress does not count against the
+                # segment.
+                if not c.link_downloaded:
+                    c.segment.retried += 1
+                self._retry_elsewhere(c, delay)
+                LOG.error("%s: Try again in %.1fs", c.name, delay)
+            else:
+                self._fail(transfer, c.errmsg)
+            self._release(c)
+
+    def checkpoint(self, force=False):
+        """Flush working connections and record their progress."""
+        for c in self.working:
+            c.transfer.checkpoint(c, force)
+
+    def cancel(self, transfers, error="Cancelled"):
+        """
+        Stop transfers, keeping their journals so they may be resumed.
+
+        Parameters
+        ----------
+        transfers : list of Transfer
+            transfers to stop.
+        error : str or Exception, optional
+            recorded as the reason each unfinished transfer failed.
+
+        """
+        for transfer in transfers:
+            if not transfer.finished:
+                transfer.error = error
+                transfer.queued = []
+                transfer.unassigned = []
+        for c in self.working[:]:
+            if c.transfer in transfers:
+                self.multi.remove_handle(c.curl)
+                c.transfer.checkpoint(c, force=True)
+                self._release(c)
+        for transfer in transfers:
+            if not transfer.finished and transfer.done:
+                self._finish(transfer)
+
+    def pick_source(self, transfer):
+        """
+        Choose where the next request of a transfer goes.
+
+        Hosts which the retry policy is leaving alone are passed over.
+        Healthy sources are preferred, then those which have not failed
+        since their last success, then the one expected to deliver soonest
+        given its measured rate and the requests its host already serves.
+        A source not yet measured is credited with the best rate seen, so
+        every mirror gets tried. Probe latency breaks ties.
+
+        Parameters
+        ----------
+        transfer : Transfer
+            transfer needing a source.
+
+        Returns
+        -------
+        Source
+            the source to use, or None if every host is at its request limit
+            or being left alone.
 
-            elapsed = time.time() - start_time
-            downloaded = sum(
-                [connection.total_downloaded for connection in connections]
+        """
+        policy = self.downloader.retry
+        available = [
+            s for s in transfer.sources if policy.blocked_until(s.host) is None
+        ]
+        candidates = [s for s in available if s.healthy] or available
+        rates = [s.rate for s in candidates if s.rate]
+        default = max(rates) if rates else 1.0
+        best = None
+        best_key = None
+        for source in candidates:
+            active = self.hosts.get(source.host, 0)
+            if active >= self.downloader.max_host_requests:
+                continue
+            key = (
+                source.failures,
+                (active + 1) / (source.rate or default),
+                source.latency or 0,
             )
-            _show_progress(size, downloaded, elapsed)
+            if best is None or key < best_key:
+                best = source
+                best_key = key
+        return best
 
-            if not con["working"]:
-                break
+    def next_wakeup(self):
+        """
+        When a retry falls due or a host may be used again, if work is
+        waiting on either.
 
-            mcurl.select(1.0)
+        Returns
+        -------
+        float
+            time.time() of the next wakeup, or None if nothing is waiting.
 
-        msg = "Download Succeeded! Total Elapsed {}s".format(elapsed)
-        LOG.info(msg)
+        """
+        now = time.time()
+        policy = self.downloader.retry
+        times = []
+        for transfer in self.waiting:
+            times += [s.not_before for s in transfer.queued]
+            if transfer.has_work:
+                times += [policy.blocked_until(s.host) or 0 for s in transfer.sources]
+        times = [t for t in times if t > now]
+        return min(times) if times else None
 
-    def _get_segments(self, file_size, can_segment):
+    def _discover(self, c):
         """
-        Calculate segements to request.
+        Prepare a transfer which was not probed from the headers of the
+        response to its first request, before any data is kept. A segmented
+        request is cut down to the first segment, leaving the rest of the
+        file to other connections.
 
         Parameters
         ----------
-        file_size : int
-            Lenght of file in bytes.
-        can_segment: : bool
-            If true, remote server supports segmented downloads.
+        c : Connection
+            connection which made the first request.
 
         Returns
         -------
-        bytearray
-            A two-dimensional array of segments to download.
-
-        """
-        if can_segment:
-            num = self.max_con
-            while num * self.min_seg_size > file_size and num > 1:
-                num -= 1
-            segment_size = int(file_size / num + 0.5)
-            segments = [
-                [i, i * segment_size, (i + 1) * segment_size - 1] for i in range(num)
-            ]
-            segments[-1][2] = file_size - 1
+        bool
+            True if the request should carry on.
+
+        """
+        transfer = c.transfer
+        segment = c.segment
+        dl = self.downloader
+        raw = b"".join(c.headers).decode("iso-8859-1")
+        c.discover = None
+        transfer.unprobed = False
+        try:
+            code, probe = _response_probe(c.source.url, raw)
+            dl._remember(c.source.url, probe)
+            dl._apply_probes(transfer, [(code, None, probe)])
+            if not transfer.skipped:
+                if transfer.can_segment:
+                    dl._plan_segments(transfer)
+                transfer.open()
+        except Exception as e:
+            LOG.error("Cannot retrieve %s: %s", transfer.req_url, e)
+            self._fail(transfer, e)
+        if transfer.error is not None or transfer.skipped:
+            segment.end = segment.position - 1
+            return False
+
+        if not transfer.can_segment:
+            # The response carries the whole file.
+            segment.end = _last_byte(transfer)
+            c.discovered(False)
+            return True
+
+        # Keep the first segment, unless a journal shows it is done.
+        first = transfer.unassigned[0] if transfer.unassigned else None
+        kept = None
+        if first is not None and first[0] == segment.position:
+            kept = transfer.next_segment(dl._chunk_size(transfer, c.source))
+        if transfer.has_work and transfer not in self.waiting:
+            self.waiting.append(transfer)
+        if kept is None:
+            segment.end = segment.position - 1
+            return False
+        segment.end = kept.end
+        c.discovered(True)
+        return True
+
+    def _next_work(self):
+        for transfer in self.waiting[:]:
+            if not transfer.has_work:
+                self.waiting.remove(transfer)
+                continue
+            source = self.pick_source(transfer)
+            if source is not None:
+                chunk_size = None
+                if transfer.unassigned:
+                    chunk_size = self.downloader._chunk_size(transfer, source)
+                segment = transfer.next_segment(chunk_size)
+                if segment is not None:
+                    return transfer, segment, source
+
+        return self.downloader._steal(self)
+
+    def _requeue(self, transfer, segment):
+        transfer.queued.append(segment)
+        if transfer not in self.waiting:
+            self.waiting.append(transfer)
+
+    def _retry_delay(self, c, status=None, errno=None, hold=None):
+        """
+        Seconds before a failed request is tried again, or None if it
+        should not be.
+        """
+        policy = self.downloader.retry
+        if c.segment.retried >= policy.max_retry:
+            return None
+        if not policy.retryable(status, errno):
+            return None
+        return policy.delay(c.segment.retried, hold)
+
+    def _failed(self, c, hold=None, status=None, errno=None):
+        """Record a failed request against its source and host."""
+        c.source.failures += 1
+        self.downloader.retry.failure(c.source.host, hold, status, errno)
+
+    def _retry_elsewhere(self, c, delay=0):
+        """
+        Requeue the segment of a failed request for any source to pick up
+        once delay seconds have passed.
+        """
+        c.flush()
+        transfer = c.transfer
+        segment = c.segment
+        segment.not_before = time.time() + delay
+        transfer.retries += 1
+        if not c.can_segment and segment.downloaded:
+            if transfer.can_resume:
+                LOG.info("%s: Resuming from byte %d", c.name, segment.position)
+            else:
+                # Without ranges the file must be retrieved again from the
+                # start.
+                transfer.rewind(segment)
+        self._requeue(transfer, segment)
+
+    def _release(self, c, reuse=True):
+        c.flush()
+        transfer = c.transfer
+        self.working.remove(c)
+        self.hosts[c.source.host] -= 1
+        transfer.active -= 1
+        if reuse:
+            self.downloader._release(c)
         else:
-            segments = [file_size]
+            c.close()
+        if transfer.done:
+            self._finish(transfer)
+
+    def _fail(self, transfer, error):
+        LOG.error("%s: Download failed < %s >", transfer.output, error)
+        transfer.error = error
+        transfer.queued = []
+        transfer.unassigned = []
+        if transfer.done:
+            self._finish(transfer)
+
+    def _succeeded(self, c):
+        transfer = c.transfer
+        segment = c.segment
+        LOG.info(
+            "%s: Download successful. (%d/%s)",
+            c.name,
+            segment.downloaded,
+            "?" if segment.size is None else segment.size,
+        )
+        rate = c.rate(time.time())
+        transfer.record_rate(rate)
+        c.source.record_rate(rate)
+        c.source.failures = 0
+        self.downloader.retry.success(c.source.host)
+        transfer.checkpoint(c)
+        if c.can_segment and not segment.complete and transfer.error is None:
+            LOG.info("%s: Short response, requeueing remainder", c.name)
+            self._requeue(transfer, segment)
+        self._release(c)
 
-        LOG.debug("Using %d segments.", len(segments))
-        return segments
+    def _finish(self, transfer):
+        transfer.finish()
+        if transfer.error is not None:
+            self.downloader._forget(transfer)
+        cache = transfer.cache
+        if transfer.error is None and cache is not None and transfer.to_file:
+            cache.update(
+                transfer.req_url,
+                transfer.output,
+                transfer.size,
+                transfer.etag,
+                transfer.last_modified,
+                local_size=os.path.getsize(transfer.output),
+                decompress=self.downloader.decompress,
+            )
+        self.downloader._report(transfer)
+        if self.on_finish is not None:
+            self.on_finish(transfer)
 
 
-def _check_headers(url):
+class SelectorDriver(object):
     """
-    Request and parse file headers in preparation of file retireval.
+    Drive a multi handle with socket_action, blocking on the sockets and
+    timeout libcurl asks for rather than polling.
 
     Parameters
     ----------
-    url : str
-        URL of the file to be retrieved.
+    multi : pycurl.CurlMulti
+        handle to drive.
 
-    Returns
-    -------
-    (str, str, str)
-        Three-tuple of effective URL, size of the file in bytes, and true if
-        the remote server supports segmented downloads.
     """
-    headers = BytesIO()
-    curl = pycurl.Curl()
-    curl.setopt(pycurl.FOLLOWLOCATION, 1)
-    curl.setopt(pycurl.MAXREDIRS, 5)
-    curl.setopt(pycurl.CONNECTTIMEOUT, 30)
-    curl.setopt(pycurl.TIMEOUT, 300)
-    curl.setopt(pycurl.NOSIGNAL, 1)
-    curl.setopt(pycurl.NOPROGRESS, 1)
-    curl.setopt(pycurl.NOBODY, 1)
-    curl.setopt(pycurl.HEADERFUNCTION, headers.write)
-    curl.setopt(pycurl.URL, url)
 
-    curl.perform()
-    response_code = curl.getinfo(pycurl.RESPONSE_CODE)
-    if curl.errstr() or response_code not in STATUS_OK:
-        msg = "Cannot retrieve %s. (%s)".format(url, pycurl.RESPONSE_CODE)
-        raise RuntimeError(msg)
+    def __init__(self, multi):
+        self.multi = multi
+        self.selector = selectors.DefaultSelector()
+        self.deadline = None
+        multi.setopt(pycurl.M_SOCKETFUNCTION, self._socket_cb)
+        multi.setopt(pycurl.M_TIMERFUNCTION, self._timer_cb)
 
-    eurl = curl.getinfo(pycurl.EFFECTIVE_URL)
-    size = int(curl.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD))
-    headers = headers.getvalue().decode("UTF-8")
-    can_segment = headers.find("Accept-Ranges") != -1
-    if size < 1:
-        can_segment = False
+    def close(self):
+        self.selector.close()
+
+    def _socket_cb(self, what, fd, multi, socketp):
+        registered = fd in self.selector.get_map()
+        if what == pycurl.POLL_REMOVE:
+            if registered:
+                self.selector.unregister(fd)
+            return
 
-    return (eurl, size, can_segment)
+        events = POLL_EVENTS[what]
+        if registered:
+            self.selector.modify(fd, events)
+        else:
+            self.selector.register(fd, events)
 
+    def _timer_cb(self, timeout_ms):
+        if timeout_ms < 0:
+            self.deadline = None
+        else:
+            self.deadline = time.time() + timeout_ms / 1000.0
 
-def _show_progress(size, downloaded, elapsed):
-    if not sys.stdout.isatty():
-        return
+    def wait(self, timeout):
+        """
+        Wait for socket activity or the libcurl timeout, and let libcurl act
+        on it.
 
-    percent = min(100, downloaded * 100 / size)
-    if elapsed != 0:
-        rate = downloaded * 1.0 / 1024.0 / elapsed
-        info = " D / L:%d / %d ( % 6.2f%%) - Avg:%4.1fkB / s" % (
-            downloaded,
-            size,
-            percent,
-            rate,
-        )
-        space = " " * (60 - len(info))
+        Parameters
+        ----------
+        timeout : float
+            longest time to wait, in seconds.
+
+        """
+        if self.deadline is not None:
+            timeout = max(0, min(timeout, self.deadline - time.time()))
+        for key, mask in self.selector.select(timeout):
+            action = 0
+            if mask & selectors.EVENT_READ:
+                action |= pycurl.CSELECT_IN
+            if mask & selectors.EVENT_WRITE:
+                action |= pycurl.CSELECT_OUT
+            self._socket_action(key.fd, action)
+        if self.deadline is not None and self.deadline <= time.time():
+            self.deadline = None
+            self._socket_action(pycurl.SOCKET_TIMEOUT, 0)
+
+    def _socket_action(self, fd, action):
+        while True:
+            ret, running = self.multi.socket_action(fd, action)
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
 
-        prog_len = int(percent * 20 / 100)
-        prog = "|" + "o" * prog_len + "." * (20 - prog_len) + "|"
+    def messages(self):
+        """
+        Collect finished requests, removing them from the multi handle.
+
+        Returns
+        -------
+        list of (pycurl.Curl, int, str)
+            handle, libcurl error code and error message of each request.
 
-        sys.stdout.write(info + space + prog)
-        sys.stdout.flush()
-        sys.stdout.write("\b" * 82)
+        """
+        finished = []
+        while True:
+            num_q, ok_list, err_list = self.multi.info_read()
+            for curl in ok_list:
+                finished.append((curl, pycurl.E_OK, None))
+            for curl, errno, errmsg in err_list:
+                finished.append((curl, errno, errmsg))
+            if num_q == 0:
+                break
+        for curl, errno, errmsg in finished:
+            self.multi.remove_handle(curl)
+        return finished
 
 
-def fetch(req_url, output=None):
+class Downloader(object):
     """
-    Fetch a single URL using default settings.
+    Download files, possibly in segments.
+
+    Curl handles are kept in a pool and reused across calls to ``fetch`` and
+    ``fetch_many``, and share DNS, TLS session and connection caches, so
+    repeated requests to the same host reuse open connections. Call ``close``,
+    or use the downloader as a context manager, to release them. A downloader
+    is not safe to share between threads.
+
+    A file whose length is not known up front, such as a chunked response
+    from a server generating it on the fly, is retrieved over a single
+    connection. If the request breaks off and the server takes ranges, the
+    retry carries on from the last byte received, sending If-Range so a file
+    which has changed is retrieved again from the start. A stream of such a
+    file is held back while its consumer is ``reorder_buffer`` bytes behind.
+
+    Parameters
+    ----------
+    max_retry : int, optional
+        Maximum attempts that will be made to retrieve a segment, when no
+        retry policy is given.
+    min_seg_size : int, optional
+        Largest file size, in bytes, that will not trigger segmenting.
+    max_con : int, optional
+        Maximum number of concurrent connections to a single remote server.
+    max_total_con : int, optional
+        Maximum number of concurrent connections across all remote servers.
+    http2 : bool or str, optional
+        If true, ask for HTTP/2 over TLS and multiplex up to max_streams
+        requests over each connection, so many small files share a few
+        connections. "prior-knowledge" speaks cleartext HTTP/2 (h2c) to
+        servers known to support it. Servers which do not negotiate HTTP/2
+        over TLS are spoken to in HTTP/1.1.
+    max_streams : int, optional
+        Maximum number of concurrent requests over one HTTP/2 connection.
+    resume : bool, optional
+        If true, keep a journal of completed segments in a .journal file
+        next to each output and use it to resume an interrupted download.
+        Off by default, so nothing but the output is written.
+    cache : str, optional
+        filename, possibly with path, of a metadata cache. If provided, the
+        ETag, Last-Modified and size of each download are remembered and
+        files which have not changed on the server are not retrieved again.
+    probe : bool, optional
+        If false, a file with a single source is not probed before it is
+        retrieved. Its first request asks for the whole file as a range,
+        and the size, range support and validators are learned from the
+        response, saving a round trip per file. Files with an entry in the
+        metadata cache are still probed, conditionally.
+    probe_ttl : float, optional
+        Seconds the result of a probe is remembered, so a file fetched again
+        within that time is not probed again. 0 remembers nothing.
+    rate : int or TokenBucket, optional
+        Maximum bytes per second across all transfers, or a token bucket
+        shared with other downloaders, such as a SharedTokenBucket drawn on
+        by several worker processes.
+    host_rate : int, optional
+        Maximum bytes per second from a single remote server.
+    verify : bool, optional
+        If true, check each download against any checksums advertised in
+        Digest, Repr-Digest, Content-MD5 or x-goog-hash headers. Checksums
+        passed to fetch or fetch_many are always checked, and a file which
+        fails its checksum is removed.
+    reorder_buffer : int, optional
+        Most bytes held for each streamed download while waiting for earlier
+        data. Segments are only requested this far ahead of the data
+        delivered.
+    decompress : bool, optional
+        If true, decompress gzip, bzip2 and xz files while they are
+        retrieved, recognised by Content-Encoding, Content-Type or suffix.
+        The suffix is dropped from default filenames. Segments are
+        decompressed in order once the data before them has arrived, and
+        checksums apply to the compressed data. Decompressed files are
+        remembered in the metadata cache, but are not resumed.
+    accept_encoding : bool, optional
+        If true and decompress is set, ask servers to compress responses.
+        Compressed responses are retrieved over a single connection.
+    hooks : list of MetricsHook, optional
+        receive the measurements of each request and the result of each
+        file, such as a PrometheusExporter or StatsdExporter.
+    retry : RetryPolicy, optional
+        when failed requests are tried again. Share one policy between
+        downloaders to share what they learn about failing hosts.
+    allocation : str, optional
+        how space is set aside for each file: "sparse", or "fallocate" to
+        reserve every block up front so files do not fragment.
+    write_mode : str, optional
+        how files are written: "buffered", "dontneed" to drop written pages
+        from the page cache, or "direct" to bypass it with O_DIRECT. The
+        last two keep large downloads from evicting other cached data.
+    atomic : bool, optional
+        If true, write each file under a hidden temporary name in the same
+        directory and rename it into place once it is synced and verified,
+        so watchers never see a partial file. Hooks hear of each file as
+        soon as it is in place.
+    progress : ProgressSink or list of ProgressSink, optional
+        where the progress of each batch is shown, such as a TtyProgress,
+        LogProgress or JsonProgress. By default progress is drawn on stdout
+        if it is a terminal. An empty list shows nothing.
+    progress_updates : float, optional
+        most progress updates a second. Progress is sampled from a separate
+        thread, so the transfer loop does not wait on it.
+
+    """
+
+    def __init__(
+        self,
+        max_retry=DEFAULT_MAX_RETRY,
+        min_seg_size=DEFAULT_MIN_SEG_SIZE,
+        max_con=DEFAULT_MAX_CON,
+        max_total_con=DEFAULT_MAX_TOTAL_CON,
+        resume=False,
+        cache=None,
+        rate=None,
+        host_rate=None,
+        verify=False,
+        reorder_buffer=DEFAULT_REORDER_BUFFER,
+        decompress=False,
+        accept_encoding=False,
+        hooks=None,
+        retry=None,
+        allocation="sparse",
+        write_mode="buffered",
+        atomic=False,
+        http2=False,
+        max_streams=DEFAULT_MAX_STREAMS,
+        probe=True,
+        probe_ttl=0,
+        progress=None,
+        progress_updates=DEFAULT_UPDATES,
+    ):
+        if allocation not in ALLOCATIONS:
+            raise ValueError("Unknown allocation {}".format(allocation))
+        if write_mode not in WRITE_MODES:
+            raise ValueError("Unknown write mode {}".format(write_mode))
+        self.min_seg_size = min_seg_size
+        self.retry = retry or RetryPolicy(max_retry)
+        self.max_retry = self.retry.max_retry
+        self.max_con = max_con
+        self.max_total_con = max(max_con, max_total_con)
+        self.max_streams = max_streams
+        self._http_version = None
+        if http2:
+            if http2 not in HTTP2_VERSIONS:
+                raise ValueError("Unknown HTTP/2 mode {}".format(http2))
+            if pycurl.version_info()[4] & pycurl.VERSION_HTTP2:
+                self._http_version = HTTP2_VERSIONS[http2]
+            else:
+                LOG.warning("libcurl is built without HTTP/2, using HTTP/1.1.")
+        streams = max_streams if self._http_version is not None else 1
+        self.max_host_requests = max_con * streams
+        self.max_requests = self.max_total_con * streams
+        self.resume = resume
+        self.cache = MetadataCache(cache) if cache else None
+        self.probe = probe
+        self._probe_cache = ProbeCache(probe_ttl) if probe_ttl > 0 else None
+        self.verify = verify
+        self.reorder_buffer = reorder_buffer
+        self.decompress = decompress
+        self.hooks = list(hooks or [])
+        if progress is None:
+            progress = [TtyProgress()]
+        elif isinstance(progress, ProgressSink):
+            progress = [progress]
+        self.progress = ProgressReporter(progress, progress_updates)
+        self.allocation = allocation
+        self.write_mode = write_mode
+        self.atomic = atomic
+        self._encoding = None
+        if decompress and accept_encoding:
+            self._encoding = ACCEPT_ENCODING
+        self._throttle = None
+        if rate or host_rate:
+            self._throttle = Throttle(rate, host_rate)
+        self._pool = []
+        self._share = _create_share()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close all pooled connections."""
+        while self._pool:
+            self._pool.pop().close()
+        if self._share is not None:
+            self._share.close()
+            self._share = None
+
+    def _acquire(self):
+        """Take a connection from the pool, creating one if needed."""
+        if self._pool:
+            return self._pool.pop()
+        if self._share is None:
+            self._share = _create_share()
+        return Connection(
+            self._share, self._throttle, self._encoding, self._http_version
+        )
+
+    def _release(self, c):
+        """Return a connection to the pool for later reuse."""
+        if len(self._pool) < self.max_requests:
+            self._pool.append(c)
+        else:
+            c.close()
+
+    def fetch(self, req_url, output=None, checksum=None):
+        """
+        Fetch a file.
+
+        Parameters
+        ----------
+        req_url : str or list of str
+            URL of the file to retrieve, or URLs of mirrors holding the same
+            file, preferred mirror first. Mirrors are probed in parallel and
+            segments are spread across them by measured throughput. A
+            segment which fails on one mirror is retried on another.
+        output : str, bytearray, memoryview, file-like or callable, optional
+            filename, possibly with path, of the downloaded file. A bytearray
+            is resized and filled with the file, and a writable memoryview
+            is filled. Data is written in order to an object with a write
+            method, or passed in order to a callable, and nothing touches
+            the disk.
+        checksum : str or dict, optional
+            expected checksum, as "algorithm:hexdigest" or a dict of
+            algorithm to hex digest. md5, sha256, crc32 and crc32c are
+            supported. Computed while the file is written.
+
+        Returns
+        -------
+        str or object
+            filename of the downloaded file, or output if it is not a
+            filename.
+
+        """
+        checksums = None if checksum is None else [checksum]
+        return self.fetch_many([req_url], [output], checksums)[0]
+
+    def fetch_many(self, urls, outputs=None, checksums=None):
+        """
+        Fetch several files over a single shared set of connections.
+
+        Segments from every file are queued on one ``pycurl.CurlMulti``
+        handle. No more than ``max_con`` connections are opened to any one
+        host and no more than ``max_total_con`` connections are open at once.
+        Over HTTP/2, up to ``max_streams`` requests share each connection.
+        A file that cannot be retrieved does not stop the rest of the batch.
+
+        Parameters
+        ----------
+        urls : list
+            URLs of the files to retrieve. An entry may be a list of mirror
+            URLs, as accepted by ``fetch``.
+        outputs : list, optional
+            filenames, possibly with path, of the downloaded files, or other
+            outputs as accepted by ``fetch``. Must be the same length as
+            ``urls`` if provided. A None entry is replaced with the last
+            component of the effective URL.
+        checksums : list, optional
+            expected checksums, as accepted by ``fetch``. Must be the same
+            length as ``urls`` if provided. A None entry is not checked
+            unless the server advertises a checksum and ``verify`` is set.
+
+        Returns
+        -------
+        list
+            filenames of the downloaded files, or the outputs given, in the
+            same order as ``urls``.
+
+        Raises
+        ------
+        RuntimeError
+            if any file could not be retrieved.
+
+        """
+        transfers = self._transfers(urls, outputs, checksums)
+        start_time = time.time()
+        for _ in self._run(transfers):
+            pass
+        return self._settle(transfers, time.time() - start_time)
+
+    def retrieve(self, req_url, output=None, checksum=None):
+        """
+        Fetch a file, reporting how it went rather than raising on failure.
+
+        Takes the same parameters as ``fetch``.
+
+        Returns
+        -------
+        TransferResult
+            outcome of the file, with the timings of every request.
+
+        """
+        checksums = None if checksum is None else [checksum]
+        return self.retrieve_many([req_url], [output], checksums)[0]
+
+    def retrieve_many(self, urls, outputs=None, checksums=None):
+        """
+        Fetch several files, reporting how each went rather than raising on
+        failure.
+
+        Takes the same parameters as ``fetch_many``.
+
+        Returns
+        -------
+        list of TransferResult
+            outcome of each file, in the same order as ``urls``.
+
+        """
+        transfers = self._transfers(urls, outputs, checksums)
+        start_time = time.time()
+        for _ in self._run(transfers):
+            pass
+        return self._results(transfers, time.time() - start_time)
+
+    def stream(self, req_url, checksum=None):
+        """
+        Retrieve a file as a sequence of chunks, in order, without writing
+        it to disk.
+
+        Segments are retrieved concurrently, if the server allows, within
+        ``reorder_buffer`` bytes of the data already yielded. The download
+        only advances while the caller asks for more.
+
+        Parameters
+        ----------
+        req_url : str or list of str
+            URL of the file to retrieve, or URLs of mirrors, as accepted by
+            ``fetch``.
+        checksum : str or dict, optional
+            expected checksum, as accepted by ``fetch``. It can only be
+            checked once every chunk has been yielded.
+
+        Yields
+        ------
+        bytes
+            the next chunk of the file.
+
+        Raises
+        ------
+        RuntimeError
+            if the file could not be retrieved or failed verification.
+
+        """
+        chunks = collections.deque()
+        sink = StreamSink(chunks.append, self.reorder_buffer)
+        checksums = None if checksum is None else [checksum]
+        transfers = self._transfers([req_url], [sink], checksums)
+        start_time = time.time()
+        run = self._run(transfers)
+        try:
+            for _ in run:
+                while chunks:
+                    yield chunks.popleft()
+        finally:
+            run.close()
+        while chunks:
+            yield chunks.popleft()
+        self._settle(transfers, time.time() - start_time)
+
+    def sync(self, index_url, local_dir, recursive=True):
+        """
+        Mirror a directory listing into a local directory, retrieving only
+        the files which are new or have changed since the last sync.
+
+        Listings in the style of Apache and nginx are parsed as they arrive,
+        so memory use follows the files changed in a directory rather than
+        the size of its listing. An index in local_dir records the size,
+        modification time and validators of each local copy, and the date
+        and size each file was listed with. A file listed as before whose
+        local copy is untouched costs no request. Other files are probed,
+        conditionally if they were seen before, and those new or changed are
+        retrieved together, a directory at a time.
+
+        Parameters
+        ----------
+        index_url : str
+            URL of the directory listing.
+        local_dir : str
+            directory to mirror into, created if needed.
+        recursive : bool, optional
+            If true, mirror subdirectories too.
+
+        Returns
+        -------
+        list of TransferResult
+            outcome of each file probed or retrieved. Files found unchanged
+            by their probe are marked skipped.
+
+        Raises
+        ------
+        RuntimeError
+            if the listing at index_url cannot be retrieved.
+
+        """
+        plan = SyncPlan(index_url, local_dir, recursive, self.decompress)
+        results = []
+        top = url = plan.next_directory()
+        while url is not None:
+            parser = ListingParser(url)
+            try:
+                for chunk in self.stream(url):
+                    plan.add(parser.parse(chunk))
+            except RuntimeError as e:
+                if url == top:
+                    raise
+                LOG.error("Cannot list %s: %s", url, e)
+            plan.add(parser.parse(b"", final=True))
+            results += self._sync_changed(plan)
+            url = plan.next_directory()
+        plan.finish(results)
+        return results
+
+    def _sync_changed(self, plan):
+        """Retrieve the files of a sync found to be new or changed."""
+        urls, outputs = plan.take()
+        if not urls:
+            return []
+        transfers = self._transfers(urls, outputs, cache=plan.index)
+        start_time = time.time()
+        for _ in self._run(transfers):
+            pass
+        results = self._results(transfers, time.time() - start_time)
+        plan.retrieved(results)
+        return results
+
+    def _run(self, transfers):
+        """
+        Retrieve a batch of transfers, yielding each time the network has
+        been serviced.
+
+        Parameters
+        ----------
+        transfers : list of Transfer
+            transfers to retrieve. Any failure is recorded on the transfer.
+
+        """
+        self._prepare_all(transfers)
+
+        fetching = [t for t in transfers if t.error is None and not t.skipped]
+        mcurl = self._create_multi()
+        scheduler = Scheduler(self, mcurl)
+        for transfer in fetching:
+            self._plan_segments(transfer)
+            scheduler.add(transfer)
+
+        start_time = time.time()
+        checkpointed = 0
+        driver = SelectorDriver(mcurl)
+        self.progress.add(fetching)
+        try:
+            while True:
+                scheduler.dispatch()
+                if scheduler.idle:
+                    break
+
+                elapsed = time.time() - start_time
+                if elapsed - checkpointed >= SAVE_INTERVAL:
+                    scheduler.checkpoint()
+                    checkpointed = elapsed
+
+                timeout = max(0, checkpointed + SAVE_INTERVAL - elapsed)
+                if self._throttle is not None:
+                    timeout = min(timeout, _resume_paused(scheduler.working))
+                wakeup = scheduler.next_wakeup()
+                if wakeup is not None:
+                    timeout = min(timeout, wakeup - time.time())
+                driver.wait(timeout)
+                for curl, errno, errmsg in driver.messages():
+                    scheduler.complete(curl, errno, errmsg)
+                yield
+        except BaseException:
+            scheduler.cancel(fetching)
+            for transfer in transfers:
+                transfer.close()
+            raise
+        finally:
+            driver.close()
+            mcurl.close()
+            self.progress.remove(fetching)
+
+    def _transfers(self, urls, outputs=None, checksums=None, cache=None):
+        """
+        Build the transfers of a batch, checking the arguments line up.
+        Transfers are checked against the downloader's metadata cache unless
+        another is given.
+        """
+        if outputs is None:
+            outputs = [None] * len(urls)
+        if checksums is None:
+            checksums = [None] * len(urls)
+        if len(outputs) != len(urls) or len(checksums) != len(urls):
+            raise ValueError("urls, outputs and checksums must be the same length.")
+
+        cache = cache or self.cache
+        return [
+            Transfer(
+                url,
+                create_sink(output, self.reorder_buffer) or output,
+                checksum,
+                cache,
+            )
+            for url, output, checksum in zip(urls, outputs, checksums)
+        ]
+
+    def _emit(self, event, value):
+        """Pass a RequestMetrics or TransferResult to each hook."""
+        for hook in self.hooks:
+            try:
+                getattr(hook, event)(value)
+            except Exception:
+                LOG.exception("Metrics hook %r failed", hook)
+
+    def _create_multi(self):
+        """Create a multi handle which enforces the connection limits."""
+        mcurl = pycurl.CurlMulti()
+        mcurl.setopt(pycurl.M_MAX_HOST_CONNECTIONS, self.max_con)
+        mcurl.setopt(pycurl.M_MAX_TOTAL_CONNECTIONS, self.max_total_con)
+        if self._http_version is not None:
+            mcurl.setopt(pycurl.M_PIPELINING, pycurl.PIPE_MULTIPLEX)
+            try:
+                mcurl.setopt(pycurl.M_MAX_CONCURRENT_STREAMS, self.max_streams)
+            except (AttributeError, pycurl.error):
+                LOG.debug("libcurl cannot limit concurrent streams.")
+        return mcurl
+
+    def _results(self, transfers, elapsed):
+        """
+        Save the cache, report the outcome of a batch and pass the result of
+        each file not yet reported to the hooks.
+
+        Parameters
+        ----------
+        transfers : list of Transfer
+            every transfer of the batch.
+        elapsed : float
+            seconds spent retrieving the batch.
+
+        Returns
+        -------
+        list of TransferResult
+            outcome of each file.
+
+        """
+        for cache in set(t.cache for t in transfers if t.cache is not None):
+            cache.save()
+
+        failed = [t for t in transfers if t.error is not None]
+        msg = "Downloaded {} of {} files. Total Elapsed {}s".format(
+            len(transfers) - len(failed), len(transfers), elapsed
+        )
+        LOG.info(msg)
+
+        return [self._report(t) for t in transfers]
+
+    def _report(self, transfer):
+        """
+        Pass the result of a transfer to the hooks, once, as soon as it is
+        settled.
+
+        Returns
+        -------
+        TransferResult
+            outcome of the transfer.
+
+        """
+        if transfer.result is None:
+            transfer.result = TransferResult(
+                transfer.req_url,
+                eurl=transfer.eurl,
+                output=transfer.target,
+                size=transfer.size,
+                downloaded=transfer.downloaded,
+                elapsed=transfer.elapsed,
+                error=transfer.error,
+                skipped=transfer.skipped,
+                resumed=transfer.resumed,
+                retries=transfer.retries,
+                requests=transfer.requests,
+            )
+            self._emit("transfer", transfer.result)
+        return transfer.result
+
+    def _settle(self, transfers, elapsed):
+        """
+        Report the outcome of a batch, as _results does, raising if any file
+        failed.
+
+        Parameters
+        ----------
+        transfers : list of Transfer
+            every transfer of the batch.
+        elapsed : float
+            seconds spent retrieving the batch.
+
+        Returns
+        -------
+        list
+            filenames of the downloaded files, or the outputs given.
+
+        Raises
+        ------
+        RuntimeError
+            if any file could not be retrieved.
+
+        """
+        self._results(transfers, elapsed)
+        failed = [t for t in transfers if t.error is not None]
+        if failed:
+            errors = ", ".join(
+                "{} ({})".format(t.output or t.req_url, t.error) for t in failed
+            )
+            raise RuntimeError("Download failed: {}".format(errors))
+
+        return [t.target for t in transfers]
+
+    def _conditions(self, transfer):
+        """
+        Conditional request headers for a transfer, from the cache. Mirrors
+        rarely agree on validators, so only single source transfers are
+        probed conditionally.
+        """
+        cache = transfer.cache
+        if cache is None or len(transfer.sources) > 1 or not transfer.to_file:
+            return []
+        return cache.conditional_headers(
+            transfer.req_url, transfer.output, self.decompress
+        )
+
+    def _prepare_all(self, transfers):
+        """
+        Probe the remote servers of a batch and settle on output filenames.
+        The probes of every transfer and mirror are made together, as many
+        at a time as the connection limits allow. If a metadata cache is in
+        use, probes are conditional and transfers of unchanged files are
+        marked as skipped. Any failure is recorded on the transfer.
+
+        Parameters
+        ----------
+        transfers : list of Transfer
+            transfers to prepare
+
+        """
+        planned = []
+        probes = []
+        for transfer in transfers:
+            wanted = self._plan_probes(transfer)
+            if wanted:
+                planned.append((transfer, len(probes), len(probes) + len(wanted)))
+                probes += wanted
+
+        results = self._probe_all(probes) if probes else []
+        for transfer, first, last in planned:
+            self._prepare_probed(transfer, results[first:last])
+
+    def _plan_probes(self, transfer):
+        """
+        Work out the probes a transfer needs. A transfer whose sources were
+        all probed recently is prepared from the probe cache, and one which
+        need not be probed is left to learn about the file from its first
+        request.
+
+        Parameters
+        ----------
+        transfer : Transfer
+            transfer to prepare
+
+        Returns
+        -------
+        list of (str, list of str, bool)
+            URL, conditional request headers and whether to retry, of each
+            probe to make. Empty if the transfer needs no probe.
+
+        """
+        if self._probe_cache is not None:
+            probes = [self._probe_cache.get(s.url) for s in transfer.sources]
+            if None not in probes:
+                LOG.debug("%s: Probed recently", transfer.req_url)
+                self._prepare_probed(transfer, [(200, None, p) for p in probes])
+                return []
+
+        conditions = self._conditions(transfer)
+        if not self.probe and len(transfer.sources) == 1 and not conditions:
+            source = transfer.sources[0]
+            source.eurl = source.url
+            source.host = urlparse(source.url).netloc
+            transfer.unprobed = True
+            return []
+
+        # Mirrors stand in for each other, so only a lone source is retried.
+        retry = len(transfer.sources) == 1
+        return [(s.url, conditions, retry) for s in transfer.sources]
+
+    def _prepare_probed(self, transfer, results):
+        """Prepare a transfer from its probes, recording any failure."""
+        try:
+            self._apply_probes(transfer, results)
+        except Exception as e:
+            LOG.error("Cannot retrieve %s: %s", transfer.req_url, e)
+            transfer.error = e
+
+    def _probe_all(self, probes):
+        """
+        Make several probes at once, no more than max_requests at a time.
+
+        Parameters
+        ----------
+        probes : list of (str, list of str, bool)
+            URL, conditional request headers and whether to probe again
+            after a transient failure, of each probe.
+
+        Returns
+        -------
+        list
+            for each probe, as returned by _probe_outcome.
+
+        """
+        mcurl = self._create_multi()
+        driver = SelectorDriver(mcurl)
+        pending = {}
+        delayed = collections.OrderedDict()
+        attempts = [0 if probe[2] else None for probe in probes]
+        results = [None] * len(probes)
+        try:
+            for i in range(len(probes)):
+                delayed[i] = 0
+
+            while pending or delayed:
+                now = time.time()
+                for i, when in list(delayed.items()):
+                    if len(pending) >= self.max_requests:
+                        break
+                    if when <= now:
+                        del delayed[i]
+                        url, conditions, retry = probes[i]
+                        c = self._acquire()
+                        headers = _start_probe(url, c.curl, conditions)
+                        pending[c.curl] = (i, c, headers)
+                        mcurl.add_handle(c.curl)
+
+                timeout = 1.0
+                later = [when for when in delayed.values() if when > now]
+                if later:
+                    timeout = min(timeout, min(later) - now)
+                driver.wait(timeout)
+                for curl, errno, errmsg in driver.messages():
+                    i, c, headers = pending.pop(curl)
+                    url, conditions, retry = probes[i]
+                    outcome = self._probe_outcome(
+                        c, url, headers, conditions, errno, errmsg, attempts[i]
+                    )
+                    if isinstance(outcome, TransientError):
+                        LOG.warning(
+                            "%s: %s, probing again in %.1fs",
+                            url,
+                            outcome,
+                            outcome.delay,
+                        )
+                        attempts[i] += 1
+                        delayed[i] = time.time() + outcome.delay
+                    else:
+                        results[i] = outcome
+        finally:
+            for curl, (i, c, headers) in pending.items():
+                mcurl.remove_handle(curl)
+                c.close()
+            driver.close()
+            mcurl.close()
+        return results
+
+    def _probe_outcome(self, c, url, headers, conditions, errno, errmsg, attempt=None):
+        """
+        Settle a finished probe, returning its connection to the pool.
+
+        Parameters
+        ----------
+        attempt : int, optional
+            retries already made. If given, a transient failure is returned
+            as a TransientError until the retry policy gives up.
+
+        Returns
+        -------
+        tuple or Exception
+            HTTP status, RequestMetrics of the probe and the tuple returned
+            by _check_headers, or the reason the probe failed.
+
+        """
+        _end_probe(c.curl, conditions)
+        eurl = c.curl.getinfo(pycurl.EFFECTIVE_URL) or url
+        metrics = RequestMetrics.from_curl(
+            c.curl,
+            "probe",
+            url,
+            urlparse(eurl).netloc,
+            error=errmsg if errno != pycurl.E_OK else None,
+        )
+        self._emit("request", metrics)
+        try:
+            if errno != pycurl.E_OK:
+                raise pycurl.error(errno, errmsg)
+            probe = _probe_result(url, c.curl, headers, conditions)
+        except Exception as e:
+            c.close()
+            if errno == pycurl.E_OK:
+                status, errno = metrics.status, None
+            else:
+                status = None
+            if not self.retry.retryable(status, errno):
+                return e
+            hold = None
+            if status in RETRY_AFTER_STATUSES:
+                raw = headers.getvalue().decode("iso-8859-1")
+                retry_after = _parse_headers(raw).get("retry-after")
+                if retry_after is not None:
+                    hold = parse_retry_after(retry_after)
+            self.retry.failure(metrics.host, hold, status, errno)
+            if attempt is None or attempt >= self.retry.max_retry:
+                return e
+            return TransientError(str(e), self.retry.delay(attempt, hold))
+
+        self.retry.success(metrics.host)
+        self._release(c)
+        if metrics.status != STATUS_NOT_MODIFIED:
+            self._remember(url, probe)
+        return (metrics.status, metrics, probe)
+
+    def _remember(self, url, probe):
+        """Keep the result of a probe in the probe cache, if there is one."""
+        if self._probe_cache is not None:
+            self._probe_cache.put(url, probe)
+
+    def _forget(self, transfer):
+        """Drop the sources of a failed transfer from the probe cache."""
+        if self._probe_cache is not None:
+            self._probe_cache.forget(transfer.req_url)
+            for source in transfer.sources:
+                self._probe_cache.forget(source.url)
+
+    def _apply_probes(self, transfer, results):
+        """
+        Prepare a transfer from the responses to its probes. The first
+        source to answer, in the order given, describes the file.
+
+        Parameters
+        ----------
+        transfer : Transfer
+            transfer to prepare
+        results : list
+            for each source, as returned by _probe_outcome.
+
+        Raises
+        ------
+        Exception
+            the reason the first source failed, if every source failed.
+
+        """
+        probed = []
+        errors = []
+        for source, result in zip(transfer.sources, results):
+            if isinstance(result, Exception):
+                if len(transfer.sources) > 1:
+                    LOG.warning("%s: Mirror unavailable < %s >", source.url, result)
+                errors.append(result)
+            else:
+                probed.append((source, result))
+                if result[1] is not None:
+                    transfer.requests.append(result[1])
+        if not probed:
+            raise errors[0]
+
+        (code, metrics, (eurl, size, can_segment, headers)) = probed[0][1]
+        if code == STATUS_NOT_MODIFIED:
+            entry = None
+            if transfer.cache is not None:
+                entry = transfer.cache.lookup(
+                    transfer.req_url, transfer.output, self.decompress
+                )
+            if entry is None:
+                raise RuntimeError("Not modified, but there is no cached copy to keep.")
+            transfer.eurl = eurl
+            transfer.output = entry["output"]
+            transfer.skipped = True
+            LOG.info("%s: Not modified, skipping", transfer.output)
+            return
+
+        codecs = []
+        if self.decompress:
+            codecs = compression(eurl, headers, self._encoding is not None)
+        can_resume = code == STATUS_PARTIAL or _accepts_ranges(headers)
+        if self._encoding is not None and "content-encoding" in headers:
+            # Compressed on request, so ranges may not line up between requests.
+            can_segment = can_resume = False
+
+        transfer.eurl = eurl
+        transfer.size = size
+        transfer.can_segment = can_segment
+        transfer.can_resume = can_resume
+        transfer.etag = headers.get("etag")
+        transfer.last_modified = headers.get("last-modified")
+        if transfer.output is None:
+            transfer.output = os.path.split(eurl)[1]
+            if codecs:
+                transfer.output = decompressed_name(transfer.output)
+
+        if len(transfer.output) < 1:
+            raise RuntimeError(
+                "Output file must be provided if URL points " "to a directory."
+            )
+        if transfer.sink is None:
+            transfer.sink = FileSink(
+                transfer.output, self.allocation, self.write_mode, self.atomic
+            )
+        if codecs:
+            sink = transfer.sink
+            for codec in reversed(codecs):
+                sink = DecompressSink(sink, codec, self.reorder_buffer)
+            transfer.sink = sink
+            LOG.debug("%s: Decompressing %s", transfer.output, ", ".join(codecs))
+        if (
+            transfer.cache is not None
+            and transfer.to_file
+            and transfer.cache.matches(
+                transfer.req_url,
+                transfer.output,
+                size,
+                transfer.etag,
+                transfer.last_modified,
+                self.decompress,
+            )
+        ):
+            transfer.skipped = True
+            LOG.info("%s: Unchanged, skipping", transfer.output)
+            return
+
+        transfer.sources = _usable_mirrors(transfer, probed)
+        if len(transfer.sources) > 1 and _strong_validator(transfer) is None:
+            # Nothing shows that mirrors serve the same bytes past an offset.
+            transfer.can_resume = False
+        LOG.info(
+            "Downloading %s, (%d bytes) from %d source(s)",
+            transfer.output,
+            size,
+            len(transfer.sources),
+        )
+
+        expected = parse_digest_headers(headers) if self.verify else {}
+        expected.update(transfer.checksum)
+        if expected:
+            transfer.verifier = Verifier(expected)
+            LOG.debug("%s: Verifying %s", transfer.output, ", ".join(expected))
+
+        if self.resume and can_segment and transfer.to_file:
+            if codecs:
+                # A decompressor cannot pick up part way through its input.
+                LOG.debug("%s: Cannot resume while decompressing", transfer.output)
+            else:
+                self._prepare_journal(transfer)
+
+    def _prepare_journal(self, transfer):
+        """
+        Start a new journal or pick up the journal of an interrupted attempt.
+
+        Parameters
+        ----------
+        transfer : Transfer
+            transfer to prepare
+
+        """
+        path = transfer.sink.path
+        journal = SegmentJournal.load(path)
+        if (
+            journal is not None
+            and journal.matches(transfer.size, transfer.etag, transfer.last_modified)
+            and os.path.isfile(path)
+            and os.path.getsize(path) == transfer.size
+        ):
+            transfer.resumed = True
+            transfer.downloaded = journal.completed_bytes
+            LOG.info(
+                "Resuming %s, %d bytes already retrieved",
+                transfer.output,
+                transfer.downloaded,
+            )
+        else:
+            if journal is not None:
+                LOG.info("Discarding stale journal for %s", transfer.output)
+            journal = SegmentJournal(
+                path,
+                transfer.eurl,
+                transfer.size,
+                transfer.etag,
+                transfer.last_modified,
+            )
+        transfer.journal = journal
+
+    def _plan_segments(self, transfer):
+        """
+        Lay out the ranges of a transfer still to be retrieved, skipping any
+        ranges recorded as complete by a previous attempt. Segments are carved
+        from these ranges as connections become free.
+
+        Parameters
+        ----------
+        transfer : Transfer
+            transfer to plan
+
+        """
+        if transfer.unprobed:
+            # The end is learned from the response.
+            transfer.queued = [transfer.new_segment(0, -1)]
+            return
+
+        if not transfer.can_segment:
+            transfer.queued = [transfer.new_segment(0, _last_byte(transfer))]
+            return
+
+        if transfer.resumed:
+            transfer.unassigned = transfer.journal.missing(0, transfer.size - 1)
+        else:
+            transfer.unassigned = [[0, transfer.size - 1]]
+        LOG.debug(
+            "%s: %d bytes in %d ranges to retrieve.",
+            transfer.output,
+            transfer.unassigned_bytes,
+            len(transfer.unassigned),
+        )
+
+    def _chunk_size(self, transfer, source):
+        """
+        Size the next segment of a transfer.
+
+        Until a request has completed, a file is split into CHUNKS_PER_CON
+        segments for each allowed connection. After that, segments are sized
+        to take about CHUNK_SECONDS at the per-connection rate measured from
+        the source, or from the transfer if the source is untried. A
+        segment is never smaller than min_seg_size nor larger than an even
+        share of what is left to assign, so the last segments stay small, and
+        a remainder too small to stand on its own is folded into the segment.
+        Streamed transfers share their reorder buffer among max_con segments.
+
+        Parameters
+        ----------
+        transfer : Transfer
+            transfer to size
+        source : Source
+            source the segment will be retrieved from.
+
+        Returns
+        -------
+        int
+            segment size in bytes.
+
+        """
+        rate = source.rate or transfer.rate
+        if rate:
+            chunk = int(rate * CHUNK_SECONDS)
+        else:
+            chunk = int(math.ceil(transfer.size / self.max_con)) // CHUNKS_PER_CON
+        share = int(math.ceil(transfer.unassigned_bytes / self.max_con))
+        chunk = max(self.min_seg_size, min(chunk, share))
+
+        if transfer.unassigned:
+            first = transfer.unassigned[0]
+            left = first[1] - first[0] + 1
+            if left - chunk < self.min_seg_size:
+                chunk = left
+
+        window = transfer.sink.window if transfer.sink is not None else None
+        if window:
+            # Keep every connection busy within the reorder buffer.
+            chunk = min(chunk, max(self.min_seg_size, window // self.max_con))
+        return chunk
+
+    def _steal(self, scheduler):
+        """
+        Give an idle connection part of the segment expected to finish last.
+        Segments expected to finish within STEAL_MIN_SECONDS are left alone,
+        as a new request would gain little.
+
+        The remaining range of the victim is split in proportion to the rate
+        of the victim and the typical rate of the source the new request
+        will use, so that both halves should finish at about the same time.
+        The victim stops when it reaches its new end.
+
+        Parameters
+        ----------
+        scheduler : Scheduler
+            scheduler of the running transfers.
+
+        Returns
+        -------
+        (Transfer, Segment, Source)
+            the transfer, new segment to retrieve and source to retrieve it
+            from, or None if no segment is worth splitting.
+
+        """
+        now = time.time()
+        victim = None
+        victim_eta = 0
+        thief = None
+        for c in scheduler.working:
+            transfer = c.transfer
+            if (
+                not c.can_segment
+                or transfer.error is not None
+                or c.segment.remaining < 2 * self.min_seg_size
+            ):
+                continue
+
+            eta = c.segment.remaining / max(c.rate(now), 1.0)
+            if eta > max(victim_eta, STEAL_MIN_SECONDS):
+                source = scheduler.pick_source(transfer)
+                if source is not None:
+                    victim = c
+                    victim_eta = eta
+                    thief = source
+
+        if victim is None:
+            return None
+
+        transfer = victim.transfer
+        segment = victim.segment
+        victim_rate = max(victim.rate(now), 1.0)
+        thief_rate = thief.rate or transfer.rate or victim_rate
+        keep = int(segment.remaining * victim_rate / (victim_rate + thief_rate))
+        keep = max(self.min_seg_size, min(keep, segment.remaining - self.min_seg_size))
+
+        split = segment.position + keep
+        stolen = transfer.new_segment(split, segment.end)
+        segment.end = split - 1
+        LOG.debug(
+            "%s: Splitting at %d, %d bytes handed off",
+            victim.name,
+            split,
+            stolen.size,
+        )
+        return transfer, stolen, thief
+
+
+def _usable_mirrors(transfer, probed):
+    """
+    Keep the sources which serve the same file as the first, fastest first.
+
+    Parameters
+    ----------
+    transfer : Transfer
+        transfer described by its first source.
+    probed : list of (Source, tuple)
+        sources which answered, with the results of their probes.
+
+    Returns
+    -------
+    list of Source
+    """
+    usable = []
+    for source, (code, metrics, probe) in probed:
+        (eurl, size, can_segment, headers) = probe
+        if size != transfer.size:
+            LOG.warning(
+                "%s: Ignoring mirror, size %d differs from %d",
+                source.url,
+                size,
+                transfer.size,
+            )
+            continue
+        if transfer.can_segment and not can_segment:
+            LOG.warning("%s: Ignoring mirror without range support", source.url)
+            continue
+        source.eurl = eurl
+        source.host = urlparse(eurl).netloc
+        if metrics is not None:
+            source.latency = metrics.total
+        usable.append(source)
+    usable.sort(key=lambda source: source.latency or 0)
+    return usable
+
+
+def _resume_paused(connections):
+    """
+    Resume connections paused by a throttle whose wait has passed.
+
+    Parameters
+    ----------
+    connections : list of Connection
+        working connections.
+
+    Returns
+    -------
+    float
+        seconds until the next paused connection is due, at most one.
+
+    """
+    now = time.time()
+    timeout = 1.0
+    for c in connections:
+        if c.resume_at is None:
+            continue
+        if c.resume_at <= now:
+            c.resume_at = None
+            c.curl.pause(pycurl.PAUSE_CONT)
+        else:
+            timeout = min(timeout, c.resume_at - now)
+    return timeout
+
+
+def _create_share():
+    """
+    Create a share handle for DNS, TLS session and connection caches.
+
+    Returns
+    -------
+    pycurl.CurlShare
+    """
+    share = pycurl.CurlShare()
+    share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+    share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+    try:
+        share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_CONNECT)
+    except (AttributeError, pycurl.error):
+        LOG.debug("libcurl cannot share connection caches.")
+    return share
+
+
+def _check_headers(url, curl=None, conditions=None):
+    """
+    Request and parse file headers in preparation of file retireval.
+
+    Parameters
+    ----------
+    url : str
+        URL of the file to be retrieved.
+    curl : pycurl.Curl, optional
+        Handle used to make the request. It is returned to GET mode before
+        returning, so it may be reused for a download.
+    conditions : list of str, optional
+        Conditional request headers. If provided, a 304 Not Modified response
+        is accepted.
+
+    Returns
+    -------
+    (str, int, bool, dict)
+        Four-tuple of effective URL, size of the file in bytes, true if the
+        remote server supports segmented downloads, and the headers of the
+        final response keyed by lower-case name.
+    """
+    if curl is None:
+        curl = pycurl.Curl()
+        curl.setopt(pycurl.FOLLOWLOCATION, 1)
+        curl.setopt(pycurl.MAXREDIRS, 5)
+        curl.setopt(pycurl.CONNECTTIMEOUT, 30)
+        curl.setopt(pycurl.TIMEOUT, 300)
+        curl.setopt(pycurl.NOSIGNAL, 1)
+    headers = _start_probe(url, curl, conditions)
+    try:
+        curl.perform()
+    finally:
+        _end_probe(curl, conditions)
+    return _probe_result(url, curl, headers, conditions)
+
+
+def _start_probe(url, curl, conditions=None):
+    """
+    Set up a handle to request file headers.
+
+    Returns
+    -------
+    BytesIO
+        buffer the response headers are written to.
+    """
+    headers = BytesIO()
+    curl.setopt(pycurl.NOPROGRESS, 1)
+    curl.setopt(pycurl.NOBODY, 1)
+    curl.setopt(pycurl.HEADERFUNCTION, headers.write)
+    curl.setopt(pycurl.URL, url)
+    curl.unsetopt(pycurl.RANGE)
+    if conditions:
+        curl.setopt(pycurl.HTTPHEADER, conditions)
+    return headers
+
+
+def _end_probe(curl, conditions=None):
+    """Return a handle used for a probe to GET mode."""
+    curl.setopt(pycurl.HTTPGET, 1)
+    curl.unsetopt(pycurl.HEADERFUNCTION)
+    if conditions:
+        curl.unsetopt(pycurl.HTTPHEADER)
+
+
+def _probe_result(url, curl, headers, conditions=None):
+    """Check and parse the response to a probe, as _check_headers returns."""
+    accepted = STATUS_OK
+    if conditions:
+        accepted += (STATUS_NOT_MODIFIED,)
+    response_code = curl.getinfo(pycurl.RESPONSE_CODE)
+    if curl.errstr() or response_code not in accepted:
+        msg = "Cannot retrieve {}. ({})".format(url, response_code)
+        raise RuntimeError(msg)
+
+    eurl = curl.getinfo(pycurl.EFFECTIVE_URL)
+    size = int(curl.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD))
+    headers = _parse_headers(headers.getvalue().decode("iso-8859-1"))
+    can_segment = _accepts_ranges(headers)
+    if size < 1:
+        can_segment = False
+
+    return (eurl, size, can_segment, headers)
+
+
+def _response_probe(url, raw):
+    """
+    Describe a file from the headers of the response to a request for the
+    whole file as a range, as _probe_result describes it from a probe.
+
+    Parameters
+    ----------
+    url : str
+        URL requested.
+    raw : str
+        headers as received, including those of any redirects.
+
+    Returns
+    -------
+    (int, tuple)
+        HTTP status, and the tuple returned by _check_headers.
+
+    """
+    eurl = url
+    status = None
+    for line in raw.splitlines():
+        if line.startswith("HTTP/"):
+            try:
+                status = int(line.split()[1])
+            except (IndexError, ValueError):
+                status = None
+        elif line[:9].lower() == "location:":
+            eurl = urljoin(eurl, line[9:].strip())
+    headers = _parse_headers(raw)
+
+    total = None
+    content_range = headers.get("content-range", "")
+    if "/" in content_range:
+        try:
+            total = int(content_range.rsplit("/", 1)[1])
+        except ValueError:
+            total = None
+
+    if status == STATUS_RANGE_NOT_SATISFIABLE and not total:
+        # Only an empty file cannot satisfy a range from its first byte.
+        return status, (eurl, 0, False, headers)
+    if status not in STATUS_OK:
+        raise RuntimeError("Cannot retrieve {}. ({})".format(url, status))
+
+    if status == STATUS_PARTIAL:
+        size = total if total is not None else -1
+        can_segment = True
+    else:
+        try:
+            size = int(headers.get("content-length", -1))
+        except ValueError:
+            size = -1
+        can_segment = _accepts_ranges(headers)
+    if size < 1:
+        can_segment = False
+    return status, (eurl, size, can_segment, headers)
+
+
+def _accepts_ranges(headers):
+    """Check if response headers advertise support for byte ranges."""
+    return headers.get("accept-ranges", "none").lower() != "none"
+
+
+def _strong_validator(transfer):
+    """
+    The validator to send in If-Range when resuming a transfer: its ETag
+    unless it is weak, otherwise its Last-Modified date, or None.
+    """
+    if transfer.etag and not transfer.etag.startswith("W/"):
+        return transfer.etag
+    return transfer.last_modified
+
+
+def _last_byte(transfer):
+    """Offset of the last byte of a file, or None if its size is unknown."""
+    return transfer.size - 1 if transfer.size >= 0 else None
+
+
+def _parse_headers(raw):
+    """
+    Parse raw response headers, keeping only the last response when
+    redirects were followed.
+
+    Parameters
+    ----------
+    raw : str
+        headers as received.
+
+    Returns
+    -------
+    dict
+        header values keyed by lower-case name.
+
+    """
+    headers = {}
+    for line in raw.splitlines():
+        if line.startswith("HTTP/"):
+            headers = {}
+        elif ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+def fetch(req_url, output=None, checksum=None):
+    """
+    Fetch a single URL using default settings.
+
+    Parameters
+    ----------
+    req_url : unicode or str, or list
+        URL to request, or URLs of mirrors holding the same file. File will be
+        written to teh current working directory.
+    output : str, bytearray, memoryview, file-like or callable, optional
+        filename, possibly with path, of the downloaded file, or other output
+        as accepted by Downloader.fetch.
+    checksum : str or dict, optional
+        expected checksum, as accepted by Downloader.fetch.
+    """
+    with Downloader() as dl:
+        return dl.fetch(req_url, output, checksum)
+
+
+def fetch_many(urls, outputs=None, checksums=None):
+    """
+    Fetch several URLs using default settings.
+
+    Parameters
+    ----------
+    urls : list of unicode or str
+        URLs to request. Files will be written to the current working directory
+        unless outputs are provided.
+    outputs : list, optional
+        filenames, possibly with path, of the downloaded files, or other
+        outputs as accepted by Downloader.fetch.
+    checksums : list, optional
+        expected checksums, as accepted by Downloader.fetch.
+    """
+    with Downloader() as dl:
+        return dl.fetch_many(urls, outputs, checksums)
+
+
+def stream(req_url, checksum=None):
+    """
+    Retrieve a single URL as a sequence of chunks using default settings.
 
     Parameters
     ----------
-    req_url : unicode or str
-        URL to request. File will be written to teh current working directory.
+    req_url : unicode or str, or list
+        URL to request, or URLs of mirrors holding the same file.
+    checksum : str or dict, optional
+        expected checksum, as accepted by Downloader.fetch.
     """
-    dl = Downloader()
-    dl.fetch(req_url, output)
+    with Downloader() as dl:
+        for chunk in dl.stream(req_url, checksum):
+            yield chunk
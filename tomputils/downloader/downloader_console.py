@@ -2,18 +2,61 @@
 """
 Provides a console interface for downloading a file, possibly in segments.
 
+With --manifest, many files are retrieved by one process. The manifest
+holds one file per line, as a JSON object with url, output and checksum
+keys, or as CSV columns in that order. Output and checksum may be left
+out. The status of each file is printed as a line of JSON once it settles.
+
+With --sync, the URL is a directory listing which is mirrored into the
+given directory. Only files which are new or have changed since the last
+sync are retrieved.
+
 """
 from __future__ import absolute_import, division, print_function, unicode_literals
 import argparse
+import asyncio
+import csv
+import json
 import logging
+import sys
 
-from future.builtins import *  # NOQA
 
 from tomputils.downloader.downloader import DEFAULT_MIN_SEG_SIZE
 from tomputils.downloader.downloader import DEFAULT_MAX_CON
 from tomputils.downloader.downloader import Downloader, DEFAULT_MAX_RETRY
+from tomputils.downloader.aio import AsyncDownloader
+from tomputils.downloader.metrics import PrometheusExporter
+from tomputils.downloader.progress import DEFAULT_UPDATES
+from tomputils.downloader.progress import JsonProgress, LogProgress, TtyProgress
+from tomputils.downloader.sink import ALLOCATIONS, WRITE_MODES
 
 LOG = logging.getLogger(__name__)
+RATE_UNITS = {"k": 1024, "m": 1024**2, "g": 1024**3}
+DEFAULT_JOBS = 8
+MANIFEST_FIELDS = ("url", "output", "checksum")
+PROGRESS_SINKS = {
+    "tty": TtyProgress,
+    "log": LogProgress,
+    "json": JsonProgress,
+    "none": None,
+}
+
+
+def _parse_rate(rate):
+    """
+    Parse a bandwidth in bytes per second, allowing a k, M or G suffix.
+
+    """
+    rate = rate.strip()
+    multiplier = RATE_UNITS.get(rate[-1:].lower())
+    if multiplier is not None:
+        rate = rate[:-1]
+    else:
+        multiplier = 1
+    try:
+        return int(float(rate) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid rate: {}".format(rate))
 
 
 def _arg_parse():
@@ -21,7 +64,26 @@ def _arg_parse():
         "Provides a console interface for downloading a file, " "possibly in segments."
     )
     parser = argparse.ArgumentParser(description=description)
-    parser.add_argument("url", help="URL of file to download.")
+    parser.add_argument("url", help="URL of file to download.", nargs="?")
+    parser.add_argument(
+        "-i",
+        "--manifest",
+        help="Download the files listed in this file, or - for stdin, as JSON "
+        "lines or CSV of url, output and checksum.",
+    )
+    parser.add_argument(
+        "-y",
+        "--sync",
+        help="Mirror the directory listing at the URL into this directory.",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Files retrieved at once in manifest mode.",
+        type=int,
+        default=DEFAULT_JOBS,
+    )
     parser.add_argument(
         "-r",
         "--retries",
@@ -43,14 +105,241 @@ def _arg_parse():
         type=int,
         default=DEFAULT_MIN_SEG_SIZE,
     )
+    parser.add_argument(
+        "-l",
+        "--rate",
+        help="Maximum download rate in bytes per second. A k, M or G suffix "
+        "may be used.",
+        type=_parse_rate,
+    )
+    parser.add_argument(
+        "-d",
+        "--decompress",
+        help="Decompress gzip, bzip2 and xz files while downloading.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-e",
+        "--accept-encoding",
+        help="Ask the server to compress the response. Implies --decompress.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-m",
+        "--metrics",
+        help="Write request timings to this file in Prometheus text format.",
+    )
+    parser.add_argument(
+        "-a",
+        "--allocation",
+        help="How file space is set aside before writing.",
+        choices=ALLOCATIONS,
+        default="sparse",
+    )
+    parser.add_argument(
+        "-w",
+        "--write-mode",
+        help="How data passes through the page cache: buffered, dontneed to "
+        "drop written pages, or direct to bypass the cache.",
+        choices=WRITE_MODES,
+        default="buffered",
+    )
+    parser.add_argument(
+        "-t",
+        "--atomic",
+        help="Write to a temporary name and rename the file into place once "
+        "it is complete.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-2",
+        "--http2",
+        help="Multiplex requests over HTTP/2 where the server offers it.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-p",
+        "--no-probe",
+        help="Learn the size of each file from its first request rather than "
+        "probing it first.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-g",
+        "--progress",
+        help="How progress is shown: drawn on a terminal, logged, written to "
+        "stderr as JSON lines, or not at all. In manifest mode it is drawn on "
+        "stderr, leaving stdout to the statuses.",
+        choices=PROGRESS_SINKS,
+        default="tty",
+    )
+    parser.add_argument(
+        "-u",
+        "--progress-updates",
+        help="Most progress updates a second.",
+        type=float,
+        default=DEFAULT_UPDATES,
+    )
     parser.add_argument("-v", "--verbose", help="Verbose util", action="store_true")
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if (args.url is None) == (args.manifest is None):
+        parser.error("give either a URL or --manifest")
+    if args.sync is not None and args.url is None:
+        parser.error("--sync needs the URL of a listing")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.progress_updates <= 0:
+        parser.error("--progress-updates must be positive")
+    return args
+
+
+def _parse_item(line):
+    """
+    Parse a line of a manifest.
+
+    Returns
+    -------
+    dict
+        url, output and checksum of the file, or None for a blank line,
+        comment or CSV header.
+
+    Raises
+    ------
+    ValueError
+        if the line cannot be understood.
+
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    if line.startswith("{"):
+        item = json.loads(line)
+        if not isinstance(item, dict):
+            raise ValueError("expected a JSON object")
+    else:
+        row = [field.strip() for field in next(csv.reader([line]))]
+        if row[0].lower() == "url":
+            return None
+        item = dict(zip(MANIFEST_FIELDS, row))
+    if not item.get("url"):
+        raise ValueError("no url")
+    return dict((key, item.get(key) or None) for key in MANIFEST_FIELDS)
+
+
+def _report(item, result=None, error=None):
+    """Print the status of a manifest item as a line of JSON."""
+    status = {"url": item.get("url"), "output": item.get("output")}
+    if result is None:
+        status.update(status="failed", error=str(error))
+    else:
+        if result.skipped:
+            status["status"] = "skipped"
+        else:
+            status["status"] = "ok" if result.ok else "failed"
+        status.update(
+            output=result.output,
+            size=result.size,
+            bytes=result.downloaded,
+            elapsed=round(result.elapsed, 3),
+            retries=result.retries,
+        )
+        if not result.ok:
+            status["error"] = str(result.error)
+    sys.stdout.write(json.dumps(status) + "\n")
+    sys.stdout.flush()
+    return status["status"] != "failed"
+
+
+async def _retrieve(downloader, item):
+    try:
+        return (
+            item,
+            await downloader.retrieve(item["url"], item["output"], item["checksum"]),
+            None,
+        )
+    except Exception as e:
+        return item, None, e
+
+
+async def _run_manifest(manifest, options, jobs):
+    """
+    Retrieve every file of a manifest, no more than jobs at a time. Lines
+    are read as room frees up, so the manifest may be a long stream, and
+    each status is printed as soon as its file settles.
+
+    Returns
+    -------
+    int
+        number of files which failed.
+
+    """
+    loop = asyncio.get_running_loop()
+    failures = []
+    pending = set()
+
+    def settle(task):
+        pending.discard(task)
+        if not _report(*task.result()):
+            failures.append(task)
+
+    async with AsyncDownloader(**options) as downloader:
+        number = 0
+        while True:
+            line = await loop.run_in_executor(None, manifest.readline)
+            if not line:
+                break
+            number += 1
+            try:
+                item = _parse_item(line)
+            except ValueError as e:
+                item = {"url": None, "output": None}
+                if not _report(item, error="line {}: {}".format(number, e)):
+                    failures.append(item)
+                continue
+            if item is None:
+                continue
+
+            task = asyncio.ensure_future(_retrieve(downloader, item))
+            task.add_done_callback(settle)
+            pending.add(task)
+            while len(pending) >= jobs:
+                await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+        while pending:
+            await asyncio.wait(pending)
+    return len(failures)
+
+
+def _download_manifest(args, options):
+    """
+    Retrieve the files of a manifest.
+
+    Returns
+    -------
+    int
+        exit status, 1 if any file failed.
+
+    """
+    if args.manifest == "-":
+        manifest = sys.stdin
+    else:
+        manifest = open(args.manifest)
+    try:
+        failed = asyncio.run(_run_manifest(manifest, options, args.jobs))
+    finally:
+        if manifest is not sys.stdin:
+            manifest.close()
+    if failed:
+        LOG.error("%d files failed", failed)
+        return 1
+    return 0
 
 
 def download():
     """
-    Download a single file. Entrypoint for downloader console script.
+    Download a file, or the files of a manifest. Entrypoint for downloader
+    console script.
 
     """
     logging.basicConfig()
@@ -58,12 +347,55 @@ def download():
     if args.verbose is True:
         logging.getLogger().setLevel(logging.DEBUG)
 
-    downloader = Downloader(
-        max_retry=args.retries, min_seg_size=args.seg_size, max_con=args.num_con
+    hooks = []
+    if args.metrics:
+        hooks.append(PrometheusExporter())
+    sink = PROGRESS_SINKS[args.progress]
+    if sink is None:
+        progress = []
+    elif sink is TtyProgress and args.manifest is not None:
+        # Statuses go to stdout, so redraws must not.
+        progress = [TtyProgress(sys.stderr)]
+    else:
+        progress = [sink()]
+    if args.progress == "log":
+        logging.getLogger(LogProgress.__module__).setLevel(logging.INFO)
+
+    options = dict(
+        max_retry=args.retries,
+        min_seg_size=args.seg_size,
+        max_con=args.num_con,
+        rate=args.rate,
+        decompress=args.decompress or args.accept_encoding,
+        accept_encoding=args.accept_encoding,
+        hooks=hooks,
+        allocation=args.allocation,
+        write_mode=args.write_mode,
+        atomic=args.atomic,
+        http2=args.http2,
+        probe=not args.no_probe,
+        progress=progress,
+        progress_updates=args.progress_updates,
     )
 
-    LOG.debug("Downloading %s", args.url)
-    downloader.fetch(args.url)
+    try:
+        if args.manifest is not None:
+            sys.exit(_download_manifest(args, options))
+        if args.sync is not None:
+            LOG.debug("Syncing %s into %s", args.url, args.sync)
+            with Downloader(**options) as downloader:
+                results = downloader.sync(args.url, args.sync)
+            failed = sum(1 for result in results if not result.ok)
+            if failed:
+                LOG.error("%d files failed", failed)
+                sys.exit(1)
+            return
+        LOG.debug("Downloading %s", args.url)
+        with Downloader(**options) as downloader:
+            downloader.fetch(args.url)
+    finally:
+        for hook in hooks:
+            hook.write(args.metrics)
 
 
 if __name__ == "__main__":
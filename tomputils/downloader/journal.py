@@ -0,0 +1,214 @@
+# -*- coding: utf8 -*-
+"""
+Keep a sidecar record of the byte ranges of a download which have been written
+to disk, so an interrupted download can be resumed.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import json
+import logging
+import os
+import time
+
+JOURNAL_SUFFIX = ".journal"
+SAVE_INTERVAL = 1.0
+
+LOG = logging.getLogger(__name__)
+
+
+class SegmentJournal(object):
+    """
+    Completed byte ranges of a partially downloaded file.
+
+    The journal is written next to the output file and removed once the
+    download completes. Ranges are inclusive and are merged as they are
+    recorded.
+
+    Parameters
+    ----------
+    output : str
+        filename, possibly with path, of the downloaded file.
+    url : str
+        effective URL of the file.
+    size : int
+        size of the file in bytes.
+    etag : str, optional
+        ETag reported by the remote server.
+    last_modified : str, optional
+        Last-Modified reported by the remote server.
+
+    """
+
+    def __init__(self, output, url, size, etag=None, last_modified=None):
+        self.path = output + JOURNAL_SUFFIX
+        self.url = url
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.completed = []
+        self._dirty = False
+        self._saved = 0
+
+    @classmethod
+    def load(cls, output):
+        """
+        Read the journal of a previous attempt, if there is one.
+
+        Parameters
+        ----------
+        output : str
+            filename, possibly with path, of the downloaded file.
+
+        Returns
+        -------
+        SegmentJournal
+            the journal, or None if there is no usable journal.
+
+        """
+        path = output + JOURNAL_SUFFIX
+        try:
+            with open(path, str("r")) as journal_file:
+                state = json.load(journal_file)
+        except (IOError, OSError):
+            return None
+        except ValueError:
+            LOG.warning("Ignoring unreadable journal %s", path)
+            return None
+
+        journal = cls(
+            output,
+            state.get("url"),
+            state.get("size"),
+            state.get("etag"),
+            state.get("last_modified"),
+        )
+        journal.completed = [list(r) for r in state.get("completed", [])]
+        return journal
+
+    def matches(self, size, etag=None, last_modified=None):
+        """
+        Check if the journal describes the same version of the remote file.
+
+        A journal can only be trusted if the remote server provided at least
+        one validator and every validator is unchanged.
+
+        Parameters
+        ----------
+        size : int
+            size of the file in bytes.
+        etag : str, optional
+            ETag reported by the remote server.
+        last_modified : str, optional
+            Last-Modified reported by the remote server.
+
+        Returns
+        -------
+        bool
+            True if completed ranges may be reused.
+
+        """
+        if etag is None and last_modified is None:
+            return False
+
+        return (
+            self.size == size
+            and self.etag == etag
+            and self.last_modified == last_modified
+        )
+
+    def record(self, start, end):
+        """
+        Record a range of bytes as written.
+
+        Parameters
+        ----------
+        start : int
+            offset of first byte written.
+        end : int
+            offset of last byte written.
+
+        """
+        if end < start:
+            return
+
+        merged = []
+        for r in sorted(self.completed + [[start, end]]):
+            if merged and r[0] <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], r[1])
+            else:
+                merged.append(list(r))
+        self.completed = merged
+        self._dirty = True
+
+    def missing(self, start, end):
+        """
+        Find the ranges within start-end which have not been written.
+
+        Parameters
+        ----------
+        start : int
+            offset of first byte of interest.
+        end : int
+            offset of last byte of interest.
+
+        Returns
+        -------
+        list
+            list of [start, end] ranges.
+
+        """
+        gaps = []
+        for r in self.completed:
+            if r[1] < start:
+                continue
+            if r[0] > end:
+                break
+            if r[0] > start:
+                gaps.append([start, r[0] - 1])
+            start = max(start, r[1] + 1)
+        if start <= end:
+            gaps.append([start, end])
+        return gaps
+
+    @property
+    def completed_bytes(self):
+        return sum(r[1] - r[0] + 1 for r in self.completed)
+
+    def save(self, force=True):
+        """
+        Write the journal to disk.
+
+        The journal is replaced atomically so a crash while saving never
+        leaves a truncated journal behind.
+
+        Parameters
+        ----------
+        force : bool, optional
+            If false, only save if something changed and the journal has not
+            been saved in the last SAVE_INTERVAL seconds.
+
+        """
+        now = time.time()
+        if not force and (not self._dirty or now - self._saved < SAVE_INTERVAL):
+            return
+
+        state = {
+            "url": self.url,
+            "size": self.size,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "completed": self.completed,
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, str("w")) as journal_file:
+            json.dump(state, journal_file)
+        os.rename(tmp_path, self.path)
+        self._dirty = False
+        self._saved = now
+
+    def remove(self):
+        """Remove the journal once the download is complete."""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
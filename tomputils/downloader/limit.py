@@ -3,23 +3,31 @@ source:
     https://stackoverflow.com/questions/456649/throttling-with-urllib2#456668
 """
 
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import asyncio
+import multiprocessing
 import os
 import sys
 import threading
 import time
-import urllib
-import urlparse
+from time import monotonic
+
+from six.moves.urllib.parse import urlparse
+from six.moves.urllib.request import urlretrieve
 
 
 class TokenBucket(object):
     """An implementation of the token bucket algorithm.
     source: http://code.activestate.com/recipes/511490/
+    (rewritten around a monotonic clock, with the fill folded into consume so
+    each call takes the lock once)
 
     >>> bucket = TokenBucket(80, 0.5)
-    >>> print bucket.consume(10)
+    >>> bucket.consume(10)
+    0
+    >>> bucket.consume(90) > 0
     True
-    >>> print bucket.consume(90)
-    False
     """
     def __init__(self, tokens, fill_rate):
         """tokens is the total tokens in the bucket. fill_rate is the
@@ -27,32 +35,136 @@ class TokenBucket(object):
         self.capacity = float(tokens)
         self._tokens = float(tokens)
         self.fill_rate = float(fill_rate)
-        self.timestamp = time.time()
-        self.lock = threading.RLock()
+        self.timestamp = monotonic()
+        self.lock = threading.Lock()
+
+    def _fill(self, now):
+        """Top up the bucket for the time passed since the last call. The
+        caller must hold the lock."""
+        tokens = self._tokens + self.fill_rate * (now - self.timestamp)
+        self._tokens = min(self.capacity, tokens)
+        self.timestamp = now
 
     def consume(self, tokens):
         """Consume tokens from the bucket. Returns 0 if there were
         sufficient tokens, otherwise the expected time until enough
         tokens become available."""
-        self.lock.acquire()
-        tokens = max(tokens, self.tokens)
-        expected_time = (tokens - self.tokens) / self.fill_rate
-        if expected_time <= 0:
-            self._tokens -= tokens
-        self.lock.release()
-        return max(0, expected_time)
+        with self.lock:
+            # _fill, inlined as this is called for every buffer received.
+            now = monotonic()
+            available = self._tokens + self.fill_rate * (now - self.timestamp)
+            if available > self.capacity:
+                available = self.capacity
+            self.timestamp = now
+            if tokens <= available:
+                self._tokens = available - tokens
+                return 0
+            self._tokens = available
+            return (tokens - available) / self.fill_rate
+
+    def peek(self, tokens):
+        """Like consume, but never takes any tokens."""
+        with self.lock:
+            self._fill(monotonic())
+            return max(0, (tokens - self._tokens) / self.fill_rate)
+
+    def acquire(self, tokens):
+        """Block until tokens have been consumed. Returns the time spent
+        waiting."""
+        self._check(tokens)
+        waited = 0
+        wait_time = self.consume(tokens)
+        while wait_time > 0:
+            time.sleep(wait_time)
+            waited += wait_time
+            wait_time = self.consume(tokens)
+        return waited
+
+    def _check(self, tokens):
+        if tokens > self.capacity:
+            raise ValueError("Cannot acquire %s tokens from a bucket holding "
+                             "%s." % (tokens, self.capacity))
 
     @property
     def tokens(self):
-        self.lock.acquire()
-        if self._tokens < self.capacity:
-            now = time.time()
-            delta = self.fill_rate * (now - self.timestamp)
-            self._tokens = min(self.capacity, self._tokens + delta)
-            self.timestamp = now
-        value = self._tokens
-        self.lock.release()
-        return value
+        with self.lock:
+            self._fill(monotonic())
+            return self._tokens
+
+
+class AsyncTokenBucket(TokenBucket):
+    """A token bucket whose acquire waits on the running asyncio event
+    loop rather than blocking the thread.
+
+    The bucket is meant to be shared by tasks on one event loop. consume
+    never blocks, so it may also be called from loop callbacks.
+    """
+    async def acquire(self, tokens):
+        """Wait until tokens have been consumed. Returns the time spent
+        waiting."""
+        self._check(tokens)
+        waited = 0
+        wait_time = self.consume(tokens)
+        while wait_time > 0:
+            await asyncio.sleep(wait_time)
+            waited += wait_time
+            wait_time = self.consume(tokens)
+        return waited
+
+
+class SharedTokenBucket(TokenBucket):
+    """A token bucket kept in shared memory, so several worker processes
+    can draw from one budget.
+
+    Create the bucket in the parent and hand it to the workers when they
+    are started, either through multiprocessing.Process arguments or by
+    forking. The monotonic clock is system wide on the platforms we run on,
+    so timestamps taken in different processes can be compared.
+
+    >>> bucket = SharedTokenBucket(80, 0.5)
+    >>> bucket.consume(10)
+    0
+    """
+    def __init__(self, tokens, fill_rate):
+        self.capacity = float(tokens)
+        self.fill_rate = float(fill_rate)
+        # [tokens, timestamp]
+        self.state = multiprocessing.RawArray("d", [self.capacity,
+                                                    monotonic()])
+        self.lock = multiprocessing.Lock()
+
+    def _fill(self, now):
+        state = self.state
+        tokens = state[0] + self.fill_rate * (now - state[1])
+        state[0] = min(self.capacity, tokens)
+        state[1] = now
+
+    def consume(self, tokens):
+        with self.lock:
+            state = self.state
+            self._fill(monotonic())
+            if tokens <= state[0]:
+                state[0] -= tokens
+                return 0
+            return (tokens - state[0]) / self.fill_rate
+
+    def peek(self, tokens):
+        with self.lock:
+            self._fill(monotonic())
+            return max(0, (tokens - self.state[0]) / self.fill_rate)
+
+    @property
+    def tokens(self):
+        with self.lock:
+            self._fill(monotonic())
+            return self.state[0]
+
+    @property
+    def timestamp(self):
+        return self.state[1]
+
+
+MIN_BURST = 64 * 1024
 
 
 class RateLimit(object):
@@ -78,12 +190,9 @@ class RateLimit(object):
 
         predicted_size = block_size/1024.
 
-        wait_time = self.bucket.consume(predicted_size)
-        while wait_time > 0:
-            time.sleep(wait_time)
-            wait_time = self.bucket.consume(predicted_size)
+        self.bucket.acquire(predicted_size)
 
-        now = time.time()
+        now = monotonic()
         delta = now - self.last_update
         if self.last_update != 0:
             if delta > 0:
@@ -100,6 +209,64 @@ class RateLimit(object):
         self.last_update = now
 
 
+class Throttle(object):
+    """Shape the bandwidth used by a set of curl transfers.
+
+    A global budget and a per-host budget may be set. Write callbacks ask
+    the throttle for permission before accepting data; when a budget is
+    exhausted the callback pauses its transfer and the transfer loop resumes
+    it once enough tokens have accumulated.
+
+    >>> throttle = Throttle(rate=1024 * 1024)
+    >>> throttle.request("example.com", 16384)
+    0
+    """
+    def __init__(self, rate=None, host_rate=None, burst=1.0):
+        """rate and host_rate are in bytes/second; None means unlimited.
+        rate may also be a TokenBucket, such as a SharedTokenBucket drawn
+        on by other processes. burst is the number of seconds of traffic
+        each bucket may hold."""
+        self.host_rate = host_rate
+        self.burst = burst
+        self.bucket = None
+        if isinstance(rate, TokenBucket):
+            self.bucket = rate
+        elif rate:
+            self.bucket = self._new_bucket(rate)
+        self.host_buckets = {}
+
+    def _new_bucket(self, rate):
+        capacity = max(rate * self.burst, MIN_BURST)
+        return TokenBucket(capacity, rate)
+
+    def _buckets(self, host):
+        buckets = []
+        if self.bucket is not None:
+            buckets.append(self.bucket)
+        if self.host_rate:
+            if host not in self.host_buckets:
+                self.host_buckets[host] = self._new_bucket(self.host_rate)
+            buckets.append(self.host_buckets[host])
+        return buckets
+
+    def request(self, host, size):
+        """Take size bytes from every budget that applies to host. Returns 0
+        if they were granted, otherwise the time until they will be
+        available. Nothing is taken unless every budget can grant the
+        request."""
+        buckets = self._buckets(host)
+        if len(buckets) > 1:
+            wait = max(b.peek(min(size, b.capacity)) for b in buckets)
+            if wait > 0:
+                return wait
+
+        for bucket in buckets:
+            wait = bucket.consume(min(size, bucket.capacity))
+            if wait > 0:
+                return wait
+        return 0
+
+
 def main():
     """Fetch the contents of urls"""
     if len(sys.argv) < 4:
@@ -113,12 +280,12 @@ def main():
 
     threads = []
     for url in urls:
-        path = urlparse.urlparse(url, 'http')[2]
+        path = urlparse(url, 'http')[2]
         filename = os.path.basename(path)
         print('Downloading "%s" to "%s"...' % (url, filename))
         rate_limiter = RateLimit(bucket, filename)
         t = threading.Thread(
-            target=urllib.urlretrieve,
+            target=urlretrieve,
             args=(url, filename, rate_limiter))
         t.start()
         threads.append(t)
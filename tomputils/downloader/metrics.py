@@ -0,0 +1,447 @@
+# -*- coding: utf8 -*-
+"""
+Timings of the requests behind a download, and hooks to export them.
+
+Each request records what libcurl measured: name lookup, connect, TLS
+handshake, time to first byte and the speed of the body. Requests are
+gathered into a TransferResult for each file. Hooks receive each request as
+it finishes and each result as its batch settles, so measurements can be
+exported to Prometheus or StatsD while a long batch runs.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import logging
+import os
+import socket
+import threading
+
+import pycurl
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PHASES = ("dns", "connect", "tls", "ttfb", "total")
+STATSD_PORT = 8125
+
+LOG = logging.getLogger(__name__)
+
+
+class RequestMetrics(object):
+    """
+    Measurements of a single request.
+
+    Times are in seconds from the start of the request, as libcurl reports
+    them. A request on a reused connection spends no time on name lookup,
+    connect or TLS.
+
+    Attributes
+    ----------
+    kind : str
+        "probe" or "segment".
+    url : str
+        effective URL requested.
+    host : str
+        host and port the request went to.
+    start : int
+        offset of the first byte requested, or None for a probe.
+    end : int
+        offset of the last byte requested, or None for a probe.
+    bytes : int
+        body bytes received.
+    status : int
+        HTTP status, or 0 if no response arrived.
+    error : str
+        why the request failed, or None.
+    dns, connect, tls, ttfb, total : float
+        time to name lookup, TCP connect, TLS handshake and first byte, and
+        the total time of the request.
+    speed : float
+        average download speed in bytes per second.
+    connections : int
+        new connections opened for the request.
+
+    """
+
+    def __init__(self, kind, url, host, start=None, end=None, bytes=0, error=None):
+        self.kind = kind
+        self.url = url
+        self.host = host
+        self.start = start
+        self.end = end
+        self.bytes = bytes
+        self.error = error
+        self.status = 0
+        self.dns = 0.0
+        self.connect = 0.0
+        self.tls = 0.0
+        self.ttfb = 0.0
+        self.total = 0.0
+        self.speed = 0.0
+        self.connections = 0
+
+    @classmethod
+    def from_curl(cls, curl, kind, url, host, **kwargs):
+        """
+        Read the measurements of a finished request from its handle.
+
+        Parameters
+        ----------
+        curl : pycurl.Curl
+            handle of the finished request.
+        kind : str
+            "probe" or "segment".
+        url : str
+            URL requested, used if no effective URL is known.
+        host : str
+            host and port the request went to.
+        kwargs
+            other attributes of the request.
+
+        Returns
+        -------
+        RequestMetrics
+
+        """
+        metrics = cls(kind, curl.getinfo(pycurl.EFFECTIVE_URL) or url, host, **kwargs)
+        metrics.status = curl.getinfo(pycurl.RESPONSE_CODE)
+        metrics.dns = curl.getinfo(pycurl.NAMELOOKUP_TIME)
+        metrics.connect = curl.getinfo(pycurl.CONNECT_TIME)
+        metrics.tls = curl.getinfo(pycurl.APPCONNECT_TIME)
+        metrics.ttfb = curl.getinfo(pycurl.STARTTRANSFER_TIME)
+        metrics.total = curl.getinfo(pycurl.TOTAL_TIME)
+        metrics.speed = curl.getinfo(pycurl.SPEED_DOWNLOAD)
+        metrics.connections = curl.getinfo(pycurl.NUM_CONNECTS)
+        return metrics
+
+    @property
+    def ok(self):
+        return self.error is None and 200 <= self.status < 400
+
+    def __repr__(self):
+        return "<RequestMetrics {} {} {} bytes in {:.3f}s>".format(
+            self.kind, self.host, self.bytes, self.total
+        )
+
+
+class TransferResult(object):
+    """
+    Outcome of retrieving a single file.
+
+    Attributes
+    ----------
+    url : str
+        URL asked for, or the first mirror.
+    eurl : str
+        effective URL of the file.
+    output : object
+        filename of the downloaded file, or the output given.
+    size : int
+        size of the file in bytes, or -1 if not known.
+    downloaded : int
+        bytes retrieved by this attempt.
+    elapsed : float
+        seconds from the first byte requested to the last written.
+    error : object
+        why the file could not be retrieved, or None.
+    skipped : bool
+        true if the local copy was current.
+    resumed : bool
+        true if an earlier attempt was picked up.
+    retries : int
+        requests retried after a failure.
+    requests : list of RequestMetrics
+        every request made for the file, probes included.
+
+    """
+
+    def __init__(
+        self,
+        url,
+        eurl=None,
+        output=None,
+        size=-1,
+        downloaded=0,
+        elapsed=0.0,
+        error=None,
+        skipped=False,
+        resumed=False,
+        retries=0,
+        requests=None,
+    ):
+        self.url = url
+        self.eurl = eurl
+        self.output = output
+        self.size = size
+        self.downloaded = downloaded
+        self.elapsed = elapsed
+        self.error = error
+        self.skipped = skipped
+        self.resumed = resumed
+        self.retries = retries
+        self.requests = requests or []
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def rate(self):
+        """Bytes per second retrieved."""
+        return self.downloaded / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def hosts(self):
+        """
+        Requests, bytes and request seconds of each host.
+
+        Returns
+        -------
+        dict
+            dicts of requests, bytes and seconds, keyed by host.
+
+        """
+        hosts = {}
+        for request in self.requests:
+            host = hosts.setdefault(
+                request.host, dict(requests=0, bytes=0, seconds=0.0)
+            )
+            host["requests"] += 1
+            host["bytes"] += request.bytes
+            host["seconds"] += request.total
+        return hosts
+
+    def __repr__(self):
+        state = "ok" if self.ok else "failed"
+        if self.skipped:
+            state = "skipped"
+        return "<TransferResult {} {} {} bytes in {:.3f}s>".format(
+            self.url, state, self.downloaded, self.elapsed
+        )
+
+
+class MetricsHook(object):
+    """
+    Receives measurements from a downloader. Subclasses override the
+    methods they need. Hooks are called from the thread, or event loop,
+    running the download, so they should return quickly.
+    """
+
+    def request(self, metrics):
+        """
+        Called as each request finishes.
+
+        Parameters
+        ----------
+        metrics : RequestMetrics
+            measurements of the request.
+
+        """
+
+    def transfer(self, result):
+        """
+        Called for each file as soon as it has been retrieved, or has
+        failed. Files which were skipped, or could not be probed, are
+        reported once their batch has settled.
+
+        Parameters
+        ----------
+        result : TransferResult
+            outcome of the file.
+
+        """
+
+
+class PrometheusExporter(MetricsHook):
+    """
+    Aggregate measurements as Prometheus metrics.
+
+    Requests are labelled by host and kind. Collected metrics are rendered
+    in the Prometheus text exposition format, to be served or written for
+    the node exporter textfile collector.
+
+    Parameters
+    ----------
+    prefix : str, optional
+        prefix of every metric name.
+    buckets : tuple of float, optional
+        upper bounds of the duration histogram buckets, in seconds.
+
+    """
+
+    def __init__(self, prefix="downloader", buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def request(self, metrics):
+        labels = (("host", metrics.host), ("kind", metrics.kind))
+        outcome = "ok" if metrics.ok else "error"
+        with self.lock:
+            self._count("requests_total", labels + (("outcome", outcome),))
+            self._count("request_bytes_total", labels, metrics.bytes)
+            self._count("connections_total", labels, metrics.connections)
+            for phase in PHASES:
+                self._observe(
+                    "request_seconds",
+                    labels + (("phase", phase),),
+                    getattr(metrics, phase),
+                )
+
+    def transfer(self, result):
+        if result.skipped:
+            outcome = "skipped"
+        else:
+            outcome = "ok" if result.ok else "error"
+        with self.lock:
+            self._count("transfers_total", (("outcome", outcome),))
+            self._count("transfer_bytes_total", (), result.downloaded)
+            self._count("transfer_retries_total", (), result.retries)
+            if outcome == "ok":
+                self._observe("transfer_seconds", (), result.elapsed)
+
+    def _count(self, name, labels, value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def _observe(self, name, labels, value):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * len(self.buckets), 0, 0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += 1
+        histogram[2] += value
+
+    def render(self):
+        """
+        Render the collected metrics.
+
+        Returns
+        -------
+        str
+            metrics in the Prometheus text exposition format.
+
+        """
+        lines = []
+        typed = set()
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                name = "{}_{}".format(self.prefix, name)
+                if name not in typed:
+                    lines.append("# TYPE {} counter".format(name))
+                    typed.add(name)
+                lines.append("{}{} {}".format(name, _labels(labels), value))
+
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                counts, count, total = histogram
+                name = "{}_{}".format(self.prefix, name)
+                if name not in typed:
+                    lines.append("# TYPE {} histogram".format(name))
+                    typed.add(name)
+                for bound, bucket in zip(self.buckets, counts):
+                    le = labels + (("le", _number(bound)),)
+                    lines.append("{}_bucket{} {}".format(name, _labels(le), bucket))
+                le = labels + (("le", "+Inf"),)
+                lines.append("{}_bucket{} {}".format(name, _labels(le), count))
+                lines.append("{}_sum{} {}".format(name, _labels(labels), total))
+                lines.append("{}_count{} {}".format(name, _labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Write the collected metrics to a file, replacing it atomically so a
+        collector never reads a partial file.
+
+        Parameters
+        ----------
+        path : str
+            filename, possibly with path, to write.
+
+        """
+        temp = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp, str("w")) as metrics_file:
+            metrics_file.write(self.render())
+        os.rename(temp, path)
+
+
+class StatsdExporter(MetricsHook):
+    """
+    Send measurements to a StatsD daemon over UDP.
+
+    Timings are sent in milliseconds, by host, as
+    ``<prefix>.request.<host>.<phase>``. Bytes, requests and transfer
+    outcomes are sent as counters. Sending is best effort; a missing daemon
+    does not affect downloads.
+
+    Parameters
+    ----------
+    host : str, optional
+        address of the StatsD daemon.
+    port : int, optional
+        UDP port of the StatsD daemon.
+    prefix : str, optional
+        prefix of every metric name.
+
+    """
+
+    def __init__(self, host="127.0.0.1", port=STATSD_PORT, prefix="downloader"):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def request(self, metrics):
+        name = "{}.request.{}".format(self.prefix, _statsd_name(metrics.host))
+        outcome = "ok" if metrics.ok else "error"
+        lines = [
+            "{}.{}:1|c".format(name, outcome),
+            "{}.bytes:{}|c".format(name, metrics.bytes),
+        ]
+        for phase in PHASES:
+            ms = getattr(metrics, phase) * 1000
+            lines.append("{}.{}:{:.3f}|ms".format(name, phase, ms))
+        self._send(lines)
+
+    def transfer(self, result):
+        name = "{}.transfer".format(self.prefix)
+        if result.skipped:
+            self._send(["{}.skipped:1|c".format(name)])
+            return
+        outcome = "ok" if result.ok else "error"
+        self._send(
+            [
+                "{}.{}:1|c".format(name, outcome),
+                "{}.bytes:{}|c".format(name, result.downloaded),
+                "{}.retries:{}|c".format(name, result.retries),
+                "{}.seconds:{:.3f}|ms".format(name, result.elapsed * 1000),
+            ]
+        )
+
+    def _send(self, lines):
+        try:
+            self.sock.sendto("\n".join(lines).encode("utf-8"), self.address)
+        except (IOError, OSError) as e:
+            LOG.debug("Cannot send to StatsD at %s:%d < %s >", self.address + (e,))
+
+    def close(self):
+        self.sock.close()
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append('{}="{}"'.format(name, value.replace("\n", "\\n")))
+    return "{" + ",".join(pairs) + "}"
+
+
+def _number(value):
+    return repr(float(value))
+
+
+def _statsd_name(name):
+    """Make a host safe to use as part of a StatsD metric name."""
+    return "".join(ch if ch.isalnum() or ch in "-_" else "_" for ch in name)
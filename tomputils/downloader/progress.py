@@ -0,0 +1,423 @@
+# -*- coding: utf8 -*-
+"""
+Progress of the transfers a downloader is working on, and sinks to show it.
+
+A ProgressReporter samples the byte counters of the transfers from its own
+thread, a few times a second, so the transfer loop does no more than count
+the bytes it writes. Each sample is a Progress holding the bytes retrieved,
+the total size if every file's size is known, the rate over the last
+interval, a smoothed rate and an estimate of the time left. Sinks draw it
+on a terminal, log it or write it as lines of JSON for batch jobs.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import json
+import logging
+import math
+import sys
+import threading
+import time
+
+DEFAULT_UPDATES = 2
+RATE_WINDOW = 3.0
+LOG_INTERVAL = 10.0
+BAR_WIDTH = 20
+UNITS = ("B", "KiB", "MiB", "GiB", "TiB")
+
+LOG = logging.getLogger(__name__)
+
+
+class Progress(object):
+    """
+    A sample of the progress of the transfers under way.
+
+    Attributes
+    ----------
+    elapsed : float
+        seconds since the first transfer was added.
+    downloaded : int
+        bytes retrieved, including any resumed from an earlier run.
+    size : int
+        total bytes of every file, or None while any size is unknown.
+    files : int
+        files being retrieved.
+    finished : int
+        files which have settled, successfully or not.
+    rate : float
+        bytes per second since the previous sample.
+    average : float
+        exponentially weighted average of the rate, in bytes per second.
+    eta : float
+        estimated seconds left, or None if it cannot be told.
+    done : bool
+        True for the last sample, once every transfer has settled.
+
+    """
+
+    def __init__(
+        self,
+        elapsed,
+        downloaded,
+        size,
+        files,
+        finished,
+        rate,
+        average,
+        done=False,
+    ):
+        self.elapsed = elapsed
+        self.downloaded = downloaded
+        self.size = size
+        self.files = files
+        self.finished = finished
+        self.rate = rate
+        self.average = average
+        self.done = done
+
+    @property
+    def percent(self):
+        """Share of the total size retrieved, or None if it is unknown."""
+        if self.size is None:
+            return None
+        if self.size <= 0:
+            return 100.0
+        return min(100.0, self.downloaded * 100.0 / self.size)
+
+    @property
+    def eta(self):
+        if self.done:
+            return 0.0
+        if self.size is None or not self.average:
+            return None
+        return max(0, self.size - self.downloaded) / self.average
+
+    def as_dict(self):
+        """The sample as a dict, ready to be encoded as JSON."""
+        return {
+            "elapsed": round(self.elapsed, 3),
+            "downloaded": self.downloaded,
+            "size": self.size,
+            "percent": _round(self.percent, 2),
+            "files": self.files,
+            "finished": self.finished,
+            "rate": _round(self.rate, 1),
+            "average": _round(self.average, 1),
+            "eta": _round(self.eta, 1),
+            "done": self.done,
+        }
+
+    def __repr__(self):
+        return "Progress({} of {} bytes, {} of {} files)".format(
+            self.downloaded, self.size, self.finished, self.files
+        )
+
+
+class ProgressSink(object):
+    """
+    Receives progress samples. Subclasses override update.
+
+    A sink which is not active, such as a terminal sink whose stream is not
+    a terminal, is never sampled for.
+
+    """
+
+    active = True
+
+    def update(self, progress):
+        """
+        Show a sample. Called from the reporter's thread, and once more with
+        done set from the thread which ran the transfers.
+
+        Parameters
+        ----------
+        progress : Progress
+            the sample.
+
+        """
+        pass
+
+
+class TtyProgress(ProgressSink):
+    """
+    Draw progress on one line of a terminal.
+
+    Parameters
+    ----------
+    stream : file-like, optional
+        terminal to draw on, stdout by default. Nothing is drawn unless it
+        is a terminal.
+
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        try:
+            self.active = self.stream.isatty()
+        except (AttributeError, ValueError):
+            self.active = False
+        self._line = None
+
+    def update(self, progress):
+        line = _describe(progress)
+        percent = progress.percent
+        if percent is not None:
+            filled = int(percent * BAR_WIDTH / 100)
+            line += " |{}{}|".format("o" * filled, "." * (BAR_WIDTH - filled))
+        if line != self._line:
+            width = len(self._line or "")
+            self.stream.write("\r" + line.ljust(width))
+            self._line = line
+        if progress.done:
+            self.stream.write("\n")
+            self._line = None
+        self.stream.flush()
+
+
+class LogProgress(ProgressSink):
+    """
+    Log progress, at most once every interval.
+
+    Parameters
+    ----------
+    logger : logging.Logger, optional
+        logger to write to, this module's by default.
+    level : int, optional
+        level of the records.
+    interval : float, optional
+        least seconds between records. The last sample is always logged.
+
+    """
+
+    def __init__(self, logger=None, level=logging.INFO, interval=LOG_INTERVAL):
+        self.logger = logger or LOG
+        self.level = level
+        self.interval = interval
+        self._logged = None
+
+    def update(self, progress):
+        if not progress.done and self._logged is not None:
+            if progress.elapsed - self._logged < self.interval:
+                return
+        self._logged = None if progress.done else progress.elapsed
+        self.logger.log(self.level, "%s", _describe(progress))
+
+
+class JsonProgress(ProgressSink):
+    """
+    Write each sample as a line of JSON, for batch jobs to follow.
+
+    Parameters
+    ----------
+    stream : file-like, optional
+        where to write, stderr by default.
+    interval : float, optional
+        least seconds between lines. The last sample is always written.
+
+    """
+
+    def __init__(self, stream=None, interval=0):
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self._written = None
+
+    def update(self, progress):
+        if not progress.done and self._written is not None:
+            if progress.elapsed - self._written < self.interval:
+                return
+        self._written = None if progress.done else progress.elapsed
+        self.stream.write(json.dumps(progress.as_dict()) + "\n")
+        self.stream.flush()
+
+
+class ProgressReporter(object):
+    """
+    Sample the transfers under way and pass each sample to the sinks.
+
+    Transfers are added as their batch starts and removed once it settles.
+    While any are under way a thread samples them at most ``updates`` times
+    a second. Once the last is removed a final sample is shown and the
+    counts start afresh. Transfers from concurrent batches are reported
+    together.
+
+    Parameters
+    ----------
+    sinks : list of ProgressSink
+        where samples go. Inactive sinks are left out.
+    updates : float, optional
+        most samples a second.
+
+    """
+
+    def __init__(self, sinks, updates=DEFAULT_UPDATES):
+        if updates <= 0:
+            raise ValueError("updates must be positive")
+        self.sinks = [sink for sink in sinks if sink.active]
+        self.interval = 1.0 / updates
+        self._lock = threading.Lock()
+        self._transfers = set()
+        self._thread = None
+        self._stop = None
+        self._reset()
+
+    @property
+    def active(self):
+        return bool(self.sinks)
+
+    def add(self, transfers):
+        """Start reporting on transfers."""
+        if not self.sinks or not transfers:
+            return
+        with self._lock:
+            if self._started is None:
+                self._started = self._sampled = time.time()
+            for transfer in transfers:
+                self._transfers.add(transfer)
+                self._files += 1
+                # Bytes resumed from an earlier run are not part of the rate.
+                self._last += transfer.downloaded
+        if self._thread is None:
+            self._stop = threading.Event()
+            self._thread = threading.Thread(
+                target=self._report, args=(self._stop,), name="progress"
+            )
+            self._thread.daemon = True
+            self._thread.start()
+
+    def remove(self, transfers):
+        """
+        Stop reporting on transfers whose batch has settled. The final
+        sample is shown once none are left.
+        """
+        if not self.sinks or not transfers:
+            return
+        with self._lock:
+            for transfer in transfers:
+                if transfer not in self._transfers:
+                    continue
+                self._transfers.discard(transfer)
+                self._settled += transfer.downloaded
+            if self._transfers:
+                return
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+        self._emit(self.sample(done=True))
+        with self._lock:
+            self._reset()
+
+    def sample(self, done=False):
+        """
+        Take a sample of the transfers under way.
+
+        Returns
+        -------
+        Progress
+
+        """
+        with self._lock:
+            now = time.time()
+            downloaded = self._settled
+            size = self._settled
+            finished = self._files - len(self._transfers)
+            for transfer in self._transfers:
+                downloaded += transfer.downloaded
+                if transfer.finished:
+                    # A settled file is as large as what was retrieved.
+                    finished += 1
+                    if size is not None:
+                        size += transfer.downloaded
+                elif size is not None:
+                    if transfer.size is None or transfer.size < 0:
+                        size = None
+                    else:
+                        size += transfer.size
+
+            interval = now - self._sampled
+            delta = max(0, downloaded - self._last)
+            if interval > 0:
+                rate = delta / interval
+                if self._average is None:
+                    self._average = rate
+                else:
+                    alpha = 1 - math.exp(-interval / RATE_WINDOW)
+                    self._average += alpha * (rate - self._average)
+            else:
+                rate = self._rate
+            self._rate = rate
+            self._sampled = now
+            self._last = downloaded
+            return Progress(
+                now - self._started,
+                downloaded,
+                size,
+                self._files,
+                finished,
+                rate or 0.0,
+                self._average or 0.0,
+                done,
+            )
+
+    def _report(self, stop):
+        while not stop.wait(self.interval):
+            self._emit(self.sample())
+
+    def _emit(self, progress):
+        for sink in self.sinks:
+            try:
+                sink.update(progress)
+            except Exception:
+                LOG.exception("Progress sink %r failed", sink)
+
+    def _reset(self):
+        self._started = None
+        self._sampled = None
+        self._files = 0
+        self._settled = 0
+        self._last = 0
+        self._rate = None
+        self._average = None
+
+
+def _round(value, digits):
+    return None if value is None else round(value, digits)
+
+
+def _bytes(value):
+    """Format a number of bytes for people to read."""
+    value = float(value)
+    for unit in UNITS[:-1]:
+        if abs(value) < 1024:
+            break
+        value /= 1024
+    else:
+        unit = UNITS[-1]
+    if unit == UNITS[0]:
+        return "{:.0f} {}".format(value, unit)
+    return "{:.1f} {}".format(value, unit)
+
+
+def _duration(seconds):
+    seconds = int(seconds)
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def _describe(progress):
+    """Describe a sample in one line."""
+    line = "D/L {}".format(_bytes(progress.downloaded))
+    if progress.size is not None:
+        line += " / {} ({:6.2f}%)".format(_bytes(progress.size), progress.percent)
+    if progress.done:
+        line += " in {}".format(_duration(progress.elapsed))
+        if progress.elapsed > 0:
+            line += " - {}/s".format(_bytes(progress.downloaded / progress.elapsed))
+    else:
+        line += " - {}/s, avg {}/s".format(
+            _bytes(progress.rate), _bytes(progress.average)
+        )
+        eta = progress.eta
+        if eta is not None:
+            line += ", ETA {}".format(_duration(math.ceil(eta)))
+    if progress.files > 1:
+        line += " - {} of {} files".format(progress.finished, progress.files)
+    return line
@@ -0,0 +1,271 @@
+# -*- coding: utf8 -*-
+"""
+Decide when failed requests are tried again.
+
+Retries back off exponentially with full jitter, so many failed requests
+do not return to a struggling server together. A server which asks for
+time with Retry-After gets at least that long. A host which keeps failing
+is left alone for a while, for every transfer sharing the policy, before
+requests are let through again. Only failures which say something about
+the host count towards that: connection errors and 5xx statuses, not a
+missing file.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import email.utils
+import logging
+import random
+import threading
+import time
+
+import pycurl
+
+DEFAULT_MAX_RETRY = 5
+DEFAULT_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 30.0
+DEFAULT_MAX_RETRY_AFTER = 300.0
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_COOLDOWN = 30.0
+
+RETRY_STATUSES = (408, 425, 429, 500, 502, 503, 504)
+RETRY_AFTER_STATUSES = (429, 503)
+
+# Errors which will not go away by asking again.
+PERMANENT_ERRORS = (
+    pycurl.E_UNSUPPORTED_PROTOCOL,
+    pycurl.E_URL_MALFORMAT,
+    pycurl.E_REMOTE_ACCESS_DENIED,
+    pycurl.E_TOO_MANY_REDIRECTS,
+    pycurl.E_ABORTED_BY_CALLBACK,
+    pycurl.E_SSL_CERTPROBLEM,
+    pycurl.E_PEER_FAILED_VERIFICATION,
+    pycurl.E_FILESIZE_EXCEEDED,
+    pycurl.E_LOGIN_DENIED,
+    pycurl.E_REMOTE_FILE_NOT_FOUND,
+)
+
+# Errors on this side, which say nothing about the host.
+LOCAL_ERRORS = PERMANENT_ERRORS + (pycurl.E_WRITE_ERROR,)
+
+LOG = logging.getLogger(__name__)
+
+
+class TransientError(RuntimeError):
+    """
+    A request failed in a way which may pass.
+
+    Parameters
+    ----------
+    msg : str
+        what went wrong.
+    delay : float
+        seconds to wait before trying again.
+
+    """
+
+    def __init__(self, msg, delay):
+        super(TransientError, self).__init__(msg)
+        self.delay = delay
+
+
+class RetryPolicy(object):
+    """
+    When and how often to retry, shared by every request of a downloader,
+    or of several downloaders.
+
+    Parameters
+    ----------
+    max_retry : int, optional
+        Maximum attempts that will be made to retrieve a segment.
+    backoff : float, optional
+        Longest wait, in seconds, before the first retry.
+    factor : float, optional
+        Growth of the longest wait with each further retry.
+    max_backoff : float, optional
+        Cap on the longest wait, in seconds.
+    jitter : bool, optional
+        If true, wait a random time up to the longest wait.
+    statuses : tuple of int, optional
+        HTTP statuses which are retried. Other errors fail at once.
+    max_retry_after : float, optional
+        Longest Retry-After, in seconds, which is honoured.
+    breaker_threshold : int, optional
+        Consecutive connection errors or 5xx statuses after which a host is
+        left alone. 0 never leaves a host alone.
+    breaker_cooldown : float, optional
+        Seconds a failing host is left alone.
+
+    """
+
+    def __init__(
+        self,
+        max_retry=DEFAULT_MAX_RETRY,
+        backoff=DEFAULT_BACKOFF,
+        factor=2.0,
+        max_backoff=DEFAULT_MAX_BACKOFF,
+        jitter=True,
+        statuses=RETRY_STATUSES,
+        max_retry_after=DEFAULT_MAX_RETRY_AFTER,
+        breaker_threshold=DEFAULT_BREAKER_THRESHOLD,
+        breaker_cooldown=DEFAULT_BREAKER_COOLDOWN,
+    ):
+        self.max_retry = max_retry
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.statuses = statuses
+        self.max_retry_after = max_retry_after
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def retryable(self, status=None, errno=None):
+        """
+        Check if a failed request is worth trying again.
+
+        Parameters
+        ----------
+        status : int, optional
+            HTTP status of the response, if one arrived.
+        errno : int, optional
+            libcurl error code, if the request failed.
+
+        Returns
+        -------
+        bool
+
+        """
+        if errno is not None:
+            return errno not in PERMANENT_ERRORS
+        return status in self.statuses
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Seconds to wait before a retry.
+
+        Parameters
+        ----------
+        attempt : int
+            retries already made, starting at 0.
+        retry_after : float, optional
+            seconds the server asked for.
+
+        Returns
+        -------
+        float
+
+        """
+        delay = min(self.max_backoff, self.backoff * self.factor**attempt)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_retry_after))
+        return delay
+
+    def host_failed(self, status=None, errno=None):
+        """
+        Check if a failed request counts against its host.
+
+        Parameters
+        ----------
+        status : int, optional
+            HTTP status of the response, if one arrived.
+        errno : int, optional
+            libcurl error code, if the request failed.
+
+        Returns
+        -------
+        bool
+            True for a connection error or 5xx status. An error status for
+            one URL, such as 404, does not mean the host is failing.
+
+        """
+        if errno is not None:
+            return errno not in LOCAL_ERRORS
+        if status is not None:
+            return status >= 500
+        return True
+
+    def failure(self, host, hold=None, status=None, errno=None):
+        """
+        Record a failed request to a host.
+
+        Parameters
+        ----------
+        host : str
+            host and port the request went to.
+        hold : float, optional
+            seconds the host asked to be left alone for.
+        status : int, optional
+            HTTP status of the response, if one arrived.
+        errno : int, optional
+            libcurl error code, if the request failed. Failures which do
+            not count against the host, as told by host_failed, only apply
+            hold.
+
+        """
+        now = time.time()
+        with self.lock:
+            state = self.hosts.setdefault(host, [0, 0])
+            if self.host_failed(status, errno):
+                state[0] += 1
+            if self.breaker_threshold and state[0] >= self.breaker_threshold:
+                if state[1] <= now:
+                    LOG.warning(
+                        "%s: %d failures, leaving alone for %ds",
+                        host,
+                        state[0],
+                        self.breaker_cooldown,
+                    )
+                state[1] = max(state[1], now + self.breaker_cooldown)
+            if hold:
+                state[1] = max(state[1], now + min(hold, self.max_retry_after))
+
+    def success(self, host):
+        """Record a successful request to a host."""
+        with self.lock:
+            self.hosts.pop(host, None)
+
+    def blocked_until(self, host):
+        """
+        When requests to a host may start again.
+
+        Returns
+        -------
+        float
+            time.time() after which the host may be used, or None if it may
+            be used now.
+
+        """
+        state = self.hosts.get(host)
+        if state is None or state[1] <= time.time():
+            return None
+        return state[1]
+
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header.
+
+    Parameters
+    ----------
+    value : str
+        delay in seconds, or an HTTP date.
+
+    Returns
+    -------
+    float
+        seconds to wait, or None if the value cannot be parsed.
+
+    """
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(parsed) - time.time())
@@ -0,0 +1,686 @@
+# -*- coding: utf8 -*-
+"""
+Destinations for downloaded data.
+
+Segments arrive out of order. A file or buffer can take each piece at its
+offset as it arrives. A stream must see the data in order, so pieces which
+arrive ahead of the next offset are held in a reorder buffer, and segments
+are only requested within a window of that offset so the buffer stays
+bounded. Compressed files are decompressed the same way, in order, as they
+arrive.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import bz2
+import errno
+import logging
+import mmap
+import os
+import zlib
+
+import six
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+STREAM_BUFFER_SIZE = 64 * 1024
+
+# How file space is set aside before segments are written.
+ALLOCATIONS = ("sparse", "fallocate")
+# How written data passes through the page cache.
+WRITE_MODES = ("buffered", "dontneed", "direct")
+# Direct writes must start and end on this boundary, and come from memory
+# aligned to it.
+DIRECT_ALIGNMENT = max(4096, mmap.PAGESIZE)
+# Bytes written through the page cache between requests to drop them.
+DROP_INTERVAL = 64 * 1024 * 1024
+PARTIAL_SUFFIX = ".part"
+
+# Suffixes of compressed files, with the suffix of the decompressed file.
+EXTENSIONS = {
+    ".gz": ("gzip", ""),
+    ".tgz": ("gzip", ".tar"),
+    ".bz2": ("bz2", ""),
+    ".tbz2": ("bz2", ".tar"),
+    ".xz": ("xz", ""),
+    ".txz": ("xz", ".tar"),
+}
+CONTENT_TYPES = {
+    "application/gzip": "gzip",
+    "application/x-gzip": "gzip",
+    "application/x-bzip2": "bz2",
+    "application/x-xz": "xz",
+}
+CONTENT_ENCODINGS = {"gzip": "gzip", "x-gzip": "gzip", "deflate": "deflate"}
+MAGIC = {"gzip": b"\x1f\x8b", "bz2": b"BZh", "xz": b"\xfd7zXZ\x00"}
+DECOMPRESS_ERRORS = (EOFError, IOError, OSError, ValueError, zlib.error)
+if lzma is not None:
+    DECOMPRESS_ERRORS += (lzma.LZMAError,)
+
+LOG = logging.getLogger(__name__)
+
+
+class Sink(object):
+    """
+    Where the data of a transfer goes.
+
+    Attributes
+    ----------
+    name : str
+        name used in log messages.
+    target : object
+        what fetch returns for the transfer.
+    buffer_size : int
+        bytes a connection gathers before writing.
+    window : int
+        for ordered sinks, the most bytes which may be requested beyond the
+        next offset to be delivered, otherwise None.
+    rewindable : bool
+        true if data written again replaces what was there. Otherwise it is
+        dropped, and the verifier never sees it twice.
+    verifier : Verifier
+        checks the data as it is written, if set.
+
+    """
+
+    name = None
+    target = None
+    buffer_size = STREAM_BUFFER_SIZE
+    window = None
+    rewindable = True
+    verifier = None
+
+    def open(self, size, resumed=False):
+        """
+        Prepare to receive data.
+
+        Parameters
+        ----------
+        size : int
+            size of the file in bytes, or -1 if not known.
+        resumed : bool, optional
+            true if earlier data is being kept.
+
+        """
+
+    def write(self, offset, data):
+        """Store data retrieved from offset."""
+        raise NotImplementedError
+
+    def read(self, offset, length):
+        """Read back data previously written."""
+        raise NotImplementedError
+
+    def limit(self):
+        """Highest offset which may be requested now, or None for no limit."""
+        return None
+
+    def finish(self):
+        """Check the output is complete once every byte has been written."""
+
+    def discard(self, corrupt=False):
+        """
+        Remove what was written of a failed download which will not resume.
+
+        Parameters
+        ----------
+        corrupt : bool, optional
+            true if the data failed its checksum, so nothing of it may be
+            kept.
+
+        """
+
+    def close(self):
+        pass
+
+
+class FileSink(Sink):
+    """
+    Write to a named file, each piece at its offset.
+
+    Parameters
+    ----------
+    path : str
+        filename, possibly with path.
+    allocation : str, optional
+        "sparse" sets the file size up front and leaves the filesystem to
+        place blocks as segments arrive. "fallocate" reserves every block
+        before writing, so the file lies in few extents however the segments
+        arrive, falling back to sparse where the filesystem cannot.
+    write_mode : str, optional
+        "buffered" writes through the page cache. "dontneed" asks the kernel
+        to drop written pages as they reach the disk, so a large download
+        does not push other data out of the cache. "direct" writes the
+        aligned bulk of each piece with O_DIRECT, bypassing the cache, and
+        falls back to "dontneed" where that is not supported.
+    atomic : bool, optional
+        If true, write to a hidden name in the same directory, then sync
+        the file and rename it into place once it is complete and verified.
+        Watchers never see a partial file, and a single IN_MOVED_TO event
+        announces each finished one.
+
+    Attributes
+    ----------
+    path : str
+        file being written, which is path, or its temporary name.
+
+    """
+
+    buffer_size = WRITE_BUFFER_SIZE
+
+    def __init__(self, path, allocation="sparse", write_mode="buffered", atomic=False):
+        if allocation not in ALLOCATIONS:
+            raise ValueError("Unknown allocation {}".format(allocation))
+        if write_mode not in WRITE_MODES:
+            raise ValueError("Unknown write mode {}".format(write_mode))
+        self.name = path
+        self.target = path
+        self.allocation = allocation
+        self.write_mode = write_mode
+        self.atomic = atomic
+        self.path = partial_name(path) if atomic else path
+        self.fd = None
+        self.direct_fd = None
+        self.cached = 0
+        self._block = None
+
+    def open(self, size, resumed=False):
+        """Allocate file space and open the output for writing."""
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        if not resumed:
+            flags |= os.O_TRUNC
+        self.fd = os.open(self.path, flags, 0o644)
+        if not resumed and size > 0:
+            self._allocate(size)
+
+        if self.write_mode == "direct":
+            self.direct_fd = self._open_direct()
+        if self.write_mode != "buffered" and not hasattr(os, "posix_fadvise"):
+            LOG.debug("%s: Cannot drop cached pages on this platform", self.name)
+            self.write_mode = "buffered"
+
+    def write(self, offset, data):
+        if self.direct_fd is not None:
+            self._write_direct(offset, data)
+        else:
+            _pwrite(self.fd, data, offset)
+            self.cached += len(data)
+        if self.write_mode != "buffered" and self.cached >= DROP_INTERVAL:
+            self._drop_cache()
+        if self.verifier is not None:
+            self.verifier.update(self.read, offset, data)
+
+    def read(self, offset, length):
+        if hasattr(os, "pread"):
+            return os.pread(self.fd, length, offset)
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        return os.read(self.fd, length)
+
+    def finish(self):
+        """Publish a complete file written under its temporary name."""
+        if not self.atomic:
+            return
+        os.fsync(self.fd)
+        self.close()
+        getattr(os, "replace", os.rename)(self.path, self.name)
+        _fsync_dir(os.path.dirname(self.name))
+        LOG.debug("%s: Published", self.name)
+
+    def discard(self, corrupt=False):
+        # A partial file is left in place, as it always was, but one which
+        # failed its checksum would pass for good at its final name.
+        if not self.atomic and not corrupt:
+            return
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def close(self):
+        if self.direct_fd is not None:
+            os.close(self.direct_fd)
+            self.direct_fd = None
+        if self._block is not None:
+            self._block.close()
+            self._block = None
+        if self.fd is not None:
+            try:
+                if self.write_mode != "buffered":
+                    self._drop_cache(sync=True)
+            finally:
+                os.close(self.fd)
+                self.fd = None
+
+    def _allocate(self, size):
+        if self.allocation == "fallocate":
+            try:
+                os.posix_fallocate(self.fd, 0, size)
+                return
+            except (AttributeError, OSError) as e:
+                LOG.warning("%s: Cannot preallocate, leaving sparse (%s)", self.name, e)
+        os.ftruncate(self.fd, size)
+
+    def _open_direct(self):
+        """Open a second descriptor for direct writes, or return None."""
+        flag = getattr(os, "O_DIRECT", None)
+        if flag is None:
+            LOG.warning("%s: No direct I/O on this platform", self.name)
+            self.write_mode = "dontneed"
+            return None
+        try:
+            return os.open(self.path, os.O_WRONLY | flag)
+        except OSError as e:
+            LOG.warning("%s: Cannot write directly (%s)", self.name, e)
+            self.write_mode = "dontneed"
+            return None
+
+    def _write_direct(self, offset, data):
+        """
+        Write the aligned middle of data directly and its ragged ends
+        through the page cache. The ends never share a page with the middle,
+        so the two paths do not overlap.
+        """
+        end = offset + len(data)
+        start = -(-offset // DIRECT_ALIGNMENT) * DIRECT_ALIGNMENT
+        stop = end // DIRECT_ALIGNMENT * DIRECT_ALIGNMENT
+        if stop <= start:
+            _pwrite(self.fd, data, offset)
+            self.cached += len(data)
+            return
+
+        view = memoryview(data)
+        head = start - offset
+        tail = stop - offset
+        if head:
+            _pwrite(self.fd, view[:head], offset)
+        if tail < len(data):
+            _pwrite(self.fd, view[tail:], stop)
+        self.cached += head + len(data) - tail
+
+        length = stop - start
+        if self._block is None or len(self._block) < length:
+            if self._block is not None:
+                self._block.close()
+            # Anonymous maps are page aligned.
+            self._block = mmap.mmap(-1, length)
+        self._block[:length] = view[head:tail]
+        try:
+            _pwrite(self.direct_fd, memoryview(self._block)[:length], start)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            LOG.warning("%s: Cannot write directly (%s)", self.name, e)
+            os.close(self.direct_fd)
+            self.direct_fd = None
+            self.write_mode = "dontneed"
+            _pwrite(self.fd, view[head:tail], start)
+            self.cached += length
+
+    def _drop_cache(self, sync=False):
+        """
+        Ask the kernel to drop cached pages of the file. Dirty pages are
+        written back first and dropped by a later call, unless sync is set.
+        """
+        if sync:
+            getattr(os, "fdatasync", os.fsync)(self.fd)
+        os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        self.cached = 0
+
+
+class BufferSink(Sink):
+    """
+    Write into memory, each piece at its offset.
+
+    Parameters
+    ----------
+    buffer : bytearray or memoryview
+        destination. A bytearray is resized to fit the file. A memoryview
+        must be writable and large enough.
+
+    """
+
+    def __init__(self, buffer):
+        self.name = "<{}>".format(type(buffer).__name__)
+        self.target = buffer
+        self.buffer = buffer
+
+    def open(self, size, resumed=False):
+        if isinstance(self.buffer, bytearray):
+            keep = max(size, 0)
+            del self.buffer[keep:]
+            if size > 0:
+                self.buffer.extend(bytes(size - len(self.buffer)))
+        elif self.buffer.readonly:
+            raise ValueError("Output buffer is read only.")
+        elif len(self.buffer) < size:
+            raise ValueError(
+                "Output buffer holds {} bytes, {} needed.".format(
+                    len(self.buffer), size
+                )
+            )
+
+    def write(self, offset, data):
+        end = offset + len(data)
+        if end > len(self.buffer):
+            if not isinstance(self.buffer, bytearray):
+                raise ValueError("Output buffer is too small.")
+            self.buffer.extend(bytes(end - len(self.buffer)))
+        self.buffer[offset:end] = data
+        if self.verifier is not None:
+            self.verifier.update(self.read, offset, data)
+
+    def read(self, offset, length):
+        end = offset + length
+        return bytes(self.buffer[offset:end])
+
+
+class StreamSink(Sink):
+    """
+    Deliver data in order to a callable or a writable object.
+
+    Pieces which arrive ahead of the next offset are held until the gap
+    before them is filled. No more than ``window`` bytes beyond the next
+    offset are requested, which bounds what is held. Data before the next
+    offset has already been delivered and is dropped.
+
+    Parameters
+    ----------
+    consumer : callable or file-like
+        called with each chunk of data, in order, or an object whose write
+        method is.
+    window : int
+        reorder buffer size in bytes.
+    manual_release : bool, optional
+        If true, the window only moves when ``release`` is called, so a
+        consumer can hold back the download while it catches up.
+
+    """
+
+    rewindable = False
+
+    def __init__(self, consumer, window, manual_release=False):
+        self.target = consumer
+        if hasattr(consumer, "write"):
+            consumer = consumer.write
+        if not six.callable(consumer):
+            raise TypeError("Cannot stream to {!r}".format(consumer))
+        self.name = "<stream>"
+        self.consumer = consumer
+        self.window = window
+        self.manual_release = manual_release
+        self.position = 0
+        self.released = 0
+        self.pending = {}
+        self.buffered = 0
+
+    def write(self, offset, data):
+        if offset < self.position:
+            # A transfer without ranges is being retrieved again from the
+            # start. Skip what has already been delivered.
+            skip = self.position - offset
+            data = data[skip:]
+            offset = self.position
+            if not data:
+                return
+        if offset != self.position:
+            self.pending[offset] = data
+            self.buffered += len(data)
+            return
+
+        self._deliver(data)
+        while self.position in self.pending:
+            data = self.pending.pop(self.position)
+            self.buffered -= len(data)
+            self._deliver(data)
+
+    def _deliver(self, data):
+        if self.verifier is not None:
+            self.verifier.update(self.read, self.position, data)
+        self.position += len(data)
+        if not self.manual_release:
+            self.released = self.position
+        self.consumer(data)
+
+    def read(self, offset, length):
+        raise RuntimeError("A stream cannot be read back.")
+
+    def release(self, size):
+        """Move the window on by size bytes, once they have been consumed."""
+        self.released += size
+
+    def limit(self):
+        return self.released + self.window - 1
+
+
+class DecompressSink(StreamSink):
+    """
+    Decompress data in order, writing the result to another sink.
+
+    Checksums apply to the compressed data, as served. Concatenated gzip,
+    bzip2 and xz streams are decompressed one after another. Data which
+    does not start as the codec requires is passed on untouched, as files
+    are sometimes labelled compressed when they are not, or labelled twice.
+
+    Parameters
+    ----------
+    inner : Sink
+        destination of the decompressed data.
+    codec : str
+        gzip, deflate, bz2 or xz.
+    window : int
+        reorder buffer size in bytes.
+
+    """
+
+    def __init__(self, inner, codec, window):
+        super(DecompressSink, self).__init__(self._decompress, window)
+        if codec == "xz" and lzma is None:
+            raise ValueError("xz decompression requires the lzma module.")
+        self.inner = inner
+        self.codec = codec
+        self.name = inner.name
+        self.target = inner.target
+        self.decompressor = _decompressor(codec)
+        self.written = 0
+        self.error = None
+        self.passthrough = False
+        self._in_stream = False
+
+    def open(self, size, resumed=False):
+        self.inner.open(-1)
+
+    def limit(self):
+        if self.error is not None:
+            return self.position - 1
+        inner = self.inner.limit()
+        if inner is not None and self.inner.position > inner:
+            # The consumer has fallen a window behind.
+            return self.position - 1
+        return super(DecompressSink, self).limit()
+
+    def _decompress(self, data):
+        if self.error is not None:
+            return
+        if self.written == 0 and not self._in_stream:
+            magic = MAGIC.get(self.codec, b"")
+            self.passthrough = not data.startswith(magic[: len(data)])
+            if self.passthrough:
+                LOG.debug("%s: Not %s compressed, keeping as is", self.name, self.codec)
+        if self.passthrough:
+            self.inner.write(self.written, data)
+            self.written += len(data)
+            return
+        try:
+            while data:
+                if not self._in_stream:
+                    if not data.strip(b"\0"):
+                        # Streams may be padded with zeros.
+                        break
+                    self._in_stream = True
+                decompressed = self.decompressor.decompress(data)
+                if decompressed:
+                    self.inner.write(self.written, decompressed)
+                    self.written += len(decompressed)
+                if not self.decompressor.eof:
+                    break
+                self._in_stream = False
+                data = self.decompressor.unused_data
+                self.decompressor = _decompressor(self.codec)
+        except DECOMPRESS_ERRORS as e:
+            LOG.error("%s: Cannot decompress < %s >", self.name, e)
+            self.error = e
+
+    def finish(self):
+        if self.error is not None:
+            raise RuntimeError("Cannot decompress: {}".format(self.error))
+        if self._in_stream:
+            raise RuntimeError("Compressed data ends early.")
+        self.inner.finish()
+
+    def discard(self, corrupt=False):
+        self.inner.discard(corrupt)
+
+    def close(self):
+        self.inner.close()
+
+
+def partial_name(path):
+    """
+    Temporary name under which a file is written before it is published.
+
+    Parameters
+    ----------
+    path : str
+        filename, possibly with path.
+
+    Returns
+    -------
+    str
+        a hidden name in the same directory, so the rename stays on one
+        filesystem.
+
+    """
+    head, tail = os.path.split(path)
+    return os.path.join(head, "." + tail + PARTIAL_SUFFIX)
+
+
+def compression(name, headers, encoded=False):
+    """
+    Tell how a response is compressed.
+
+    Parameters
+    ----------
+    name : str
+        filename or URL of the file.
+    headers : dict
+        response headers keyed by lower-case name.
+    encoded : bool, optional
+        If true, the response was asked for compressed, so Content-Encoding
+        is applied on top of the file.
+
+    Returns
+    -------
+    list of str
+        gzip, deflate, bz2 or xz, outermost first, or an empty list if the
+        response is not compressed.
+
+    """
+    codecs = []
+    encoding = headers.get("content-encoding", "").strip().lower()
+    if encoded and encoding in CONTENT_ENCODINGS:
+        codecs.append(CONTENT_ENCODINGS[encoding])
+    content_type = headers.get("content-type", "").split(";")[0].strip().lower()
+    extension = os.path.splitext(name)[1].lower()
+    if content_type in CONTENT_TYPES:
+        codecs.append(CONTENT_TYPES[content_type])
+    elif extension in EXTENSIONS:
+        codecs.append(EXTENSIONS[extension][0])
+    return codecs
+
+
+def decompressed_name(name):
+    """Filename of a compressed file once decompressed."""
+    root, extension = os.path.splitext(name)
+    if extension.lower() in EXTENSIONS:
+        return root + EXTENSIONS[extension.lower()][1]
+    return name
+
+
+def _decompressor(codec):
+    if codec == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if codec == "deflate":
+        return zlib.decompressobj()
+    if codec == "bz2":
+        return bz2.BZ2Decompressor()
+    return lzma.LZMADecompressor()
+
+
+def create_sink(output, window):
+    """
+    Wrap an output in a sink.
+
+    Parameters
+    ----------
+    output : str, bytearray, memoryview, file-like or callable
+        a filename, a buffer to fill, or where to stream the data.
+    window : int
+        reorder buffer size for streams.
+
+    Returns
+    -------
+    Sink
+        the sink, or None if output is a filename or None.
+
+    """
+    if output is None or isinstance(output, six.string_types):
+        return None
+    if isinstance(output, Sink):
+        return output
+    if isinstance(output, (bytearray, memoryview)):
+        return BufferSink(output)
+    return StreamSink(output, window)
+
+
+def _fsync_dir(path):
+    """Make a rename in a directory durable, where the platform allows."""
+    try:
+        fd = os.open(path or os.curdir, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _pwrite(fd, data, offset):
+    """
+    Write all of data to a file descriptor at offset, leaving the file
+    position alone where the platform allows.
+
+    Parameters
+    ----------
+    fd : int
+        file descriptor open for writing.
+    data : bytes
+        data to write.
+    offset : int
+        file offset of the first byte.
+
+    """
+    view = memoryview(data)
+    while view:
+        if hasattr(os, "pwrite"):
+            written = os.pwrite(fd, view, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        offset += written
@@ -0,0 +1,384 @@
+# -*- coding: utf8 -*-
+"""
+Mirror directory listings, retrieving only files which are new or have
+changed since the last sync.
+
+Listings are parsed as they arrive. Each link to a file or directory
+directly inside the listed directory is an entry, and the text which
+follows the link, holding the date and size in Apache and nginx listings,
+is kept as the stamp of the entry. A file listed with the same stamp as
+last time, whose local copy is as it was left, is not asked about again.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import codecs
+import collections
+import logging
+import os
+
+from six.moves.html_parser import HTMLParser
+from six.moves.urllib.parse import unquote, urljoin, urlparse
+
+from tomputils.downloader.cache import MetadataCache, _entry
+
+LOG = logging.getLogger(__name__)
+SYNC_INDEX = ".sync-index.json"
+MAX_STAMP = 256
+
+# Tags which end the row of a listing.
+ROW_END_TAGS = ("tr", "li", "pre", "table", "ul")
+
+
+class ListingEntry(object):
+    """
+    A file or directory found in a listing.
+
+    Parameters
+    ----------
+    url : str
+        URL of the file or directory.
+    name : str
+        name of the file or directory.
+    is_dir : bool
+        True for a directory.
+
+    """
+
+    def __init__(self, url, name, is_dir):
+        self.url = url
+        self.name = name
+        self.is_dir = is_dir
+        self.stamp = None
+
+
+class ListingParser(HTMLParser):
+    """
+    Pick the entries out of a directory listing as it arrives.
+
+    Parameters
+    ----------
+    url : str
+        URL of the listed directory, ending with a slash.
+
+    """
+
+    def __init__(self, url):
+        HTMLParser.__init__(self)
+        self.url = url
+        self.entries = collections.deque()
+        self._decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self._entry = None
+        self._in_link = False
+        self._text = []
+        self._length = 0
+
+    def parse(self, data, final=False):
+        """
+        Parse the next part of the listing.
+
+        Parameters
+        ----------
+        data : bytes
+            the next part of the listing.
+        final : bool, optional
+            If true, the listing is complete.
+
+        Returns
+        -------
+        list of ListingEntry
+            entries completed by this part.
+
+        """
+        self.feed(self._decoder.decode(data, final))
+        if final:
+            self.close()
+            self._end_entry()
+        entries = list(self.entries)
+        self.entries.clear()
+        return entries
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "a":
+            return
+        self._in_link = True
+        entry = _listing_entry(self.url, dict(attrs).get("href"))
+        if entry is None:
+            return
+        if self._entry is not None and self._entry.url == entry.url:
+            # The icon and the name of an entry are often separate links.
+            return
+        self._end_entry()
+        self._entry = entry
+
+    def handle_endtag(self, tag):
+        if tag == "a":
+            self._in_link = False
+        elif tag in ROW_END_TAGS:
+            self._end_entry()
+
+    def handle_data(self, data):
+        if self._entry is None or self._in_link or self._length >= MAX_STAMP:
+            return
+        self._text.append(data)
+        self._length += len(data)
+
+    def _end_entry(self):
+        if self._entry is None:
+            return
+        stamp = " ".join("".join(self._text).split())[:MAX_STAMP]
+        self._entry.stamp = stamp or None
+        self.entries.append(self._entry)
+        self._entry = None
+        self._text = []
+        self._length = 0
+
+
+class SyncIndex(MetadataCache):
+    """
+    Metadata cache of a mirrored directory tree. Each entry also records the
+    stamp the file was listed with and the modification time of its local
+    copy, and entries are kept for files without validators.
+
+    Parameters
+    ----------
+    path : str
+        filename, possibly with path, of the index.
+
+    """
+
+    def unchanged(self, url, output, stamp, decompress=False):
+        """
+        Check if a file is listed as it was when its local copy was made,
+        and the local copy has not been touched since.
+
+        Parameters
+        ----------
+        url : str
+            URL of the file.
+        output : str
+            filename of the local copy.
+        stamp : str
+            stamp the file is listed with.
+        decompress : bool, optional
+            true if the file is wanted decompressed.
+
+        Returns
+        -------
+        bool
+
+        """
+        if stamp is None:
+            return False
+        entry = self.lookup(url, output, decompress)
+        if entry is None or entry.get("stamp") != stamp:
+            return False
+        try:
+            return os.path.getmtime(output) == entry.get("mtime")
+        except OSError:
+            return False
+
+    def update(
+        self,
+        url,
+        output,
+        size,
+        etag=None,
+        last_modified=None,
+        local_size=None,
+        decompress=False,
+    ):
+        """Remember a completed download, with or without validators."""
+        self.entries[url] = _entry(
+            output, size, etag, last_modified, local_size, decompress
+        )
+        self._dirty = True
+
+    def stamp(self, url, stamp):
+        """
+        Record the stamp of a file whose local copy is current.
+
+        Parameters
+        ----------
+        url : str
+            URL the file is listed at.
+        stamp : str
+            stamp the file is listed with.
+
+        """
+        entry = self.entries.get(url)
+        if entry is None:
+            return
+        try:
+            entry["mtime"] = os.path.getmtime(entry["output"])
+        except OSError:
+            return
+        entry["stamp"] = stamp
+        self._dirty = True
+
+
+class SyncPlan(object):
+    """
+    What a sync has left to do: the directories still to be listed and the
+    files found to be new or changed in the directory being listed.
+
+    Parameters
+    ----------
+    index_url : str
+        URL of the listing at the top of the tree.
+    local_dir : str
+        directory the tree is mirrored into. The index is kept here.
+    recursive : bool, optional
+        If true, subdirectories are mirrored too.
+    decompress : bool, optional
+        true if files are decompressed as they are retrieved.
+
+    """
+
+    def __init__(self, index_url, local_dir, recursive=True, decompress=False):
+        self.index = SyncIndex(os.path.join(local_dir, SYNC_INDEX))
+        self.recursive = recursive
+        self.decompress = decompress
+        self.directories = collections.deque()
+        self.seen = set()
+        self.changed = collections.OrderedDict()
+        self.listed = 0
+        self.directory = None
+        self._add_directory(_directory_url(index_url), local_dir)
+
+    def next_directory(self):
+        """
+        Move on to the next directory to list, creating its local copy.
+
+        Returns
+        -------
+        str
+            URL of the listing, or None if every directory has been listed.
+
+        """
+        if not self.directories:
+            return None
+        url, self.directory = self.directories.popleft()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        return url
+
+    def add(self, entries):
+        """
+        Sort entries of the current listing into directories to list and
+        files to retrieve.
+
+        Parameters
+        ----------
+        entries : list of ListingEntry
+            entries of the listing.
+
+        """
+        for entry in entries:
+            path = os.path.join(self.directory, entry.name)
+            if entry.is_dir:
+                if self.recursive:
+                    self._add_directory(entry.url, path)
+                continue
+            self.listed += 1
+            if entry.name == SYNC_INDEX or entry.url in self.changed:
+                continue
+            if not self.index.unchanged(entry.url, path, entry.stamp, self.decompress):
+                self.changed[entry.url] = entry
+
+    def take(self):
+        """
+        Take the files found to be new or changed.
+
+        Returns
+        -------
+        (list of str, list of str)
+            URLs and local filenames of the files.
+
+        """
+        entries = list(self.changed.values())
+        urls = [entry.url for entry in entries]
+        outputs = [os.path.join(self.directory, entry.name) for entry in entries]
+        return urls, outputs
+
+    def retrieved(self, results):
+        """
+        Record the outcome of the files taken.
+
+        Parameters
+        ----------
+        results : list of TransferResult
+            outcome of each file, in the order taken.
+
+        """
+        for entry, result in zip(self.changed.values(), results):
+            if result.ok:
+                self.index.stamp(entry.url, entry.stamp)
+        self.changed.clear()
+
+    def finish(self, results):
+        """
+        Save the index and report the outcome of the sync.
+
+        Parameters
+        ----------
+        results : list of TransferResult
+            outcome of every file probed or retrieved.
+
+        """
+        self.index.save()
+        retrieved = [r for r in results if r.ok and not r.skipped]
+        failed = [r for r in results if not r.ok]
+        LOG.info(
+            "Synced %d files, %d retrieved, %d failed.",
+            self.listed,
+            len(retrieved),
+            len(failed),
+        )
+
+    def _add_directory(self, url, path):
+        if url in self.seen:
+            return
+        self.seen.add(url)
+        self.directories.append((url, path))
+
+
+def _directory_url(url):
+    """Make sure the URL of a directory ends with a slash."""
+    parsed = urlparse(url)
+    if parsed.path.endswith("/"):
+        return url
+    return parsed._replace(path=parsed.path + "/").geturl()
+
+
+def _listing_entry(base, href):
+    """
+    Make an entry of a link in a listing, if it points directly inside the
+    listed directory.
+
+    Parameters
+    ----------
+    base : str
+        URL of the listed directory, ending with a slash.
+    href : str
+        target of the link.
+
+    Returns
+    -------
+    ListingEntry
+        the entry, or None if the link leads elsewhere.
+
+    """
+    if not href or href.startswith(("?", "#")):
+        return None
+    url = urljoin(base, href.strip())
+    if not url.startswith(base) or "?" in url or "#" in url:
+        return None
+    start = len(base)
+    rest = url[start:]
+    is_dir = rest.endswith("/")
+    if is_dir:
+        rest = rest[:-1]
+    name = unquote(rest)
+    if not name or name in (".", "..") or "/" in rest or os.sep in name:
+        return None
+    return ListingEntry(url, name, is_dir)
@@ -0,0 +1,353 @@
+# -*- coding: utf8 -*-
+"""
+Verify downloads against checksums while they are written.
+
+MD5 and SHA-256 must see the file in order, so they are fed from the lowest
+offset not yet hashed. Data which arrives ahead of that point is read back
+once the gap before it closes; it was written moments earlier, so it is
+usually still in the page cache. CRC32 and CRC32C are computed for each
+piece of data as it is written and combined at the end, so they never read
+the file back.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import base64
+import binascii
+import hashlib
+import logging
+import struct
+import zlib
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+READ_SIZE = 1024 * 1024
+CRC32_POLY = 0xEDB88320
+CRC32C_POLY = 0x82F63B78
+
+ALIASES = {
+    "md5": "md5",
+    "content-md5": "md5",
+    "sha-256": "sha256",
+    "sha256": "sha256",
+    "crc32": "crc32",
+    "crc32c": "crc32c",
+}
+
+LOG = logging.getLogger(__name__)
+
+
+class VerificationError(RuntimeError):
+    """A downloaded file does not match its checksum."""
+
+
+def parse_checksum(checksum):
+    """
+    Parse a caller supplied checksum.
+
+    Parameters
+    ----------
+    checksum : str or dict
+        "algorithm:hexdigest", or a dict mapping algorithm names to hex
+        digests. Algorithms are md5, sha256, crc32 and crc32c.
+
+    Returns
+    -------
+    dict
+        expected digests as bytes, keyed by algorithm.
+
+    """
+    if not isinstance(checksum, dict):
+        algorithm, _, digest = checksum.partition(":")
+        checksum = {algorithm: digest}
+
+    expected = {}
+    for algorithm, digest in checksum.items():
+        name = ALIASES.get(algorithm.lower())
+        if name is None:
+            raise ValueError("Unsupported checksum algorithm {}".format(algorithm))
+        if name == "crc32c" and crc32c is None:
+            raise ValueError("crc32c checksums require the crc32c package.")
+        expected[name] = binascii.unhexlify(digest.strip())
+    return expected
+
+
+def parse_digest_headers(headers):
+    """
+    Collect checksums advertised by the remote server.
+
+    Digest (RFC 3230), Repr-Digest (RFC 9530), Content-MD5 and
+    x-goog-hash headers are understood. Unknown algorithms are ignored.
+
+    Parameters
+    ----------
+    headers : dict
+        response headers keyed by lower-case name.
+
+    Returns
+    -------
+    dict
+        expected digests as bytes, keyed by algorithm.
+
+    """
+    values = []
+    if "content-md5" in headers:
+        values.append("md5=" + headers["content-md5"])
+    for name in ("digest", "repr-digest", "x-goog-hash"):
+        if name in headers:
+            values += headers[name].split(",")
+
+    expected = {}
+    for value in values:
+        algorithm, _, digest = value.strip().partition("=")
+        name = ALIASES.get(algorithm.strip().lower())
+        if name is None or (name == "crc32c" and crc32c is None):
+            continue
+        try:
+            expected[name] = base64.b64decode(digest.strip().strip(":"))
+        except (binascii.Error, ValueError):
+            LOG.debug("Ignoring malformed %s digest", algorithm)
+    return expected
+
+
+class Verifier(object):
+    """
+    Compute checksums of a file from the pieces written to it.
+
+    Parameters
+    ----------
+    expected : dict
+        expected digests as bytes, keyed by algorithm.
+
+    """
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.hashes = {}
+        for name in ("md5", "sha256"):
+            if name in expected:
+                self.hashes[name] = hashlib.new(name)
+        self.crcs = [name for name in ("crc32", "crc32c") if name in expected]
+        self.pieces = []
+        self.frontier = 0
+        self.covered = []
+
+    def update(self, read, offset, data):
+        """
+        Account for data written to the file.
+
+        Parameters
+        ----------
+        read : callable
+            reads back the output, given an offset and a length.
+        offset : int
+            file offset of the first byte of data.
+        data : bytes
+            data just written.
+
+        """
+        if self.crcs:
+            self.pieces.append((offset, len(data), self._crcs(data)))
+
+        if self.hashes:
+            _add_range(self.covered, offset, offset + len(data) - 1)
+            if offset == self.frontier:
+                self._hash(data)
+            if offset <= self.frontier:
+                self._catch_up(read)
+
+    def finish(self, read, size):
+        """
+        Check the file against the expected digests.
+
+        Ranges not seen by update, such as those retrieved before a download
+        was resumed, are read back from the file.
+
+        Parameters
+        ----------
+        read : callable
+            reads back the output, given an offset and a length.
+        size : int
+            size of the file in bytes.
+
+        Raises
+        ------
+        VerificationError
+            if any digest does not match.
+
+        """
+        if self.hashes:
+            self.covered = [[0, size - 1]]
+            self._catch_up(read)
+
+        actual = {}
+        for name, digest in self.hashes.items():
+            actual[name] = digest.digest()
+        if self.crcs:
+            actual.update(self._combined_crcs(read, size))
+
+        for name, digest in actual.items():
+            if digest != self.expected[name]:
+                raise VerificationError(
+                    "{} mismatch: expected {}, got {}".format(
+                        name,
+                        binascii.hexlify(self.expected[name]).decode(),
+                        binascii.hexlify(digest).decode(),
+                    )
+                )
+            LOG.debug("%s verified", name)
+
+    def _hash(self, data):
+        for digest in self.hashes.values():
+            digest.update(data)
+        self.frontier += len(data)
+
+    def _catch_up(self, read):
+        """Hash data beyond the frontier which is now contiguous with it."""
+        for r in self.covered:
+            if r[0] <= self.frontier <= r[1]:
+                for data in _read_range(read, self.frontier, r[1]):
+                    self._hash(data)
+                break
+
+    def _crcs(self, data):
+        crcs = []
+        for name in self.crcs:
+            if name == "crc32":
+                crcs.append(zlib.crc32(data) & 0xFFFFFFFF)
+            else:
+                crcs.append(crc32c.crc32c(data))
+        return crcs
+
+    def _combined_crcs(self, read, size):
+        pieces = []
+        position = 0
+        for offset, length, crcs in sorted(self.pieces):
+            if offset > position:
+                pieces += self._read_pieces(read, position, offset - 1)
+            elif offset < position:
+                raise VerificationError("overlapping writes at %d" % offset)
+            pieces.append((offset, length, crcs))
+            position = offset + length
+        if position < size:
+            pieces += self._read_pieces(read, position, size - 1)
+
+        combined = None
+        for offset, length, crcs in pieces:
+            if combined is None:
+                combined = list(crcs)
+                continue
+            for i, name in enumerate(self.crcs):
+                poly = CRC32_POLY if name == "crc32" else CRC32C_POLY
+                combined[i] = crc_combine(combined[i], crcs[i], length, poly)
+
+        if combined is None:
+            combined = self._crcs(b"")
+        return dict(
+            (name, struct.pack(">I", crc)) for name, crc in zip(self.crcs, combined)
+        )
+
+    def _read_pieces(self, read, start, end):
+        pieces = []
+        for data in _read_range(read, start, end):
+            pieces.append((start, len(data), self._crcs(data)))
+            start += len(data)
+        return pieces
+
+
+def _add_range(ranges, start, end):
+    """Merge an inclusive range into a sorted list of disjoint ranges."""
+    merged = []
+    for r in sorted(ranges + [[start, end]]):
+        if merged and r[0] <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], r[1])
+        else:
+            merged.append(list(r))
+    ranges[:] = merged
+
+
+def _read_range(read, start, end):
+    """Yield the bytes of an inclusive range of a file in chunks."""
+    while start <= end:
+        data = read(start, min(READ_SIZE, end - start + 1))
+        if not data:
+            raise VerificationError("file ends before offset %d" % start)
+        start += len(data)
+        yield data
+
+
+def _gf2_times(matrix, vector):
+    total = 0
+    i = 0
+    while vector:
+        if vector & 1:
+            total ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return total
+
+
+def _gf2_multiply(a, b):
+    """Compose two operators, applying b first."""
+    return [_gf2_times(a, column) for column in b]
+
+
+_ZEROS_OPERATORS = {}
+
+
+def _zeros_operator(length, poly):
+    """
+    Build the operator which advances a CRC over length zero bytes. Pieces
+    are mostly the same length, so operators are cached.
+    """
+    key = (length, poly)
+    if key in _ZEROS_OPERATORS:
+        return _ZEROS_OPERATORS[key]
+
+    # one zero bit, squared three times for one zero byte
+    op = [poly] + [1 << i for i in range(31)]
+    for _ in range(3):
+        op = _gf2_multiply(op, op)
+
+    result = [1 << i for i in range(32)]
+    remaining = length
+    while remaining:
+        if remaining & 1:
+            result = _gf2_multiply(op, result)
+        remaining >>= 1
+        if remaining:
+            op = _gf2_multiply(op, op)
+
+    if len(_ZEROS_OPERATORS) > 64:
+        _ZEROS_OPERATORS.clear()
+    _ZEROS_OPERATORS[key] = result
+    return result
+
+
+def crc_combine(crc1, crc2, len2, poly):
+    """
+    Combine the CRCs of two consecutive blocks, as zlib's crc32_combine does,
+    for any reflected 32-bit CRC.
+
+    Parameters
+    ----------
+    crc1 : int
+        CRC of the first block.
+    crc2 : int
+        CRC of the second block.
+    len2 : int
+        length of the second block in bytes.
+    poly : int
+        reflected polynomial of the CRC.
+
+    Returns
+    -------
+    int
+        CRC of the two blocks together.
+
+    """
+    if len2 == 0:
+        return crc1
+    return _gf2_times(_zeros_operator(len2, poly), crc1) ^ crc2
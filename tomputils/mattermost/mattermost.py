@@ -23,7 +23,6 @@ from __future__ import (absolute_import, division, print_function,
 import json
 import logging
 import os
-from future.builtins import *  # NOQA
 
 import requests
 import requests.exceptions
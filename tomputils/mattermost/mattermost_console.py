@@ -19,7 +19,6 @@ import json
 import logging
 import sys
 
-from future.builtins import *  # NOQA
 
 from .mattermost import DEFAULT_RETRIES, DEFAULT_TIMEOUT
 from .mattermost import Mattermost